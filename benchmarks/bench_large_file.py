@@ -0,0 +1,112 @@
+import hashlib, os, resource, shutil, subprocess, sys, tempfile, time
+from sys import argv
+
+# Loopback benchmark: STOR then RETR one large file through server-tcp.py and client-tcp.py
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, "server", "server-tcp.py")
+CLIENT = os.path.join(ROOT, "client", "client-tcp.py")
+FILE_NAME = "large.bin"
+# The test file repeats one random block; samples of this size are compared after each transfer
+BLOCK_SIZE = 1024 * 1024
+SAMPLES = 64
+
+def correct_usage_parameters_message():
+    if len(argv) < 2 or len(argv) > 4:
+        print("Usage: python3 bench_large_file.py <SIZE_GB> [PORT] [BUFFER_SIZE]")
+        exit(1)
+
+def create_test_file(path, file_size):
+    # Real data rather than a sparse file, so the benchmark includes disk reads and writes
+    block = os.urandom(BLOCK_SIZE)
+    with open(path, "wb") as output_file:
+        written = 0
+        while written < file_size:
+            written += output_file.write(block[:file_size - written])
+    return
+
+def sample_digest(path, file_size):
+    # Hash evenly spaced samples plus the size; a full hash of 10+ GB would dominate the run
+    digest = hashlib.sha256(str(file_size).encode())
+    with open(path, "rb") as content:
+        for index in range(SAMPLES):
+            content.seek(file_size * index // SAMPLES)
+            digest.update(content.read(BLOCK_SIZE))
+    return digest.hexdigest()
+
+def peak_rss_kib(pid):
+    # High-water mark of the resident set of a running process (Linux only)
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def run_client(directory, port, command):
+    start_time = time.time()
+    result = subprocess.run([sys.executable, CLIENT, "127.0.0.1", str(port), "-q"],
+                            input=f"{command}\nQUIT\n", cwd=directory, capture_output=True, text=True)
+    elapsed = time.time() - start_time
+    if result.returncode != 0:
+        print(result.stdout, result.stderr)
+        raise RuntimeError(f"client failed running '{command}'")
+    return elapsed
+
+def main():
+    # Check for correct usage of parameters
+    correct_usage_parameters_message()
+
+    file_size = int(float(argv[1]) * 1024 ** 3)
+    port = int(argv[2]) if len(argv) > 2 else 2199
+    buffer_size = int(argv[3]) if len(argv) > 3 else 1024 * 1024
+
+    work_directory = tempfile.mkdtemp(prefix="ftp-bench-")
+    server_directory = os.path.join(work_directory, "server")
+    upload_directory = os.path.join(work_directory, "upload")
+    download_directory = os.path.join(work_directory, "download")
+    for directory in (server_directory, upload_directory, download_directory):
+        os.mkdir(directory)
+
+    server = None
+    try:
+        print(f"Creating {file_size} byte test file in {upload_directory}...")
+        create_test_file(os.path.join(upload_directory, FILE_NAME), file_size)
+        expected = sample_digest(os.path.join(upload_directory, FILE_NAME), file_size)
+
+        server = subprocess.Popen([sys.executable, SERVER, "127.0.0.1", str(port), str(buffer_size), "-q"],
+                                  cwd=server_directory)
+        time.sleep(1)
+
+        results = []
+        for command, directory, target in (("STOR", upload_directory, server_directory),
+                                           ("RETR", download_directory, download_directory)):
+            elapsed = run_client(directory, port, f"{command} {FILE_NAME}")
+            target_path = os.path.join(target, FILE_NAME)
+            ok = os.path.getsize(target_path) == file_size and sample_digest(target_path, file_size) == expected
+            results.append((command, elapsed, ok))
+            if command == "RETR":
+                # The uploaded copy is no longer needed; keep the disk footprint at two copies
+                os.remove(os.path.join(upload_directory, FILE_NAME))
+
+        server_rss = peak_rss_kib(server.pid)
+        client_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+        print(f"\nFile size: {file_size} bytes, buffer size: {buffer_size} bytes\n")
+        print(f"\t{'Operation':<10}{'Seconds':>10}{'MiB/s':>12}{'Verified':>10}")
+        for command, elapsed, ok in results:
+            print(f"\t{command:<10}{elapsed:>10.2f}{file_size / elapsed / 1024 ** 2:>12.1f}{str(ok):>10}")
+        print(f"\nPeak RSS: server {server_rss} KiB, client {client_rss} KiB")
+    except KeyboardInterrupt:
+        print("\nBenchmark interrupted by user.")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(work_directory, ignore_errors=True)
+    return
+
+if __name__ == "__main__":
+    main()
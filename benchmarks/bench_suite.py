@@ -0,0 +1,408 @@
+import hashlib, json, os, platform, shutil, signal, socket, subprocess, sys, tempfile, threading, time
+from sys import argv
+
+# Loopback benchmark suite: STOR, RETR, LIST and DEL through both servers and clients, swept over
+# file sizes, buffer sizes and concurrency, with JSON results that can be compared between versions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = {"tcp": os.path.join(ROOT, "server", "server-tcp.py"), "udp": os.path.join(ROOT, "server", "server-udp.py")}
+CLIENTS = {"tcp": os.path.join(ROOT, "client", "client-tcp.py"), "udp": os.path.join(ROOT, "client", "client-udp.py")}
+OPERATIONS = ("STOR", "RETR", "LIST", "DEL")
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+# Every client moves at most this many bytes per operation, so large files run once instead of --ops times
+BYTES_PER_CLIENT = 256 * 1024 ** 2
+# The UDP server serves one client at a time, so UDP only runs single-client sweeps, with buffers that fit a datagram
+UDP_MAX_BUFFER_SIZE = 65507
+BLOCK_SIZE = 1024 * 1024
+SAMPLES = 64
+STARTUP_TIMEOUT = 10
+SHUTDOWN_TIMEOUT = 10
+METRIC_BUCKET = "ftp_command_duration_seconds_bucket"
+# End of the prompt both clients print before reading a command
+PROMPT = "command: "
+
+def correct_usage_parameters_message():
+    if "-h" in argv or "--help" in argv:
+        print("Usage: python3 bench_suite.py [--protocols tcp,udp] [--sizes 1K,64K,1M,16M,256M] "
+              "[--buffers 4096,65536] [--concurrency 1,4] [--ops N] [--port PORT] [--timeout SECONDS] [--output PATH] "
+              "[--input PATH] [--compare PATH] [--threshold PERCENT]")
+        exit(1)
+
+def parse_size(text):
+    text = text.strip().upper().removesuffix("B")
+    unit = text[-1:] if text[-1:] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+def format_size(size):
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return str(size)
+
+def parse_optional_arguments(arguments):
+    # Options with their default values; the lists are comma separated
+    options = {"--protocols": "tcp,udp", "--sizes": "1K,64K,1M,16M,256M", "--buffers": "4096,65536",
+               "--concurrency": "1,4", "--ops": "20", "--port": "2200", "--timeout": "600",
+               "--output": "bench-results.json", "--input": None, "--compare": None, "--threshold": "10"}
+    index = 0
+    while index < len(arguments):
+        option = arguments[index]
+        if option not in options or index + 1 >= len(arguments):
+            raise NameError(f"unknown or incomplete option '{option}'")
+        options[option] = arguments[index + 1]
+        index += 2
+    options["--protocols"] = [name.strip().lower() for name in options["--protocols"].split(",")]
+    if not set(options["--protocols"]) <= set(SERVERS):
+        raise NameError(f"protocols must be among {', '.join(SERVERS)}")
+    options["--sizes"] = [parse_size(size) for size in options["--sizes"].split(",")]
+    options["--buffers"] = [size.strip() if size.strip() == "auto" else parse_size(size)
+                            for size in options["--buffers"].split(",")]
+    options["--concurrency"] = [int(level) for level in options["--concurrency"].split(",")]
+    for name in ("--ops", "--port", "--timeout"):
+        options[name] = int(options[name])
+    options["--threshold"] = float(options["--threshold"]) / 100
+    if min(options["--sizes"]) < 1 or min(options["--concurrency"]) < 1 or options["--ops"] < 1:
+        raise ValueError("sizes, concurrency levels and --ops must be at least 1")
+    return options
+
+def create_test_file(path, file_size):
+    # Real data rather than a sparse file, so the benchmark includes disk reads and writes
+    block = os.urandom(min(BLOCK_SIZE, file_size))
+    with open(path, "wb") as output_file:
+        written = 0
+        while written < file_size:
+            written += output_file.write(block[:file_size - written])
+    return
+
+def sample_digest(path, file_size):
+    # Hash evenly spaced samples plus the size; a full hash of 10+ GB would dominate the run
+    digest = hashlib.sha256(str(file_size).encode())
+    with open(path, "rb") as content:
+        for index in range(SAMPLES):
+            content.seek(file_size * index // SAMPLES)
+            digest.update(content.read(BLOCK_SIZE))
+    return digest.hexdigest()
+
+def source_version():
+    try:
+        result = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+def wait_process(process, timeout):
+    # Reap a process with wait4 to get its own CPU time and peak RSS; kill it if it overstays the timeout
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    finally:
+        timer.cancel()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage
+
+def wait_until_ready(protocol, port):
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        try:
+            if protocol == "tcp":
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            else:
+                # STAT is the one UDP command answered without side effects
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+                    probe.settimeout(0.2)
+                    probe.sendto(b"STAT", ("127.0.0.1", port))
+                    probe.recvfrom(UDP_MAX_BUFFER_SIZE)
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"{protocol} server on port {port} did not start")
+
+def start_server(protocol, port, buffer_size, directory, metrics_path, log_file):
+    server = subprocess.Popen([sys.executable, SERVERS[protocol], "127.0.0.1", str(port), str(buffer_size), "-q",
+                               "--metrics-file", metrics_path], cwd=directory, stdout=log_file, stderr=log_file)
+    try:
+        wait_until_ready(protocol, port)
+    except RuntimeError:
+        server.kill()
+        wait_process(server, SHUTDOWN_TIMEOUT)
+        raise
+    return server
+
+def stop_server(server):
+    # The UDP server already left on the client's QUIT; both servers write their metrics when interrupted
+    try:
+        pid, _, usage = os.wait4(server.pid, os.WNOHANG)
+        if pid:
+            server.returncode = 0
+            return usage
+        server.send_signal(signal.SIGINT)
+    except ChildProcessError:
+        return None
+    return wait_process(server, SHUTDOWN_TIMEOUT)
+
+def read_latencies(metrics_path):
+    # Per command: cumulative bucket counts, sum, count and errors from the server's Prometheus dump
+    commands = {}
+    try:
+        with open(metrics_path) as metrics_file:
+            for line in metrics_file:
+                if not line.startswith("ftp_command_"):
+                    continue
+                series, value = line.rsplit(" ", 1)
+                name, labels = series.rstrip("}").split("{", 1)
+                labels = dict(label.split("=", 1) for label in labels.split(","))
+                entry = commands.setdefault(labels["command"].strip('"'),
+                                            {"buckets": [], "sum": 0.0, "count": 0, "errors": 0})
+                if name == METRIC_BUCKET:
+                    entry["buckets"].append((float(labels["le"].strip('"')), int(value)))
+                elif name.endswith("_sum"):
+                    entry["sum"] = float(value)
+                elif name.endswith("_count"):
+                    entry["count"] = int(value)
+                elif name == "ftp_command_errors_total":
+                    entry["errors"] = int(value)
+    except OSError:
+        pass
+    return commands
+
+def latency_quantile(buckets, quantile):
+    # Same interpolation as the servers' STAT, from the cumulative counts of the dump
+    if not buckets or not buckets[-1][1]:
+        return None
+    rank = quantile * buckets[-1][1]
+    lower, below = 0.0, 0
+    for bound, cumulative in buckets:
+        if cumulative >= rank and cumulative > below:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * (rank - below) / (cumulative - below)
+        lower, below = bound, cumulative
+    return lower
+
+def operation_script(operation, file_names):
+    if operation == "LIST":
+        return "LIST\n" * len(file_names)
+    if operation == "DEL":
+        return "".join(f"DEL {file_name}\nY\n" for file_name in file_names)
+    return "".join(f"{operation} {file_name}\n" for file_name in file_names)
+
+def wait_for_prompt(log_path, deadline):
+    # input() flushes its prompt, so the prompt in the log means the client is connected and waiting
+    while time.perf_counter() < deadline:
+        with open(log_path) as log_file:
+            if PROMPT in log_file.read():
+                return True
+        time.sleep(0.001)
+    return False
+
+def run_clients(protocol, port, buffer_size, operation, directories, file_names, work_directory, timeout):
+    # One client process per directory; the clock starts once all of them are connected and waiting,
+    # so interpreter start-up stays out of the numbers
+    arguments = [sys.executable, CLIENTS[protocol], "127.0.0.1", str(port)]
+    arguments += [str(buffer_size), "-q"] if protocol == "udp" else ["-q", "--dedup", "off"]
+    clients = []
+    deadline = time.perf_counter() + timeout
+    for index, directory in enumerate(directories):
+        log_path = os.path.join(work_directory, f"client-{index}.log")
+        with open(log_path, "w") as log_file:
+            client = subprocess.Popen(arguments, cwd=directory, stdin=subprocess.PIPE, stdout=log_file,
+                                      stderr=subprocess.STDOUT, text=True)
+        clients.append((client, log_path))
+    for client, log_path in clients:
+        wait_for_prompt(log_path, deadline)
+    start_time = time.perf_counter()
+    for (client, _), names in zip(clients, file_names):
+        client.stdin.write(operation_script(operation, names) + "QUIT\n")
+        client.stdin.close()
+    usages = [wait_process(client, max(deadline - time.perf_counter(), 0.1)) for client, _ in clients]
+    elapsed = time.perf_counter() - start_time
+    return elapsed, usages, [client.returncode for client, _ in clients]
+
+def verify_files(directories, file_names, file_size, expected):
+    for directory, names in zip(directories, file_names):
+        for file_name in names:
+            path = os.path.join(directory, file_name)
+            if not os.path.isfile(path) or os.path.getsize(path) != file_size:
+                return False
+            if sample_digest(path, file_size) != expected:
+                return False
+    return True
+
+def summarize(row, operation, elapsed, client_usages, server_usage, latency, file_size):
+    operations = row["clients"] * row["ops"]
+    entry = latency.get(operation, {"buckets": [], "sum": 0.0, "count": 0, "errors": 0})
+    row.update({
+        "seconds": elapsed,
+        "ops_per_second": operations / elapsed,
+        "mib_per_second": operations * file_size / elapsed / 1024 ** 2 if operation in ("STOR", "RETR") else None,
+        "server_ops": entry["count"],
+        "errors": entry["errors"],
+        "latency_mean_ms": entry["sum"] / entry["count"] * 1000 if entry["count"] else None,
+        "client_cpu_seconds": sum(usage.ru_utime + usage.ru_stime for usage in client_usages),
+        "server_cpu_seconds": server_usage.ru_utime + server_usage.ru_stime if server_usage else None,
+        "client_peak_rss_kib": max(usage.ru_maxrss for usage in client_usages),
+        "server_peak_rss_kib": server_usage.ru_maxrss if server_usage else None,
+    })
+    for quantile in (0.5, 0.95, 0.99):
+        value = latency_quantile(entry["buckets"], quantile)
+        row[f"latency_p{round(quantile * 100)}_ms"] = value * 1000 if value is not None else None
+    return row
+
+def run_configuration(protocol, file_size, buffer_size, concurrency, options, ports, work_directory):
+    # A fresh server per operation: the UDP client's QUIT stops its server, and each phase gets its own
+    # CPU time, peak RSS and latency histogram this way
+    ops = max(1, min(options["--ops"], BYTES_PER_CLIENT // file_size))
+    configuration = os.path.join(work_directory, f"{protocol}-{file_size}-{buffer_size}-{concurrency}")
+    server_directory = os.path.join(configuration, "server")
+    source_path = os.path.join(configuration, "source.bin")
+    upload_directories = [os.path.join(configuration, f"upload-{index}") for index in range(concurrency)]
+    download_directories = [os.path.join(configuration, f"download-{index}") for index in range(concurrency)]
+    for directory in [server_directory] + upload_directories + download_directories:
+        os.makedirs(directory)
+    create_test_file(source_path, file_size)
+    expected = sample_digest(source_path, file_size)
+    file_names = [[f"bench-{index}-{number}.bin" for number in range(ops)] for index in range(concurrency)]
+    for directory, names in zip(upload_directories, file_names):
+        for file_name in names:
+            # Hard links: every upload has a name of its own without another copy on disk
+            os.link(source_path, os.path.join(directory, file_name))
+
+    rows = []
+    try:
+        for operation in OPERATIONS:
+            port = next(ports)
+            metrics_path = os.path.join(configuration, f"{operation}.prom")
+            row = {"protocol": protocol, "file_size": file_size, "buffer_size": buffer_size, "clients": concurrency,
+                   "operation": operation, "ops": ops, "status": "ok", "verified": None}
+            with open(os.path.join(configuration, f"server-{operation}.log"), "w") as log_file:
+                server = start_server(protocol, port, buffer_size, server_directory, metrics_path, log_file)
+                try:
+                    directories = download_directories if operation == "RETR" else upload_directories
+                    elapsed, client_usages, exit_codes = run_clients(protocol, port, buffer_size, operation,
+                                                                     directories, file_names, configuration,
+                                                                     options["--timeout"])
+                finally:
+                    server_usage = stop_server(server)
+            summarize(row, operation, elapsed, client_usages, server_usage, read_latencies(metrics_path), file_size)
+            if any(code != 0 for code in exit_codes):
+                row["status"] = "failed"
+            if operation == "STOR":
+                row["verified"] = verify_files([server_directory] * concurrency, file_names, file_size, expected)
+            elif operation == "RETR":
+                row["verified"] = verify_files(download_directories, file_names, file_size, expected)
+                # Only two copies at a time on disk: the server's and the uploads
+                for directory in download_directories:
+                    shutil.rmtree(directory)
+                    os.mkdir(directory)
+            if row["verified"] is False:
+                row["status"] = "failed"
+            rows.append(row)
+            print_row(row)
+    finally:
+        shutil.rmtree(configuration, ignore_errors=True)
+    return rows
+
+def print_header():
+    print(f"\n\t{'Proto':<6}{'Size':>6}{'Buffer':>8}{'Clients':>8}{'Op':>6}{'Ops':>6}{'Ops/s':>10}{'MiB/s':>10}"
+          f"{'p50 ms':>10}{'p99 ms':>10}{'CPU s':>8}{'RSS MiB':>9}  Status")
+    return
+
+def print_row(row):
+    def number(value, digits):
+        return "-" if value is None else f"{value:.{digits}f}"
+    print(f"\t{row['protocol']:<6}{format_size(row['file_size']):>6}{str(row['buffer_size']):>8}{row['clients']:>8}"
+          f"{row['operation']:>6}{row['ops']:>6}{number(row.get('ops_per_second'), 1):>10}"
+          f"{number(row.get('mib_per_second'), 1):>10}{number(row.get('latency_p50_ms'), 2):>10}"
+          f"{number(row.get('latency_p99_ms'), 2):>10}"
+          f"{number((row.get('server_cpu_seconds') or 0) + (row.get('client_cpu_seconds') or 0), 2):>8}"
+          f"{number((row.get('server_peak_rss_kib') or 0) / 1024, 1):>9}  {row['status']}")
+    return
+
+def run_suite(options):
+    results = {"version": source_version(), "python": platform.python_version(), "platform": platform.platform(),
+               "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+               "settings": {name.lstrip("-"): options[name]
+                            for name in ("--protocols", "--sizes", "--buffers", "--concurrency", "--ops")},
+               "results": []}
+    work_directory = tempfile.mkdtemp(prefix="ftp-bench-suite-")
+    ports = iter(range(options["--port"], options["--port"] + 10000))
+    print_header()
+    try:
+        for protocol in options["--protocols"]:
+            for file_size in options["--sizes"]:
+                for buffer_size in options["--buffers"]:
+                    for concurrency in options["--concurrency"]:
+                        if protocol == "udp" and (concurrency > 1 or buffer_size == "auto" or
+                                                  buffer_size > UDP_MAX_BUFFER_SIZE):
+                            continue
+                        try:
+                            results["results"] += run_configuration(protocol, file_size, buffer_size, concurrency,
+                                                                    options, ports, work_directory)
+                        except (RuntimeError, OSError) as e:
+                            print(f"\tError running {protocol} {format_size(file_size)}/{buffer_size}/"
+                                  f"{concurrency}: {e}")
+    except KeyboardInterrupt:
+        print("\nBenchmark interrupted by user, keeping the results so far.")
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    return results
+
+def row_key(row):
+    return (row["protocol"], row["file_size"], str(row["buffer_size"]), row["clients"], row["operation"])
+
+def compare_results(baseline, current, threshold):
+    # A row regresses when throughput drops, or mean latency or server memory grows, by more than the threshold
+    previous = {row_key(row): row for row in baseline["results"] if row["status"] == "ok"}
+    regressions = 0
+    print(f"\nCompared with {baseline.get('version')} from {baseline.get('started')} "
+          f"(threshold {threshold * 100:.0f}%):\n")
+    print(f"\t{'Proto':<6}{'Size':>6}{'Buffer':>8}{'Clients':>8}{'Op':>6}{'Throughput':>12}{'Mean lat.':>11}"
+          f"{'Srv RSS':>9}")
+    for row in current["results"]:
+        old = previous.get(row_key(row))
+        if old is None or row["status"] != "ok":
+            continue
+        metric = "mib_per_second" if row["mib_per_second"] is not None else "ops_per_second"
+        changes = [(row[metric] / old[metric] - 1, True)]
+        for name in ("latency_mean_ms", "server_peak_rss_kib"):
+            changes.append((row[name] / old[name] - 1 if row[name] and old[name] else 0.0, False))
+        flagged = any(-change > threshold if higher_is_better else change > threshold
+                      for change, higher_is_better in changes)
+        regressions += flagged
+        throughput, latency, memory = (change * 100 for change, _ in changes)
+        print(f"\t{row['protocol']:<6}{format_size(row['file_size']):>6}{str(row['buffer_size']):>8}"
+              f"{row['clients']:>8}{row['operation']:>6}{throughput:>+11.1f}%{latency:>+10.1f}%{memory:>+8.1f}%"
+              f"{'  REGRESSION' if flagged else ''}")
+    print(f"\n{regressions} regression(s) beyond {threshold * 100:.0f}%.")
+    return regressions
+
+def main():
+    # Check for correct usage of parameters
+    correct_usage_parameters_message()
+
+    try:
+        options = parse_optional_arguments(argv[1:])
+        if options["--input"] is not None:
+            with open(options["--input"]) as input_file:
+                results = json.load(input_file)
+        else:
+            results = run_suite(options)
+            with open(options["--output"], "w") as output_file:
+                json.dump(results, output_file, indent=2)
+            print(f"\nResults written to {options['--output']}")
+        if options["--compare"] is not None:
+            with open(options["--compare"]) as baseline_file:
+                baseline = json.load(baseline_file)
+            if compare_results(baseline, results, options["--threshold"]):
+                exit(1)
+    except (NameError, ValueError) as e:
+        print(f"Error: {e}")
+        exit(1)
+    except OSError as e:
+        print(f"Error reading or writing results: {e}")
+        exit(1)
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import importlib.util, json, logging, os, random, resource, shutil, socket, struct, tempfile, threading, time
+from sys import argv
+
+# Load generator: N concurrent TCP sessions running a weighted mix of STOR, RETR, LIST and DEL with
+# file sizes and think times drawn at random, reporting throughput, tail latency and errors over time.
+# Requests are sent and read by the same handlers client-tcp.py uses, one thread per session.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT = os.path.join(ROOT, "client", "client-tcp.py")
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+QUANTILES = (0.5, 0.95, 0.99, 0.999)
+# Commands that need a file the session stored earlier; without one the session uploads instead
+NEEDS_FILE = ("RETR", "DEL")
+# Names each session cycles through, so the server's directory stays bounded however long the run
+FILES_PER_SESSION = 8
+LIST_LIMIT = 100
+RECONNECT_DELAY = 1.0
+# Thousands of session threads only need small stacks
+THREAD_STACK_SIZE = 512 * 1024
+
+# Samples of the current interval and totals of the whole run, shared by every session thread
+RESULTS = {"lock": threading.Lock(), "samples": [], "active": 0, "intervals": [], "commands": {}}
+
+def load_client_module():
+    # client-tcp.py is a script with a dash in its name, so it is loaded from its path
+    spec = importlib.util.spec_from_file_location("client_tcp", CLIENT)
+    client = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(client)
+    # Outcomes are counted here; the client's own messages would only flood the terminal
+    client.LOG.handlers = [logging.NullHandler()]
+    client.LOG.propagate = False
+    return client
+
+def correct_usage_parameters_message():
+    if len(argv) < 3:
+        print("Usage: python3 load_generator.py <IP> <PORT> [--sessions N] [--duration SECONDS] "
+              "[--mix STOR:30,RETR:50,LIST:10,DEL:10] [--sizes 1K:50,64K:30,1M:15,16M:5] [--think MS] "
+              "[--ramp SECONDS] [--interval SECONDS] [--output PATH] [--seed N]")
+        exit(1)
+
+def parse_size(text):
+    text = text.strip().upper().removesuffix("B")
+    unit = text[-1:] if text[-1:] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+def parse_weights(text, parse_key):
+    # "KEY:WEIGHT,KEY:WEIGHT" into a list of keys and a list of weights
+    keys, weights = [], []
+    for item in text.split(","):
+        key, _, weight = item.partition(":")
+        keys.append(parse_key(key))
+        weights.append(float(weight or 1))
+    if min(weights) < 0 or sum(weights) <= 0:
+        raise ValueError("weights must not be negative and must not all be zero")
+    return keys, weights
+
+def parse_command(text):
+    command = text.strip().upper()
+    if command not in ("STOR", "RETR", "LIST", "DEL"):
+        raise NameError(f"unknown command '{text}' in --mix")
+    return command
+
+def parse_optional_arguments(arguments):
+    # Options that may follow the positional parameters, with their default values
+    options = {"--sessions": "100", "--duration": "60", "--mix": "STOR:30,RETR:50,LIST:10,DEL:10",
+               "--sizes": "1K:50,64K:30,1M:15,16M:5", "--think": "100", "--ramp": "5", "--interval": "5",
+               "--output": None, "--seed": None}
+    index = 0
+    while index < len(arguments):
+        option = arguments[index]
+        if option not in options or index + 1 >= len(arguments):
+            raise NameError(f"unknown or incomplete option '{option}'")
+        options[option] = arguments[index + 1]
+        index += 2
+    options["--sessions"] = int(options["--sessions"])
+    for name in ("--duration", "--think", "--ramp", "--interval"):
+        options[name] = float(options[name])
+    options["--mix"] = parse_weights(options["--mix"], parse_command)
+    options["--sizes"] = parse_weights(options["--sizes"], parse_size)
+    if options["--output"] is not None:
+        # The run changes into a scratch directory, so a relative path is resolved first
+        options["--output"] = os.path.abspath(options["--output"])
+    if options["--sessions"] < 1 or options["--duration"] <= 0 or options["--interval"] <= 0:
+        raise ValueError("sessions, duration and interval must be positive")
+    return options
+
+def raise_file_limit(sessions):
+    # One socket per session plus the files being sent; the soft limit is often far below that
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = sessions * 2 + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard) if hard != resource.RLIM_INFINITY else wanted,
+                                                    hard))
+    return
+
+def create_source_files(directory, sizes):
+    # One file of random data per size; uploads are hard links to these under names of their own
+    sources = {}
+    for size in sizes:
+        path = os.path.join(directory, f"source-{size}.bin")
+        with open(path, "wb") as output_file:
+            block = os.urandom(min(size, 1024 * 1024))
+            written = 0
+            while written < size:
+                written += output_file.write(block[:size - written])
+        sources[size] = path
+    return sources
+
+def record(command, start_time, size, outcome):
+    latency = time.perf_counter() - start_time
+    with RESULTS["lock"]:
+        RESULTS["samples"].append((command, latency, size, outcome))
+    return
+
+def connect(client, address):
+    soc, buffer_size, _ = client.open_session(address)
+    # Downloads stay uncompressed, like a client started without --compress
+    client.send_frame(soc, client.OP_HELLO, 0, [client.CLIENT_HELLO.pack(client.CODEC_NONE)])
+    return soc, buffer_size
+
+def create_command(client, session, command, stored, sources, options):
+    # A request dict as the interactive client builds it, for a file picked by this session
+    session["request_id"] = session["request_id"] % 0xFFFFFFFF + 1
+    if command in NEEDS_FILE and not stored:
+        command = "STOR"
+    if command == "STOR":
+        size = random.choices(*options["--sizes"])[0]
+        file_name = f"load-{session['number']}-{session['uploads'] % FILES_PER_SESSION}.bin"
+        session["uploads"] += 1
+        # STOR reads the local file with the remote name; link it to the source of the chosen size.
+        # The name belongs to this session alone, so removing and linking again needs no care for others
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            pass
+        os.link(sources[size], file_name)
+        request = client.create_request("STOR", session["request_id"], file_name)
+        request.update({"resume": False, "codec": client.CODEC_NONE, "dedup": False})
+    elif command == "LIST":
+        request = client.create_request("LIST", session["request_id"])
+        request.update(client.parse_list_options(f"-n {LIST_LIMIT}"))
+        size = 0
+    else:
+        file_name = random.choice(list(stored))
+        size = stored[file_name] if command == "RETR" else 0
+        request = client.create_request(command, session["request_id"], file_name)
+        request["codec"] = client.CODEC_NONE
+        if command == "DEL":
+            del stored[file_name]
+    return request, size
+
+def run_command(client, soc, buffer_size, request):
+    # Same sender and reader as a pipeline of one; the status decides the outcome
+    sender, receiver = client.REQUEST_HANDLERS[request["command"]]
+    request["start_time"] = time.time()
+    sender(soc, buffer_size, request)
+    _, status, flags, request_id, payload_length = client.recv_frame(soc)
+    if request_id != request["request_id"]:
+        raise ConnectionError(f"response {request_id} does not match request {request['request_id']}")
+    receiver(soc, buffer_size, request, status, flags, payload_length)
+    if status == client.STATUS_OK:
+        return "ok"
+    return "not_found" if status == client.STATUS_NOT_FOUND else "error"
+
+def run_session(client, number, address, sources, options, stop):
+    session = {"number": number, "request_id": 0, "uploads": 0}
+    # Remote files of this session and their sizes
+    stored = {}
+    soc = None
+    while not stop.is_set():
+        if soc is None:
+            start_time = time.perf_counter()
+            try:
+                soc, buffer_size = connect(client, address)
+                with RESULTS["lock"]:
+                    RESULTS["active"] += 1
+            except(socket.error, OSError, struct.error):
+                record("CONNECT", start_time, 0, "error")
+                stop.wait(RECONNECT_DELAY)
+                continue
+
+        command = random.choices(*options["--mix"])[0]
+        request, size = create_command(client, session, command, stored, sources, options)
+        start_time = time.perf_counter()
+        try:
+            outcome = run_command(client, soc, buffer_size, request)
+        except(socket.error, OSError, struct.error, ValueError):
+            # The stream is out of step after a failed exchange: start over on a new connection
+            record(request["command"], start_time, 0, "error")
+            soc.close()
+            soc = None
+            with RESULTS["lock"]:
+                RESULTS["active"] -= 1
+            continue
+        record(request["command"], start_time, size if outcome == "ok" else 0, outcome)
+        if request["command"] == "STOR" and outcome == "ok":
+            stored[request["file_name"]] = size
+        if options["--think"] > 0:
+            # Exponential think time: users act independently of each other
+            stop.wait(random.expovariate(1000 / options["--think"]))
+
+    if soc is not None:
+        # Leave the server as we found it; these deletes are not measured
+        for file_name in list(stored):
+            try:
+                session["request_id"] += 1
+                run_command(client, soc, 0, client.create_request("DEL", session["request_id"], file_name))
+            except(socket.error, OSError, struct.error):
+                break
+        client.close_connection(soc, session["request_id"] + 1)
+        with RESULTS["lock"]:
+            RESULTS["active"] -= 1
+    return
+
+def quantile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(samples, seconds):
+    latencies = sorted(latency for _, latency, _, _ in samples)
+    errors = sum(1 for _, _, _, outcome in samples if outcome == "error")
+    summary = {"ops": len(samples), "ops_per_second": len(samples) / seconds,
+               "mib_per_second": sum(size for _, _, size, _ in samples) / seconds / 1024 ** 2,
+               "errors": errors, "error_rate": errors / len(samples) if samples else 0.0,
+               "not_found": sum(1 for _, _, _, outcome in samples if outcome == "not_found"),
+               "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+               "max_ms": latencies[-1] * 1000 if latencies else 0.0}
+    for fraction in QUANTILES:
+        summary[f"p{fraction * 100:g}_ms"] = quantile(latencies, fraction) * 1000
+    return summary
+
+def print_interval(elapsed, active, summary):
+    print(f"\t{elapsed:>7.1f}{active:>9}{summary['ops_per_second']:>10.1f}{summary['mib_per_second']:>9.1f}"
+          f"{summary['p50_ms']:>9.2f}{summary['p95_ms']:>9.2f}{summary['p99_ms']:>9.2f}{summary['p99.9_ms']:>10.2f}"
+          f"{summary['errors']:>8}{summary['error_rate'] * 100:>7.2f}%")
+    return
+
+def report(options, start_time, stop):
+    # Every interval: swap out the samples, print a line and keep the summary for the JSON output
+    print(f"\n\t{'Time s':>7}{'Sessions':>9}{'Ops/s':>10}{'MiB/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'p99.9 ms':>10}{'Errors':>8}{'Err %':>8}")
+    last_time = start_time
+    while True:
+        stopping = stop.wait(options["--interval"])
+        now = time.perf_counter()
+        with RESULTS["lock"]:
+            samples, RESULTS["samples"] = RESULTS["samples"], []
+            active = RESULTS["active"]
+        for sample in samples:
+            RESULTS["commands"].setdefault(sample[0], []).append(sample)
+        summary = summarize(samples, now - last_time)
+        summary.update({"time": now - start_time, "sessions": active})
+        RESULTS["intervals"].append(summary)
+        print_interval(now - start_time, active, summary)
+        last_time = now
+        if stopping:
+            return
+
+def print_totals(seconds):
+    print(f"\n\t{'Command':<9}{'Ops':>8}{'Ops/s':>10}{'Mean ms':>9}{'p50 ms':>9}{'p99 ms':>9}{'p99.9 ms':>10}"
+          f"{'Max ms':>10}{'Errors':>8}{'Err %':>8}")
+    totals = {}
+    for command, samples in sorted(RESULTS["commands"].items()):
+        totals[command] = summary = summarize(samples, seconds)
+        print(f"\t{command:<9}{summary['ops']:>8}{summary['ops_per_second']:>10.1f}{summary['mean_ms']:>9.2f}"
+              f"{summary['p50_ms']:>9.2f}{summary['p99_ms']:>9.2f}{summary['p99.9_ms']:>10.2f}"
+              f"{summary['max_ms']:>10.2f}{summary['errors']:>8}{summary['error_rate'] * 100:>7.2f}%")
+    return totals
+
+def main():
+    # Check for correct usage of parameters
+    correct_usage_parameters_message()
+
+    try:
+        address = (argv[1], int(argv[2]))
+        options = parse_optional_arguments(argv[3:])
+    except(NameError, ValueError) as e:
+        print(f"Error: {e}")
+        exit(1)
+    if options["--seed"] is not None:
+        random.seed(options["--seed"])
+
+    client = load_client_module()
+    raise_file_limit(options["--sessions"])
+    threading.stack_size(THREAD_STACK_SIZE)
+    work_directory = tempfile.mkdtemp(prefix="ftp-load-")
+    # The client handlers open files by the remote name, relative to the working directory
+    os.chdir(work_directory)
+    sources = create_source_files(work_directory, options["--sizes"][0])
+
+    print(f"Running {options['--sessions']} sessions against {address[0]}:{address[1]} "
+          f"for {options['--duration']:.0f}s...")
+    stop = threading.Event()
+    sessions = []
+    started = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    start_time = time.perf_counter()
+    reporter = threading.Thread(target=report, args=(options, start_time, stop))
+    reporter.start()
+    try:
+        for number in range(options["--sessions"]):
+            # Sessions start spread over the ramp-up time instead of all connecting at once
+            if stop.wait(options["--ramp"] / options["--sessions"]):
+                break
+            session = threading.Thread(target=run_session, args=(client, number, address, sources, options, stop),
+                                       daemon=True)
+            session.start()
+            sessions.append(session)
+        stop.wait(max(0.0, options["--duration"] - (time.perf_counter() - start_time)))
+    except KeyboardInterrupt:
+        print("\nLoad generator interrupted by user.")
+    finally:
+        stop.set()
+        reporter.join()
+        elapsed = time.perf_counter() - start_time
+        print("\nWaiting for the sessions to clean up...")
+        for session in sessions:
+            session.join()
+        os.chdir(ROOT)
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    totals = print_totals(elapsed)
+    # Near one full core, the generator itself is the bottleneck, not the server
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+    print(f"\nLoad generator CPU: {cpu_seconds:.1f}s, {cpu_seconds / elapsed * 100:.0f}% of one core")
+    if options["--output"] is not None:
+        results = {"server": f"{address[0]}:{address[1]}", "started": started,
+                   "settings": {"sessions": options["--sessions"], "duration": options["--duration"],
+                                "mix": dict(zip(*options["--mix"])), "sizes": dict(zip(*options["--sizes"])),
+                                "think_ms": options["--think"], "ramp": options["--ramp"]},
+                   "generator_cpu_seconds": cpu_seconds, "intervals": RESULTS["intervals"], "commands": totals}
+        try:
+            with open(options["--output"], "w") as output_file:
+                json.dump(results, output_file, indent=2)
+            print(f"\nResults written to {options['--output']}")
+        except OSError as e:
+            print(f"Error writing results: {e}")
+    return
+
+if __name__ == "__main__":
+    main()
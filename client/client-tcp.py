@@ -1,31 +1,223 @@
-import socket, struct, sys, os, time
+import bz2, collections, concurrent.futures, fnmatch, functools, glob, hashlib, itertools, json, logging, logging.handlers, operator, queue, shlex, shutil, socket, struct, sys, tarfile, os, time, threading, zlib
 from sys import argv
 
+try:
+    import lzma
+except ImportError:
+    # Python builds without liblzma have no lzma module; the codec is then simply not offered
+    lzma = None
+
+# Results and errors of commands go through this logger; a background thread writes them out
+LOG = logging.getLogger("ftp.client")
+# -n shows every result, -q only warnings and errors
+LOG_LEVELS = {"-n": logging.INFO, "-q": logging.WARNING}
+# Results read like the rest of the console, without a timestamp or level
+LOG_FORMAT = "%(message)s"
+LOGGING = {"listener": None, "records": None}
+
+# Every message is a frame: opcode, status, flags, request id and payload length, in network byte order
+FRAME_HEADER = struct.Struct("!BBHIQ")
+OP_HELLO = 1
+OP_STOR = 2
+OP_RETR = 3
+OP_LIST = 4
+OP_DEL = 5
+OP_QUIT = 6
+OP_REST = 7
+OP_SIZE = 8
+OP_HASH = 9
+OP_GET = 10
+OP_PUT = 11
+OP_COMMIT = 12
+OP_DATA = 13
+OP_LINK = 14
+OP_SIGS = 15
+OP_DELTA = 16
+OP_TREE = 17
+OP_STAT = 18
+OP_PUTDIR = 19
+OP_GETDIR = 20
+# Status of a response frame; requests carry STATUS_OK, except the last DATA frame of a directory upload that
+# could not be finished
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_ERROR = 2
+STATUS_BAD_REQUEST = 3
+# Frame flags
+FLAG_MORE = 0x0001                      # more frames for the same request follow this one
+FLAG_CHUNKED = 0x0002                   # STOR or RETR whose content follows as DATA frames instead of in the payload
+FLAG_TRAILER = 0x0004                   # RETR without a root, hashed as it is sent: a HASH frame follows the content
+CODEC_SHIFT = 8                         # DATA frames carry the codec of their chunk in bits 8 to 11
+CODEC_MASK = 0x0F00
+# Payload layouts
+HELLO_PAYLOAD = struct.Struct("!IH")    # buffer size, bit mask of the codecs the server can decode and encode
+CLIENT_HELLO = struct.Struct("!B")      # codec the client wants its downloads compressed with
+CHUNK_HEADER = struct.Struct("!I")      # size of the chunk once decoded, followed by the encoded chunk
+STOR_REQUEST = struct.Struct("!QH")     # offset, file name length, followed by the name and the content from the offset
+STOR_RESPONSE = struct.Struct("!dQ32s") # seconds elapsed, bytes stored, Merkle root of the stored file
+DEL_RESPONSE = struct.Struct("!d")      # seconds elapsed
+RETR_REQUEST = struct.Struct("!Q32s")   # offset, overlap digest of the client's copy, followed by the file name
+RETR_RESPONSE = struct.Struct("!Q32s")  # offset the content starts at, Merkle root if known (zeros if not), then the content
+REST_RESPONSE = struct.Struct("!Q32s")  # bytes of the partial upload, its overlap digest
+SIZE_RESPONSE = struct.Struct("!Q")     # file size
+HASH_RESPONSE = struct.Struct("!32s")   # Merkle root of the whole file
+TREE_RESPONSE = struct.Struct("!QI")    # file size, chunk size, followed by the SHA-256 of every chunk
+RANGE_REQUEST = struct.Struct("!QQ")    # offset, length, followed by the file name
+PUT_REQUEST = struct.Struct("!QH")      # offset, file name length, followed by the name and the segment content
+COMMIT_REQUEST = struct.Struct("!Q32s") # file size, Merkle root of the whole file, followed by the file name
+LINK_REQUEST = struct.Struct("!Q32s")   # file size, Merkle root of the content, followed by the file name to create
+SIGS_REQUEST = struct.Struct("!I")      # block size (0 lets the server choose), followed by the file name
+SIGNATURE = struct.Struct("!I16s")      # adler32 and BLAKE2b-128 of one block
+SIGS_SUMMARY = struct.Struct("!QI")     # file size, block size
+DELTA_COPY = struct.Struct("!BQQ")      # DELTA_KIND_COPY, offset in the server's copy, length
+DELTA_LITERAL = struct.Struct("!B")     # DELTA_KIND_LITERAL, followed by the bytes
+DELTA_END = struct.Struct("!B32s")      # DELTA_KIND_END, Merkle root of the whole new file
+DELTA_RESPONSE = struct.Struct("!dQQ")  # seconds elapsed, bytes stored, bytes sent as literals
+LIST_ENTRY = struct.Struct("!QH")       # file size, file name length, followed by the name
+LIST_REQUEST = struct.Struct("!BIQ")    # options, page size, entry limit, followed by the cursor name
+LIST_SUMMARY = struct.Struct("!QQ")     # entries listed, their total size, followed by the next cursor
+DIR_SUMMARY = struct.Struct("!dQQ")     # seconds elapsed, files in the archive, bytes of their content
+# LIST options
+LIST_SORTED = 0x01
+# Instructions of a delta upload, one per DATA frame
+DELTA_KIND_COPY = 1
+DELTA_KIND_LITERAL = 2
+DELTA_KIND_END = 3
+# Bulk commands and the transfer each matching file gets; the transfers go out back to back as one pipeline
+BULK_COMMANDS = {"MSTOR": "STOR", "MRETR": "RETR"}
+# Options of a plain STOR or RETR, as the transfers of bulk commands are sent
+TRANSFER_DEFAULTS = {"resume": False, "streams": None, "delta": False}
+# Downloads are written under this suffix and renamed into place once complete; a dropped download keeps it to resume
+PARTIAL_SUFFIX = ".ftp-part"
+# Journal of an unfinished transfer: the digest of every chunk finished so far, so a resumed download or upload hashes
+# none of them again. It starts with the size and mtime (ns) of the file it describes, zeros for a partial download,
+# whose own length tells how many of the digests still hold
+TREE_SUFFIX = ".ftp-tree"
+TREE_JOURNAL_HEADER = struct.Struct("!QQ")
+PARTIAL_IDENTITY = (0, 0)
+# Directory downloads unpack into name + PARTIAL_SUFFIX and only then take the place of the old tree, which is
+# moved aside under this suffix and removed
+REPLACED_SUFFIX = ".ftp-old"
+# Unpacking refuses links, devices and paths outside the target; Pythons with extraction filters check it again
+EXTRACT_OPTIONS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+# A transfer resumes only if the last bytes before the offset hash the same on both sides
+RESUME_CHECK_SIZE = 1024 * 1024
+# Segmented downloads fill this file range by range, in any order, until the whole file hash is checked
+SEGMENTS_SUFFIX = ".ftp-seg"
+# Bytes read at a time when hashing a whole file
+HASH_BLOCK_SIZE = 1024 * 1024
+# Uploads that are hashed while sendfile sends them go out in ranges of this size, each hashed while the next is sent
+SENDFILE_RANGE_SIZE = 8 * 1024 * 1024
+# Files are hashed as a Merkle tree: SHA-256 of every chunk of this size, paired up level by level into one root,
+# so a transfer can check and repair each chunk on its own
+MERKLE_CHUNK_SIZE = 1024 * 1024
+# Times one chunk of a segmented transfer is sent again after failing its check before the transfer gives up
+CHUNK_RETRIES = 3
+# Delta uploads read the local file in pieces of this size and send literals of at most DELTA_LITERAL_SIZE bytes
+DELTA_READ_SIZE = 4 * 1024 * 1024
+DELTA_LITERAL_SIZE = 1024 * 1024
+# The byte-by-byte search for shifted blocks is the slow part of a delta; after this many searches in a row
+# found nothing, only one block in DELTA_SEARCH_INTERVAL is searched until a block matches again
+DELTA_SEARCH_MISSES = 8
+DELTA_SEARCH_INTERVAL = 64
+# Uploads smaller than this are sent right away; hashing them and asking the server first would not save anything
+DEDUP_MIN_SIZE = 64 * 1024
+# Segmented transfers hand out ranges of this size to their streams, one at a time
+SEGMENT_SIZE = 32 * 1024 * 1024
+# Requests each stream keeps outstanding, so it does not idle for a round trip between two ranges
+SEGMENTS_IN_FLIGHT = 2
+MAX_STREAMS = 16
+# Without a stream count, transfers start with AUTO_STREAMS and double them every TUNE_INTERVAL seconds
+# for as long as that raises the throughput by TUNE_GAIN
+AUTO_STREAMS = 2
+TUNE_INTERVAL = 1.0
+TUNE_GAIN = 1.1
+# Chunk codecs; every chunk is compressed on its own, so a chunk that does not shrink can go raw
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_BZ2 = 3
+# Name, compress function and decompressor factory of every codec this Python can use
+CODECS = {CODEC_ZLIB: ("zlib", functools.partial(zlib.compress, level=6), zlib.decompressobj),
+          CODEC_BZ2: ("bz2", bz2.compress, bz2.BZ2Decompressor)}
+if lzma is not None:
+    CODECS[CODEC_LZMA] = ("lzma", functools.partial(lzma.compress, preset=2), lzma.LZMADecompressor)
+# Raw bytes per compressed chunk, and the largest chunk accepted from the server
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Content is compressed only if a sample of this size from the transfer offset shrinks below COMPRESSIBLE_RATIO
+COMPRESSION_SAMPLE_SIZE = 256 * 1024
+COMPRESSIBLE_RATIO = 0.9
+# After this many chunks in a row that did not shrink, the rest of the transfer goes raw
+INCOMPRESSIBLE_CHUNKS = 4
+# Formats that are compressed already and never worth a sample
+COMPRESSED_EXTENSIONS = {".gz", ".tgz", ".bz2", ".xz", ".lz", ".lzma", ".zst", ".zip", ".7z", ".rar", ".jpg", ".jpeg",
+                         ".png", ".gif", ".webp", ".heic", ".mp3", ".mp4", ".m4a", ".mkv", ".avi", ".mov", ".webm",
+                         ".ogg", ".flac", ".pdf", ".docx", ".xlsx", ".pptx", ".jar", ".apk", ".whl"}
+
+def configure_logging(quiet_mode):
+    # Transfer threads only put records on a queue; records below the level are dropped before they are built
+    LOGGING["records"] = queue.Queue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    LOG.handlers = [logging.handlers.QueueHandler(LOGGING["records"])]
+    LOG.setLevel(LOG_LEVELS.get(quiet_mode, logging.INFO))
+    LOG.propagate = False
+    LOGGING["listener"] = logging.handlers.QueueListener(LOGGING["records"], handler)
+    LOGGING["listener"].start()
+    return
+
+def flush_log():
+    # Wait until every queued record is written, so results never show up after the next prompt;
+    # loaded as a library there is no queue
+    if LOGGING["records"] is not None:
+        LOGGING["records"].join()
+    return
+
 def correct_usage_parameters_message():
-    if len(argv) != 4:
-        print("Usage: python3 client.py <IP> <PORT> [-q <quiet_mode> -n <not_quiet_mode>]")
+    if len(argv) < 4:
+        print("Usage: python3 client.py <IP> <PORT> [-q <quiet_mode> -n <not_quiet_mode>] [--compress zlib|lzma|bz2] "
+              "[--dedup on|off]")
         exit(1)
 
+def parse_optional_arguments(arguments):
+    # Options that may follow the positional parameters, with their default values
+    options = {"--compress": "none", "--dedup": "on"}
+    index = 0
+    while index < len(arguments):
+        option = arguments[index]
+        if option not in options or index + 1 >= len(arguments):
+            raise NameError(f"unknown or incomplete option '{option}'")
+        options[option] = arguments[index + 1]
+        index += 2
+    codec_names = {name: codec for codec, (name, _, _) in CODECS.items()}
+    codec_names["none"] = CODEC_NONE
+    if options["--compress"] not in codec_names:
+        raise NameError(f"unknown codec '{options['--compress']}', choose from {', '.join(sorted(codec_names))}")
+    options["--compress"] = codec_names[options["--compress"]]
+    if options["--dedup"] not in ("on", "off"):
+        raise NameError(f"--dedup takes on or off, not '{options['--dedup']}'")
+    options["--dedup"] = options["--dedup"] == "on"
+    return options
+
 def create_socket_connection():
     try:
         # Set up server parameters
         TCP_IP = argv[1]
         TCP_PORT = int(argv[2])
         QUIET_MODE = argv[3]
+        OPTIONS = parse_optional_arguments(argv[4:])
 
-        # Create a socket to listen for incoming connections
-        soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Allow the socket to reuse the address in case it is in TIME_WAIT state
-        soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # Set a timeout of 10 seconds for blocking socket operations to avoid indefinite waiting
-        soc.settimeout(10)
-
-        # Connect to the server
-        soc.connect((TCP_IP, TCP_PORT))
+        # Connect to the server and get the buffer size from its greeting
+        soc, buffer_size, server_codecs = open_session((TCP_IP, TCP_PORT))
         print("Connection successful!")
 
-        # Get buffer size from server
-        buffer_size = struct.unpack("i", soc.recv(4))[0]
+        # Answer the greeting with the codec for our transfers, if the server knows it
+        codec = OPTIONS["--compress"]
+        if codec != CODEC_NONE and not server_codecs & (1 << codec):
+            print(f"The server does not support {CODECS[codec][0]}, transfers stay uncompressed.")
+            OPTIONS["--compress"] = codec = CODEC_NONE
+        send_frame(soc, OP_HELLO, 0, [CLIENT_HELLO.pack(codec)])
 
     except socket.error as e:
         print(f"Connection unsuccessful. Error: {e}")
@@ -48,320 +240,1541 @@ def create_socket_connection():
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         exit(1)
-    return soc, buffer_size, QUIET_MODE
+    return soc, buffer_size, QUIET_MODE, OPTIONS
 
-def store_file_to_server(soc, buffer_size, command, file_name, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
+def open_session(address):
+    # Create a socket to talk to the server
+    soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Allow the socket to reuse the address in case it is in TIME_WAIT state
+    soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Set a timeout of 10 seconds for blocking socket operations to avoid indefinite waiting
+    soc.settimeout(10)
+    # Requests go out as soon as they are complete; headers in front of file data are corked instead
+    soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        soc.connect(address)
 
-    # Upload a file
-    print(f"\nUploading file: {file_name}")
+        # The server greets every session with its buffer size and the codecs it supports
+        opcode, _, _, _, payload_length = recv_frame(soc)
+        if opcode != OP_HELLO:
+            raise struct.error("the server did not greet with HELLO")
+        buffer_size, server_codecs = HELLO_PAYLOAD.unpack(recv_exact(soc, payload_length))
+    except Exception:
+        soc.close()
+        raise
+    return soc, buffer_size, server_codecs
 
-    try:
-        # Check if the file exists
-        content = open(file_name, "rb")
+def recv_exact(soc, size):
+    # Keep reading until exactly size bytes arrived; a short read is not an error in TCP
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = soc.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Connection closed by server.")
+        received += count
+    return bytes(data)
 
-        # Make upload request
-        soc.send(command.encode('utf-8'))
+def recv_frame(soc):
+    # Returns (opcode, status, flags, request_id, payload_length)
+    return FRAME_HEADER.unpack(recv_exact(soc, FRAME_HEADER.size))
 
-        # Wait for server acknowledgement then send file details, Wait for server ok
-        soc.recv(buffer_size)
+def send_frame(soc, opcode, request_id, parts=(), data_length=0, flags=0, status=STATUS_OK):
+    # Scatter-gather: header and payload pieces leave in one sendmsg call instead of one send per piece;
+    # data_length counts bytes the caller streams right after, such as a file sent with sendfile
+    parts = [part for part in parts if part]
+    header = FRAME_HEADER.pack(opcode, status, flags, request_id, sum(len(part) for part in parts) + data_length)
+    buffers = [header] + parts
+    if hasattr(soc, "sendmsg"):
+        sent = soc.sendmsg(buffers)
+    else:
+        sent = 0
+    # Whatever the kernel did not take in one go is sent piece by piece
+    for buffer in buffers:
+        if sent >= len(buffer):
+            sent -= len(buffer)
+            continue
+        soc.sendall(memoryview(buffer)[sent:])
+        sent = 0
+    return
 
-        # Send file name and size
-        soc.send(struct.pack("h", len(file_name)))
-        soc.send(file_name.encode())
+def send_file_exactly(soc, content, offset, count):
+    # The frame header already announced count bytes: a file that shrank would leave the frame short and the
+    # stream out of step, so the caller has to drop the connection
+    if soc.sendfile(content, offset, count) != count:
+        raise OSError("file shrank while being sent")
+    return
 
-        # Wait for server ok then send file size
-        soc.recv(buffer_size)
-        soc.send(struct.pack("i", os.path.getsize(file_name)))
+def send_frame_with_file(soc, opcode, request_id, parts, content, offset, count, tree=None):
+    # Corked, the frame header leaves in the same segment as the first file bytes (Linux only); sendfile falls
+    # back to sendall where unsupported, and stops short only at the end of the file. With a chunk tree, the file
+    # goes out range by range and a worker thread hashes each range just sent, from the page cache, while the next
+    # one is sent
+    corked = hasattr(socket, "TCP_CORK")
+    if corked:
+        soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    hasher = None
+    hashing = None
+    try:
+        send_frame(soc, opcode, request_id, parts, data_length=count)
+        if tree is None:
+            send_file_exactly(soc, content, offset, count)
+        else:
+            # One worker, so the ranges are hashed in order
+            hasher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            end = offset + count
+            while offset < end:
+                size = min(SENDFILE_RANGE_SIZE, end - offset)
+                send_file_exactly(soc, content, offset, size)
+                if hashing is not None:
+                    hashing.result()
+                hashing = hasher.submit(hash_range, content.fileno(), tree, offset, offset + size)
+                offset += size
+    finally:
+        # The last bytes leave before the last range is hashed
+        if corked:
+            soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        if hasher is not None:
+            hasher.shutdown()
+    if hashing is not None:
+        hashing.result()
+    return
 
-        # Send the file in chunks defined by BUFFER_SIZE
-        chunks = content.read(buffer_size)
-        print("Sending...\n")
-        while chunks:
-            soc.send(chunks)
-            chunks = content.read(buffer_size)
-        content.close()
+def write_all(output_file, view):
+    # Unbuffered file writes may be partial
+    while view:
+        written = output_file.write(view)
+        view = view[written:]
+    return
 
-        # Get upload performance details
-        upload_time = struct.unpack("f", soc.recv(4))[0]
-        upload_size = struct.unpack("i", soc.recv(4))[0]
-        print(f"\tSent file: {file_name}\n\nTime elapsed: {upload_time}s\nFile size: {upload_size} bytes")
+def preallocate_file(output_file, file_size):
+    # Reserve every block up front so the file is laid out in one piece instead of growing chunk by chunk
+    if file_size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(output_file.fileno(), 0, file_size)
+        except OSError:
+            # Not every file system supports it; the writes work without it
+            pass
+    return
 
-    except FileNotFoundError:
-        print("\nFile not found. Make sure the file name was entered correctly.")
-    except socket.error as e:
-        print(f"\nSocket error: {e}")
-    except struct.error as e:
-        print(f"\nStruct packing/unpacking error: {e}")
-    except OSError as e:
-        print(f"\nOS error: {e}")
-    except Exception as e:
-        print(f"\nAn unexpected error occurred: {e}")
-    finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+def overlap_digest(content, offset):
+    # sha256 of the RESUME_CHECK_SIZE bytes before offset
+    start = max(0, offset - RESUME_CHECK_SIZE)
+    return hashlib.sha256(os.pread(content.fileno(), offset - start, start)).digest()
+
+def create_chunk_tree():
+    # Chunk digests of a stream of bytes, filled in as the bytes go by
+    return {"leaves": [], "chunk": hashlib.sha256(), "filled": 0}
+
+def update_chunk_tree(tree, view):
+    view = memoryview(view)
+    while view:
+        size = min(len(view), MERKLE_CHUNK_SIZE - tree["filled"])
+        tree["chunk"].update(view[:size])
+        tree["filled"] += size
+        view = view[size:]
+        if tree["filled"] == MERKLE_CHUNK_SIZE:
+            tree["leaves"].append(tree["chunk"].digest())
+            if "journal" in tree:
+                tree["journal"].write(tree["leaves"][-1])
+            tree["chunk"] = hashlib.sha256()
+            tree["filled"] = 0
     return
 
-def list_files_from_server(soc, command, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
+def finish_chunk_tree(tree):
+    # All chunk digests, the last chunk possibly short; no bytes at all still make one chunk
+    if tree["filled"] or not tree["leaves"]:
+        tree["leaves"].append(tree["chunk"].digest())
+        tree["chunk"] = hashlib.sha256()
+        tree["filled"] = 0
+    return tree["leaves"]
+
+def merkle_root(leaves):
+    # Pairs of digests hash into their parent until one is left; an odd digest out moves up as it is
+    level = leaves
+    while len(level) > 1:
+        level = [hashlib.sha256(level[index] + level[index + 1]).digest() if index + 1 < len(level) else level[index]
+                 for index in range(0, len(level), 2)]
+    return level[0]
 
-    # List the files available on the file server side
-    print("\nFiles on server:\n")
+def hash_range(fd, tree, offset, end):
+    # Feed bytes offset to end of a file to a chunk tree, read into one reused buffer
+    view = memoryview(bytearray(HASH_BLOCK_SIZE))
+    while offset < end:
+        size = os.preadv(fd, [view[:min(HASH_BLOCK_SIZE, end - offset)]], offset)
+        if not size:
+            raise OSError("file shrank while it was being hashed")
+        update_chunk_tree(tree, view[:size])
+        offset += size
+    return tree
 
+def file_identity(fd):
+    stat = os.fstat(fd)
+    return stat.st_size, stat.st_mtime_ns
+
+def load_tree_journal(journal_name, identity=PARTIAL_IDENTITY):
+    # The digests a journal holds, none if there is no journal or it describes another version of the file
     try:
-        # Send list request
-        soc.send(command.encode('utf-8'))
-    except socket.error:
-        print("\nCouldn't make server request. Make sure a connection has been established.")
-        return
-    except Exception as e:
-        print(f"\nUnexpected error during server request: {e}")
-        return
-    
+        with open(journal_name, "rb") as journal:
+            data = journal.read()
+    except FileNotFoundError:
+        return []
+    if len(data) < TREE_JOURNAL_HEADER.size or TREE_JOURNAL_HEADER.unpack_from(data) != tuple(identity):
+        return []
+    # A digest cut short by a crash is dropped with the rest of its chunk
+    end = len(data) - (len(data) - TREE_JOURNAL_HEADER.size) % 32
+    return [data[start:start + 32] for start in range(TREE_JOURNAL_HEADER.size, end, 32)]
+
+def resume_chunk_tree(fd, offset, journal_name, identity=PARTIAL_IDENTITY):
+    # Chunk tree of the first offset bytes of a file, from the digests its journal kept; only the chunks the journal
+    # misses are read, normally just the last, unfinished one. With a journal name, the journal is rewritten to
+    # match and records every chunk finished from here on
+    tree = create_chunk_tree()
+    if journal_name is not None:
+        tree["leaves"] = load_tree_journal(journal_name, identity)[:offset // MERKLE_CHUNK_SIZE]
+    hash_range(fd, tree, len(tree["leaves"]) * MERKLE_CHUNK_SIZE, offset)
+    if journal_name is not None:
+        journal = open(journal_name, "wb", buffering=0)
+        journal.write(TREE_JOURNAL_HEADER.pack(*identity) + b"".join(tree["leaves"]))
+        tree["journal"] = journal
+    return tree
+
+def close_tree_journal(tree):
+    # The journal stays for a resumed transfer until the caller removes it
+    journal = tree.pop("journal", None)
+    if journal is not None:
+        journal.close()
+    return
+
+def remove_if_exists(path):
     try:
-        # First get the number of files in the directory
-        number_of_files = struct.unpack("i", soc.recv(4))[0]
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return
+
+def parse_tree(payload):
+    # File size and chunk digests of a TREE response
+    file_size, chunk_size = TREE_RESPONSE.unpack_from(payload)
+    if chunk_size != MERKLE_CHUNK_SIZE or (len(payload) - TREE_RESPONSE.size) % 32:
+        raise struct.error(f"unexpected chunk tree (chunk size {chunk_size})")
+    return file_size, [payload[start:start + 32] for start in range(TREE_RESPONSE.size, len(payload), 32)]
 
-        # Then enter into a loop to receive details of each, one by one
-        for _ in range(int(number_of_files)):
-            # Get the file name and size first to slightly lessen amount transferred over socket
-            file_name_size = struct.unpack("i", soc.recv(4))[0]
-            file_name = soc.recv(file_name_size).decode()
+def query_tree(soc, request_id, file_name):
+    # Chunk digests of the server's copy as (file size, leaves), or None if it has none
+    send_frame(soc, OP_TREE, request_id, [file_name.encode('utf-8')])
+    _, status, _, _, payload_length = recv_frame(soc)
+    payload = recv_exact(soc, payload_length)
+    if status != STATUS_OK:
+        return None
+    return parse_tree(payload)
 
-            # Also get the file size for each item in the server
-            file_size = struct.unpack("i", soc.recv(4))[0]
-            print(f"\t{file_name} - {file_size} bytes")
+def discard_payload(soc, size):
+    # Skip a payload we cannot use so the next frame is still found at the right place
+    while size > 0:
+        size -= len(recv_exact(soc, min(size, 65536)))
+    return
 
-            # Make sure that the client and server are synchronized
-            soc.send("1".encode())
+def fail_request(request, message, level=logging.ERROR):
+    # The reason a command failed goes to the log and stays on its request, for callers that want more than the log
+    request["error"] = message.strip()
+    LOG.log(level, message)
+    return
 
-        # Get total size of directory
-        total_directory_size = struct.unpack("i", soc.recv(4))[0]
+def worth_compressing(content, file_name, offset, codec):
+    # Skip formats that are compressed already, then try a sample
+    if codec == CODEC_NONE or os.path.splitext(file_name)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    sample = os.pread(content.fileno(), COMPRESSION_SAMPLE_SIZE, offset)
+    return len(sample) > 0 and len(CODECS[codec][1](sample)) < len(sample) * COMPRESSIBLE_RATIO
 
-        # Get total number of files in the directory
-        count_files = struct.unpack("i", soc.recv(4))[0]
+def create_compression_totals(codec):
+    # Raw and wire bytes of one transfer, and the CPU seconds spent compressing or decompressing them
+    return {"codec": codec, "raw": 0, "wire": 0, "cpu": 0.0, "incompressible": 0}
 
-        print(f"\nTotal directory size: {total_directory_size} bytes\nTotal number of files: {count_files}")
-    except struct.error:
-        print("\nError unpacking struct data. Data may be corrupted or incomplete.")
-        return
-    except socket.error:
-        print("\nSocket error occurred while receiving file list.")
-        return
-    except UnicodeDecodeError:
-        print("\nError decoding file name. Data encoding may not match.")
+def format_compression_totals(totals):
+    ratio = totals["raw"] / totals["wire"] if totals["wire"] else 1.0
+    return (f"Compression: {CODECS[totals['codec']][0]}, {totals['raw']} -> {totals['wire']} bytes "
+            f"({ratio:.2f}x), {totals['cpu']:.3f}s CPU")
+
+def encode_chunk(chunk, totals):
+    # The codec of a chunk and the bytes to send, compressed if that shrinks them
+    if totals["codec"] == CODEC_NONE or totals["incompressible"] >= INCOMPRESSIBLE_CHUNKS:
+        return CODEC_NONE, chunk
+    start_cpu = time.thread_time()
+    compressed = CODECS[totals["codec"]][1](chunk)
+    totals["cpu"] += time.thread_time() - start_cpu
+    if len(compressed) < len(chunk):
+        totals["incompressible"] = 0
+        return totals["codec"], compressed
+    totals["incompressible"] += 1
+    return CODEC_NONE, chunk
+
+def send_file_chunks(soc, request_id, content, offset, count, totals, tree):
+    # Every chunk is compressed on its own and sent as one DATA frame; chunks that do not shrink go raw
+    end = offset + count
+    if count == 0:
+        send_frame(soc, OP_DATA, request_id, [CHUNK_HEADER.pack(0)])
         return
-    except Exception as e:
-        print(f"\nAn unexpected error occurred: {e}")
+    while offset < end:
+        chunk = os.pread(content.fileno(), min(COMPRESSION_CHUNK_SIZE, end - offset), offset)
+        if not chunk:
+            raise OSError(f"{content.name} shrank while it was being sent")
+        update_chunk_tree(tree, chunk)
+        offset += len(chunk)
+        codec, data = encode_chunk(chunk, totals)
+        flags = (codec << CODEC_SHIFT) | (FLAG_MORE if offset < end else 0)
+        send_frame(soc, OP_DATA, request_id, [CHUNK_HEADER.pack(len(chunk)), data], flags=flags)
+        totals["raw"] += len(chunk)
+        totals["wire"] += CHUNK_HEADER.size + len(data)
+    return
+
+def recv_chunk(soc, request, totals):
+    # One DATA frame of the request, decoded, and its flags
+    opcode, _, flags, request_id, payload_length = recv_frame(soc)
+    if opcode != OP_DATA or request_id != request["request_id"] or \
+            not CHUNK_HEADER.size <= payload_length <= CHUNK_HEADER.size + MAX_CHUNK_SIZE:
+        raise ConnectionError(f"malformed DATA frame for request {request['request_id']}")
+    raw_size = CHUNK_HEADER.unpack(recv_exact(soc, CHUNK_HEADER.size))[0]
+    data = recv_exact(soc, payload_length - CHUNK_HEADER.size)
+    codec = (flags & CODEC_MASK) >> CODEC_SHIFT
+    if codec != CODEC_NONE:
+        if codec not in CODECS or raw_size > MAX_CHUNK_SIZE:
+            raise ConnectionError(f"undecodable chunk for request {request['request_id']}")
+        start_cpu = time.thread_time()
+        # The decompressor stops one byte past the announced size, so a chunk can never expand beyond it
+        data = CODECS[codec][2]().decompress(data, raw_size + 1)
+        totals["cpu"] += time.thread_time() - start_cpu
+        totals["codec"] = codec
+    if len(data) != raw_size:
+        raise ConnectionError(f"chunk for request {request['request_id']} does not match its size")
+    totals["raw"] += raw_size
+    totals["wire"] += payload_length
+    return data, flags
+
+def recv_chunks_into_file(soc, request, output_file, totals, tree):
+    # Content sent as DATA frames until one without FLAG_MORE; each chunk decodes on its own
+    while True:
+        data, flags = recv_chunk(soc, request, totals)
+        update_chunk_tree(tree, data)
+        write_all(output_file, data)
+        if not flags & FLAG_MORE:
+            return
+
+def query_partial_upload(soc, request):
+    # Ask how much of an interrupted upload the server kept; the answer is needed before the upload starts
+    send_frame(soc, OP_REST, request["request_id"], [request["file_name"].encode('utf-8')])
+    _, status, _, request_id, payload_length = recv_frame(soc)
+    if request_id != request["request_id"]:
+        raise ConnectionError(f"response {request_id} does not match request {request['request_id']}")
+    payload = recv_exact(soc, payload_length)
+    if status == STATUS_OK:
+        request["server_offset"], request["server_digest"] = REST_RESPONSE.unpack(payload)
+    return
+
+def link_known_uploads(soc, requests):
+    # Offer the hash of every upload before any data moves; content the server already holds under some name
+    # is linked there, and only the uploads it answers NOT_FOUND for go through the pipeline
+    offers = []
+    for request in requests:
+        if not request.get("dedup") or request.get("resume"):
+            continue
+        try:
+            file_size = os.path.getsize(request["file_name"])
+            if file_size < DEDUP_MIN_SIZE:
+                continue
+            request["leaves"] = hash_file(request["file_name"])
+        except OSError:
+            # The upload itself reports the problem
+            continue
+        meta = LINK_REQUEST.pack(file_size, merkle_root(request["leaves"]))
+        send_frame(soc, OP_LINK, request["request_id"], [meta, request["file_name"].encode('utf-8')])
+        offers.append(request)
+
+    linked = set()
+    for request in offers:
+        _, status, _, request_id, payload_length = recv_frame(soc)
+        if request_id != request["request_id"]:
+            raise ConnectionError(f"response {request_id} does not match request {request['request_id']}")
+        payload = recv_exact(soc, payload_length)
+        if status != STATUS_OK:
+            continue
+        link_time, file_size, _ = STOR_RESPONSE.unpack(payload)
+        LOG.info(f"\n{request['command']} {request['file_name']}")
+        LOG.info(f"\tServer already holds this content, linked {request['file_name']} without sending it"
+                 f"\n\nTime elapsed: {link_time}s\nFile size: {file_size} bytes")
+        request["result"] = {"size": file_size, "elapsed": link_time, "linked": True}
+        linked.add(request["request_id"])
+    return [request for request in requests if request["request_id"] not in linked]
+
+def store_file_to_server(soc, buffer_size, request):
+    # Upload a file
+    file_name = request["file_name"]
+    encoded_name = file_name.encode('utf-8')
+    with open(file_name, "rb") as content:
+        file_size = os.fstat(content.fileno()).st_size
+        # Continue after the bytes the server kept, but only if they end the same way as the local file
+        offset = request.get("server_offset", 0)
+        if not 0 < offset <= file_size or overlap_digest(content, offset) != request["server_digest"]:
+            offset = 0
+        meta = STOR_REQUEST.pack(offset, len(encoded_name))
+        # Chunk digests of the whole file are taken from the bytes as they are sent, so the server's root can be
+        # checked without reading the file again. Uploads of more than one chunk journal them, so a resumed upload
+        # takes the digests of the part it skips from the journal instead of reading it
+        journal_name = file_name + TREE_SUFFIX if file_size > MERKLE_CHUNK_SIZE and "leaves" not in request else None
+        tree = resume_chunk_tree(content.fileno(), offset, journal_name, file_identity(content.fileno()))
+        try:
+            if worth_compressing(content, file_name, offset, request["codec"]):
+                # Compressible content follows the header as DATA frames, one compressed chunk each
+                send_frame(soc, OP_STOR, request["request_id"], [meta, encoded_name], flags=FLAG_CHUNKED)
+                request["compression"] = create_compression_totals(request["codec"])
+                send_file_chunks(soc, request["request_id"], content, offset, file_size - offset,
+                                 request["compression"], tree)
+            elif file_size - offset <= buffer_size:
+                # Small file: header, name and content leave in a single sendmsg call
+                content.seek(offset)
+                data = content.read()
+                update_chunk_tree(tree, data)
+                send_frame(soc, OP_STOR, request["request_id"], [meta, encoded_name, data])
+            else:
+                # Large file: the frame header goes first, then the content with zero-copy sendfile. The bytes never
+                # pass through here: use the digests of the deduplication offer, or hash each range once it is sent
+                send_frame_with_file(soc, OP_STOR, request["request_id"], [meta, encoded_name], content, offset,
+                                     file_size - offset, None if "leaves" in request else tree)
+        finally:
+            close_tree_journal(tree)
+        request.setdefault("leaves", finish_chunk_tree(tree))
+    request["file_size"] = file_size
+    request["offset"] = offset
+    return
+
+def receive_store_response(soc, buffer_size, request, status, flags, payload_length):
+    # The server kept no partial upload either way
+    remove_if_exists(request["file_name"] + TREE_SUFFIX)
+    if status != STATUS_OK:
+        discard_payload(soc, payload_length)
+        fail_request(request, f"\nServer could not store {request['file_name']} (status {status}).")
         return
-    
+    # Get upload performance details
+    upload_time, upload_size, root = STOR_RESPONSE.unpack(recv_exact(soc, payload_length))
+    if request["offset"]:
+        LOG.info(f"\tResumed upload from byte {request['offset']}")
+    LOG.info(f"\tSent file: {request['file_name']}\n\nTime elapsed: {upload_time}s\nFile size: {upload_size} bytes")
+    if "compression" in request:
+        LOG.info(format_compression_totals(request["compression"]))
+    repaired = 0
+    if root != merkle_root(request["leaves"]):
+        repaired = repair_upload(soc, request)
+        if repaired is None:
+            return
+    request["result"] = {"size": upload_size, "elapsed": upload_time, "offset": request["offset"],
+                         "root": merkle_root(request["leaves"]).hex(), "repaired_bytes": repaired}
+    return
+
+def repair_upload(soc, request):
+    # The server stored something else than we sent: on a session of its own, compare the chunk digests of its
+    # copy with ours and send only the chunks that differ, as a delta the server rebuilds the file from.
+    # Returns the bytes sent again, or None if the stored copy is still wrong
+    file_name = request["file_name"]
+    leaves = request["leaves"]
+    try:
+        session = open_session(soc.getpeername())[0]
+    except(socket.error, OSError, struct.error) as e:
+        fail_request(request, f"\nStored {file_name} does not match the local file and could not be repaired: {e}")
+        return None
     try:
-        # Final check
-        soc.send("1".encode())
-    except(socket.error, Exception):
-        print("\nCouldn't get final server confirmation")
+        server_size, server_leaves = query_tree(session, request["request_id"], file_name) or (0, [])
+        send_frame(session, OP_DELTA, request["request_id"], [file_name.encode('utf-8')], flags=FLAG_CHUNKED)
+        delta = {"request_id": request["request_id"], "copy_offset": 0, "copy_length": 0, "literal": 0}
+        with open(file_name, "rb") as content:
+            for index, leaf in enumerate(leaves):
+                offset = index * MERKLE_CHUNK_SIZE
+                length = min(MERKLE_CHUNK_SIZE, request["file_size"] - offset)
+                if index < len(server_leaves) and server_leaves[index] == leaf and offset + length <= server_size:
+                    send_delta_copy(session, delta, offset, length)
+                else:
+                    send_delta_literal(session, delta, os.pread(content.fileno(), length, offset))
+        flush_delta_copy(session, delta)
+        send_frame(session, OP_DATA, request["request_id"], [DELTA_END.pack(DELTA_KIND_END, merkle_root(leaves))])
+        _, status, _, _, payload_length = recv_frame(session)
+        discard_payload(session, payload_length)
+    except(socket.error, OSError, struct.error) as e:
+        fail_request(request, f"\nStored {file_name} does not match the local file and could not be repaired: {e}")
+        return None
     finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        session.close()
+    if status != STATUS_OK:
+        fail_request(request, f"\nStored {file_name} does not match the local file; repair failed (status {status}).")
+        return None
+    LOG.info(f"\tStored copy did not match, resent {delta['literal']} bytes of chunks that differed; verified")
+    return delta["literal"]
+
+def list_files_from_server(soc, buffer_size, request):
+    # Send list request: options, page size, entry limit and the name to continue after
+    options = LIST_SORTED if request["sorted"] else 0
+    meta = LIST_REQUEST.pack(options, request["page_size"], request["limit"])
+    send_frame(soc, OP_LIST, request["request_id"], [meta, request["cursor"].encode('utf-8')])
     return
 
-def retrieve_file_from_server(soc, buffer_size, command, file_name, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
+def parse_list_page(payload):
+    # The (name, size) pairs of one page of a listing
+    entries = []
+    offset = 0
+    while offset < len(payload):
+        file_size, file_name_size = LIST_ENTRY.unpack_from(payload, offset)
+        offset += LIST_ENTRY.size
+        entries.append((payload[offset:offset + file_name_size].decode('utf-8', 'replace'), file_size))
+        offset += file_name_size
+    return entries
 
-    # Download given file
-    print(f"Downloading file: {file_name}")
-    
-    try:
-        # Send request to server
-        soc.send(command.encode('utf-8'))
-
-        # Wait for server ok, send file name length then name
-        soc.recv(buffer_size)
-        soc.send(struct.pack("h", len(file_name)))
-        soc.send(file_name.encode())
-
-        # Get file size (if exists)
-        file_size = struct.unpack("i", soc.recv(4))[0]
-        if file_size == -1:
-            # If file size is -1, the file does not exist
-            print("File does not exist. Make sure the name was entered correctly")
-            return
-    except struct.error:
-        print("Error unpacking struct data. Possible data corruption.")
+def print_list_page(payload, entries=None):
+    # Callers that want the listing itself pass a list to collect the (name, size) pairs in
+    for file_name, file_size in parse_list_page(payload):
+        LOG.info("\t%s - %s bytes", file_name, file_size)
+        if entries is not None:
+            entries.append((file_name, file_size))
+    return
+
+def receive_list_response(soc, buffer_size, request, status, flags, payload_length):
+    # The listing arrives as page frames flagged FLAG_MORE, each printed as soon as it is read,
+    # followed by one summary frame
+    LOG.info("\nFiles on server:\n")
+    while flags & FLAG_MORE:
+        print_list_page(recv_exact(soc, payload_length), request.get("entries"))
+        _, status, flags, request_id, payload_length = recv_frame(soc)
+        if request_id != request["request_id"]:
+            raise ConnectionError(f"response {request_id} does not match request {request['request_id']}")
+
+    payload = recv_exact(soc, payload_length)
+    if status != STATUS_OK:
+        fail_request(request, f"\nServer could not list its files (status {status}).")
         return
-    except socket.error:
-        print("Socket error while verifying file.")
+    count_files, total_directory_size = LIST_SUMMARY.unpack_from(payload)
+    LOG.info(f"\nTotal directory size: {total_directory_size} bytes\nTotal number of files: {count_files}")
+    next_cursor = payload[LIST_SUMMARY.size:].decode('utf-8', 'replace')
+    if next_cursor:
+        LOG.info(f"More files follow; continue with: LIST -a {next_cursor}")
+    request["result"] = {"count": count_files, "total_size": total_directory_size, "next_cursor": next_cursor,
+                         "entries": request.get("entries")}
+    return
+
+def retrieve_file_from_server(soc, buffer_size, request):
+    # A partial download left by a dropped connection is offered for resuming, with the digest of its last bytes
+    offset = 0
+    digest = bytes(32)
+    try:
+        with open(request["file_name"] + PARTIAL_SUFFIX, "rb") as partial:
+            offset = os.fstat(partial.fileno()).st_size
+            if offset:
+                digest = overlap_digest(partial, offset)
+    except FileNotFoundError:
+        pass
+
+    # Send request to server
+    meta = RETR_REQUEST.pack(offset, digest)
+    send_frame(soc, OP_RETR, request["request_id"], [meta, request["file_name"].encode('utf-8')])
+    request["offset"] = offset
+    return
+
+def receive_retrieve_response(soc, buffer_size, request, status, flags, payload_length):
+    file_name = request["file_name"]
+    if status == STATUS_NOT_FOUND:
+        # The file does not exist
+        discard_payload(soc, payload_length)
+        fail_request(request, "File does not exist. Make sure the name was entered correctly", logging.WARNING)
         return
-    except Exception as e:
-        print(f"Unexpected error while checking file: {e}")
+    if status != STATUS_OK:
+        discard_payload(soc, payload_length)
+        fail_request(request, f"\nServer could not send {file_name} (status {status}).")
         return
 
-    try:
-        # Send ok to receive file content
-        soc.send("1".encode())
+    # The server continues from the offset we hold, or from zero when our copy did not match
+    offset, root = RETR_RESPONSE.unpack(recv_exact(soc, RETR_RESPONSE.size))
+    remaining = payload_length - RETR_RESPONSE.size
+    if request["offset"] and not offset:
+        LOG.warning("\nThe partial download does not match the server's file, downloading from the start.")
 
-        # Enter loop to receive file
-        output_file = open(file_name, "wb")
+    # Unbuffered so received slices go straight to the kernel
+    partial_name = file_name + PARTIAL_SUFFIX
+    output_file = open(partial_name, "r+b" if offset else "wb", buffering=0)
+    totals = None
+    tree = None
+    try:
+        output_file.truncate(offset)
+        output_file.seek(offset)
+        # Chunk digests are taken as the bytes are written, after those of the part kept from before; downloads of
+        # more than one chunk journal them, so resuming does not read that part again
+        journaled = flags & FLAG_CHUNKED or offset + remaining > MERKLE_CHUNK_SIZE
+        tree = resume_chunk_tree(output_file.fileno(), offset, file_name + TREE_SUFFIX if journaled else None)
 
-        bytes_received = 0
+        LOG.info(f"\nDownloading{f' from byte {offset}' if offset else ''}...\n")
+        try:
+            if flags & FLAG_CHUNKED:
+                # The server compresses the content: it arrives as DATA frames and its size is only known at the end
+                totals = create_compression_totals(request["codec"])
+                recv_chunks_into_file(soc, request, output_file, totals, tree)
+                remaining = totals["raw"]
+            else:
+                preallocate_file(output_file, offset + remaining)
 
-        print("\nDownloading...\n")
-        # Receive file in chunks defined by BUFFER_SIZE
-        while bytes_received < file_size:
-            chunks = soc.recv(buffer_size)
-            output_file.write(chunks)
-            bytes_received += len(chunks)
+                # One buffer of BUFFER_SIZE reused for every chunk instead of a new bytes object each time
+                view = memoryview(bytearray(buffer_size))
+                bytes_received = 0
+                while bytes_received < remaining:
+                    size = soc.recv_into(view, min(buffer_size, remaining - bytes_received))
+                    if size == 0:
+                        raise ConnectionError("Connection closed by server.")
+                    update_chunk_tree(tree, view[:size])
+                    write_all(output_file, view[:size])
+                    bytes_received += size
+        except(OSError, KeyboardInterrupt):
+            # Keep exactly what reached the disk, not the preallocated tail, so the download can resume from there
+            output_file.truncate()
+            raise
+        if flags & FLAG_TRAILER:
+            root = recv_root_trailer(soc)
+        # Only an interrupted download is resumed from its journal; repairs may rewrite any chunk
+        close_tree_journal(tree)
+        remove_if_exists(file_name + TREE_SUFFIX)
+        leaves = finish_chunk_tree(tree)
+        # Without a root, or when it differs, the chunk digests of the server's copy decide
+        if root != merkle_root(leaves) and not repair_download(soc, request, output_file, leaves):
+            return
+    finally:
+        if tree is not None:
+            close_tree_journal(tree)
         output_file.close()
+    os.replace(partial_name, file_name)
 
-        print(f"\tSuccessfully downloaded {file_name}")
+    elapsed = time.time() - request['start_time']
+    LOG.info(f"\tSuccessfully downloaded {file_name}")
+    LOG.info(f"\nTime elapsed: {elapsed}s\nFile size: {offset + remaining} bytes")
+    if totals is not None:
+        LOG.info(format_compression_totals(totals))
+    request["result"] = {"size": offset + remaining, "elapsed": elapsed, "offset": offset}
+    return
 
-        # Tell the server that the client is ready to receive the download performance details
-        soc.send("1".encode())
+def recv_root_trailer(soc):
+    # The root of a file the server hashed while sending it, in a HASH frame after the content; zeros if it could not
+    _, status, _, _, payload_length = recv_frame(soc)
+    payload = recv_exact(soc, payload_length)
+    return HASH_RESPONSE.unpack(payload)[0] if status == STATUS_OK else bytes(32)
 
-        # Get performance details
-        time_elapsed = struct.unpack("f", soc.recv(4))[0]
-        print(f"\nTime elapsed: {time_elapsed}s\nFile size: {file_size} bytes")
-    except struct.error:
-        print("Error unpacking struct data for performance details.")
-    except socket.error:
-        print("Socket error occurred during file download.")
-    except IOError:
-        print("Error writing to file.")
+def repair_download(soc, request, output_file, leaves):
+    # Compare our chunk digests with those of the server's copy, on a session of its own, and fetch again only
+    # the chunks that differ; True once the partial download matches the server's file
+    file_name = request["file_name"]
+    try:
+        session = open_session(soc.getpeername())
+    except(socket.error, OSError, struct.error) as e:
+        fail_request(request, f"\nCould not verify {file_name}: {e}")
+        return False
+    try:
+        tree = query_tree(session[0], request["request_id"], file_name)
+    except(socket.error, OSError, struct.error) as e:
+        session[0].close()
+        fail_request(request, f"\nCould not verify {file_name}: {e}")
+        return False
+    if tree is None:
+        session[0].close()
+        fail_request(request, f"\n{file_name} disappeared from the server before it could be verified.")
+        return False
+
+    plan = create_plan(request, tree[0])
+    plan["leaves"] = tree[1]
+    plan["next_offset"] = plan["file_size"]
+    plan["fd"] = output_file.fileno()
+    output_file.truncate(plan["file_size"])
+    for index, leaf in enumerate(plan["leaves"]):
+        if index >= len(leaves) or leaves[index] != leaf:
+            offset = index * MERKLE_CHUNK_SIZE
+            plan["retry"].append((offset, min(MERKLE_CHUNK_SIZE, plan["file_size"] - offset)))
+    repaired = len(plan["retry"])
+    # The bad chunks go through the same checked range download as a segmented RETR
+    run_stream(plan, session, send_range_request, receive_range)
+    if plan["error"] is not None:
+        fail_request(request, f"\nDownloaded {file_name} does not match the server's copy and could not be repaired: "
+                              f"{plan['error']}")
+        return False
+    if repaired:
+        LOG.info(f"\tFetched {repaired} chunks again that did not match the server's copy")
+    return True
+
+def hash_file(file_name):
+    # Chunk digests of a whole file
+    with open(file_name, "rb", buffering=0) as content:
+        return finish_chunk_tree(hash_range(content.fileno(), create_chunk_tree(), 0, os.fstat(content.fileno()).st_size))
+
+def pwrite_all(fd, view, offset):
+    # Positional writes let every stream fill its own range of the same file; they may be partial too
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+    return
+
+def create_plan(request, file_size):
+    # State shared by the streams of one segmented transfer
+    return {"request_id": request["request_id"], "file_name": request["file_name"],
+            "encoded_name": request["file_name"].encode('utf-8'), "file_size": file_size, "next_offset": 0,
+            "bytes_done": 0, "streams": 0, "error": None, "lock": threading.Lock(), "fd": None, "leaves": None,
+            "retry": [], "attempts": {}}
+
+def take_segment(plan):
+    # A chunk to send again, else the next range nobody transfers yet, or None once the file is covered or a
+    # stream failed
+    with plan["lock"]:
+        if plan["error"] is not None:
+            return None
+        if plan["retry"]:
+            return plan["retry"].pop()
+        if plan["next_offset"] >= plan["file_size"]:
+            return None
+        offset = plan["next_offset"]
+        length = min(SEGMENT_SIZE, plan["file_size"] - offset)
+        plan["next_offset"] += length
+    return offset, length
+
+def add_progress(plan, size):
+    with plan["lock"]:
+        plan["bytes_done"] += size
+    return
+
+def check_range(plan, segment, leaves):
+    # Chunks of a range whose digests differ from the expected ones are queued again, up to CHUNK_RETRIES times
+    # each; returns the bytes that were right
+    offset, length = segment
+    first = offset // MERKLE_CHUNK_SIZE
+    if len(leaves) != -(-length // MERKLE_CHUNK_SIZE):
+        raise ConnectionError(f"no digests for bytes {offset}-{offset + length}")
+    verified = 0
+    for index, leaf in enumerate(leaves, first):
+        chunk_offset = index * MERKLE_CHUNK_SIZE
+        chunk_length = min(MERKLE_CHUNK_SIZE, offset + length - chunk_offset)
+        if plan["leaves"][index] == leaf:
+            verified += chunk_length
+            continue
+        with plan["lock"]:
+            attempts = plan["attempts"].get(index, 0) + 1
+            if attempts > CHUNK_RETRIES:
+                raise ConnectionError(f"bytes {chunk_offset}-{chunk_offset + chunk_length} failed verification "
+                                      f"{CHUNK_RETRIES} times")
+            plan["attempts"][index] = attempts
+            plan["retry"].append((chunk_offset, chunk_length))
+    return verified
+
+def send_range_request(soc, plan, segment):
+    send_frame(soc, OP_GET, plan["request_id"], [RANGE_REQUEST.pack(*segment), plan["encoded_name"]])
+    return
+
+def receive_range(soc, view, plan, segment):
+    offset, length = segment
+    _, status, _, _, payload_length = recv_frame(soc)
+    if status != STATUS_OK or payload_length != length:
+        raise ConnectionError(f"server refused bytes {offset}-{offset + length} (status {status})")
+    # Ranges start on chunk boundaries, so the range is checked chunk by chunk as it arrives
+    tree = create_chunk_tree()
+    received = 0
+    while received < length:
+        size = soc.recv_into(view, min(len(view), length - received))
+        if size == 0:
+            raise ConnectionError("Connection closed by server.")
+        update_chunk_tree(tree, view[:size])
+        pwrite_all(plan["fd"], view[:size], offset + received)
+        received += size
+    add_progress(plan, check_range(plan, segment, finish_chunk_tree(tree)))
+    return
+
+def send_range(soc, plan, segment):
+    offset, length = segment
+    meta = PUT_REQUEST.pack(offset, len(plan["encoded_name"]))
+    # Each range opens the file itself: sendfile falls back to seek and read, which streams must not share
+    with open(plan["file_name"], "rb") as content:
+        send_frame_with_file(soc, OP_PUT, plan["request_id"], [meta, plan["encoded_name"]], content, offset, length)
+    return
+
+def receive_range_ack(soc, view, plan, segment):
+    # The server answers with the digests of the chunks it wrote
+    _, status, _, _, payload_length = recv_frame(soc)
+    payload = recv_exact(soc, payload_length)
+    if status != STATUS_OK:
+        raise ConnectionError(f"server refused bytes {segment[0]}-{segment[0] + segment[1]} (status {status})")
+    add_progress(plan, check_range(plan, segment, [payload[start:start + 32] for start in range(0, len(payload), 32)]))
+    return
+
+def run_stream(plan, session, send_segment, receive_segment):
+    # One stream on its own session, with SEGMENTS_IN_FLIGHT ranges outstanding until none is left
+    soc, buffer_size, _ = session
+    view = memoryview(bytearray(buffer_size))
+    in_flight = collections.deque()
+    try:
+        while True:
+            while len(in_flight) < SEGMENTS_IN_FLIGHT:
+                segment = take_segment(plan)
+                if segment is None:
+                    break
+                send_segment(soc, plan, segment)
+                in_flight.append(segment)
+            if not in_flight:
+                break
+            receive_segment(soc, view, plan, in_flight.popleft())
     except Exception as e:
-        print(f"Unexpected error while downloading file: {e}")
+        # The other streams stop taking ranges; the transfer fails as a whole
+        with plan["lock"]:
+            if plan["error"] is None:
+                plan["error"] = e
     finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        soc.close()
     return
 
-def delete_file_from_server(soc, buffer_size, command, file_name, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-        
-    # Delete specified file from file server
-    print(f"\nDeleting file: {file_name}")
+def run_streams(plan, session, streams, send_segment, receive_segment):
+    # Runs the streams of a segmented transfer until every range is done; with streams == 0
+    # their number grows for as long as the measured throughput keeps growing with it
+    address = session[0].getpeername()
+    threads = []
+    wanted = min(streams or AUTO_STREAMS, MAX_STREAMS)
+    tuning = streams == 0
+    last_rate = 0.0
 
+    while True:
+        # Open the streams still missing, the first one on the session we were given
+        while len(threads) < wanted and (not threads or plan["next_offset"] < plan["file_size"] and plan["error"] is None):
+            if threads:
+                try:
+                    session = open_session(address)
+                except(socket.error, OSError, struct.error):
+                    # The server takes no more sessions; go on with the streams we have
+                    wanted = len(threads)
+                    break
+            thread = threading.Thread(target=run_stream, args=(plan, session, send_segment, receive_segment),
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+        plan["streams"] = max(plan["streams"], len(threads))
+
+        # Measure one interval, or less if every stream is done
+        start_time = time.time()
+        start_bytes = plan["bytes_done"]
+        for thread in threads:
+            thread.join(max(0.0, start_time + TUNE_INTERVAL - time.time()))
+        if not any(thread.is_alive() for thread in threads):
+            break
+        rate = (plan["bytes_done"] - start_bytes) / (time.time() - start_time)
+
+        if tuning and rate > last_rate * TUNE_GAIN and len(threads) < MAX_STREAMS:
+            wanted = min(len(threads) * 2, MAX_STREAMS)
+            last_rate = rate
+        else:
+            tuning = False
+    return
+
+def store_file_in_segments(soc, buffer_size, request):
+    # Upload ranges of the file over several sessions, then ask the server to verify and commit it
+    file_name = request["file_name"]
+    file_size = os.path.getsize(file_name)
+    plan = create_plan(request, file_size)
+    # Every range is checked against these as soon as the server acknowledges it; they may already be known
+    # from the deduplication offer
+    plan["leaves"] = request.get("leaves") or hash_file(file_name)
     try:
-        # Send request, then wait for go-ahead
-        soc.send(command.encode('utf-8'))
-        soc.recv(buffer_size)
-    except socket.error:
-        print("\nCouldn't connect to server. Make sure a connection has been established.")
+        session = open_session(soc.getpeername())
+    except(socket.error, OSError, struct.error) as e:
+        request["error"] = f"Could not open a transfer session: {e}"
         return
-    except Exception as e:
-        print(f"\nUnexpected error during server request: {e}")
+    run_streams(plan, session, request["streams"], send_range, receive_range_ack)
+    if plan["error"] is not None:
+        request["error"] = f"Segmented upload of {file_name} failed: {plan['error']}"
         return
 
-    try:
-        # Send file length, then file name
-        soc.send(struct.pack("h", len(file_name)))
-        soc.send(file_name.encode())
-    except struct.error:
-        print("\nError packing or sending file details.")
-        return
-    except socket.error:
-        print("\nSocket error while sending file details.")
+    # The server checks the whole file against our root before it replaces anything
+    meta = COMMIT_REQUEST.pack(file_size, merkle_root(plan["leaves"]))
+    send_frame(soc, OP_COMMIT, request["request_id"], [meta, plan["encoded_name"]])
+    request["file_size"] = file_size
+    request["streams_used"] = plan["streams"]
+    return
+
+def receive_commit_response(soc, buffer_size, request, status, flags, payload_length):
+    discard_payload(soc, payload_length)
+    if status != STATUS_OK:
+        fail_request(request, f"\nServer could not verify {request['file_name']} (status {status}); "
+                              "nothing was stored.")
         return
-    except Exception as e:
-        print(f"\nUnexpected error sending file details: {e}")
-        return    
+    elapsed = time.time() - request["start_time"]
+    LOG.info(f"\tSent file: {request['file_name']} over {request['streams_used']} streams, verified")
+    LOG.info(f"\nTime elapsed: {elapsed}s\nFile size: {request['file_size']} bytes"
+             f"\nThroughput: {request['file_size'] / max(elapsed, 1e-9) / 1024 ** 2:.1f} MiB/s")
+    request["result"] = {"size": request["file_size"], "elapsed": elapsed, "streams": request["streams_used"]}
+    return
 
+def retrieve_file_in_segments(soc, buffer_size, request):
+    # Download ranges of the file over several sessions into one file, each checked against the chunk digests
+    # of the server's copy as it arrives, then ask for the server's root
+    file_name = request["file_name"]
+    plan = None
     try:
-        # Get confirmation that file does/doesn't exist
-        file_exists = struct.unpack("i", soc.recv(4))[0]
-        if file_exists == -1:
-            print("\nThe file does not exist on the server")
+        session = open_session(soc.getpeername())
+        tree = query_tree(session[0], request["request_id"], file_name)
+        if tree is not None:
+            plan = create_plan(request, tree[0])
+            plan["leaves"] = tree[1]
+        else:
+            session[0].close()
+            request["error"] = "File does not exist. Make sure the name was entered correctly"
             return
-    except struct.error:
-        print("\nError unpacking data. Possible data corruption.")
+    except(socket.error, OSError, struct.error) as e:
+        request["error"] = f"Could not open a transfer session: {e}"
         return
-    except socket.error:
-        print("\nSocket error occurred while checking file existence.")
+
+    segments_name = file_name + SEGMENTS_SUFFIX
+    with open(segments_name, "wb", buffering=0) as output_file:
+        preallocate_file(output_file, plan["file_size"])
+        plan["fd"] = output_file.fileno()
+        run_streams(plan, session, request["streams"], send_range_request, receive_range)
+    if plan["error"] is not None:
+        os.remove(segments_name)
+        request["error"] = f"Segmented download of {file_name} failed: {plan['error']}"
         return
-    except Exception as e:
-        print(f"\nUnexpected error while checking file existence: {e}")
+
+    send_frame(soc, OP_HASH, request["request_id"], [plan["encoded_name"]])
+    request["file_size"] = plan["file_size"]
+    request["streams_used"] = plan["streams"]
+    request["leaves"] = plan["leaves"]
+    return
+
+def receive_hash_response(soc, buffer_size, request, status, flags, payload_length):
+    file_name = request["file_name"]
+    segments_name = file_name + SEGMENTS_SUFFIX
+    payload = recv_exact(soc, payload_length)
+    # Every chunk already matched its digest; the root tells whether the digests were those of the file as it
+    # is now, without reading the file again
+    if status != STATUS_OK or HASH_RESPONSE.unpack(payload)[0] != merkle_root(request["leaves"]):
+        os.remove(segments_name)
+        fail_request(request, f"\nDownloaded {file_name} does not match the server's copy (status {status}); "
+                              "discarded.")
+        return
+    os.replace(segments_name, file_name)
+
+    elapsed = time.time() - request["start_time"]
+    LOG.info(f"\tSuccessfully downloaded {file_name} over {request['streams_used']} streams, verified")
+    LOG.info(f"\nTime elapsed: {elapsed}s\nFile size: {request['file_size']} bytes"
+             f"\nThroughput: {request['file_size'] / max(elapsed, 1e-9) / 1024 ** 2:.1f} MiB/s")
+    request["result"] = {"size": request["file_size"], "elapsed": elapsed, "streams": request["streams_used"]}
+    return
+
+def query_signatures(soc, request):
+    # Ask for the block signatures of the server's copy; the delta can only be computed once they are all here
+    meta = SIGS_REQUEST.pack(0)
+    send_frame(soc, OP_SIGS, request["request_id"], [meta, request["file_name"].encode('utf-8')])
+    pages = []
+    while True:
+        _, status, flags, request_id, payload_length = recv_frame(soc)
+        if request_id != request["request_id"]:
+            raise ConnectionError(f"response {request_id} does not match request {request['request_id']}")
+        payload = recv_exact(soc, payload_length)
+        if not flags & FLAG_MORE:
+            break
+        pages.append(payload)
+    if status != STATUS_OK:
+        # No copy to diff against: upload the whole file instead
+        request["command"] = "STOR"
+        return
+
+    file_size, block_size = SIGS_SUMMARY.unpack(payload)
+    # weak checksum -> {strong hash: offset}; a short last block can never match a full window and is left out
+    signatures = {}
+    full_blocks = file_size // block_size
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(b"".join(pages))):
+        if index < full_blocks:
+            signatures.setdefault(weak, {}).setdefault(strong, index * block_size)
+    request["signatures"] = signatures
+    request["block_size"] = block_size
+    return
+
+def rolling_checksums(window, block_size):
+    # adler32 of every block_size window of window, as zlib.adler32 computes it, from prefix sums so that every
+    # step runs in C: A = 1 + S[k+L] - S[k] and B = L + (k+L) * (S[k+L] - S[k]) - (W[k+L] - W[k]), both mod 65521,
+    # where S sums the bytes and W sums each byte times its position
+    count = len(window) - block_size + 1
+    sums = list(itertools.accumulate(window, initial=0))
+    weighted = list(itertools.accumulate(map(operator.mul, window, itertools.count()), initial=0))
+    totals = list(map(operator.sub, sums[block_size:], sums[:count]))
+    moments = map(operator.sub, map(operator.mul, itertools.count(block_size), totals),
+                  map(operator.sub, weighted[block_size:], weighted[:count]))
+    low = map(operator.mod, map((1).__add__, totals), itertools.repeat(65521))
+    high = map(operator.mod, map(block_size.__add__, moments), itertools.repeat(65521))
+    return map(operator.or_, map(operator.lshift, high, itertools.repeat(16)), low)
+
+def match_block(signatures, block):
+    # Offset of the server block holding exactly these bytes, or None; the strong hash is only computed for
+    # blocks whose weak checksum is known
+    strong_hashes = signatures.get(zlib.adler32(block))
+    if strong_hashes is None:
+        return None
+    return strong_hashes.get(hashlib.blake2b(block, digest_size=16).digest())
+
+def find_shifted_block(signatures, view, block_size):
+    # Position after the first byte of view where a known block starts, with its server offset, or (None, None)
+    window = view[1:2 * block_size]
+    if len(window) < block_size:
+        return None, None
+    known = map(signatures.__contains__, rolling_checksums(window, block_size))
+    for position in itertools.compress(itertools.count(1), known):
+        offset = match_block(signatures, view[position:position + block_size])
+        if offset is not None:
+            return position, offset
+    return None, None
+
+def send_delta_copy(soc, delta, offset, length):
+    # Consecutive server blocks become one COPY instruction
+    if delta["copy_length"] and delta["copy_offset"] + delta["copy_length"] == offset:
+        delta["copy_length"] += length
+        return
+    flush_delta_copy(soc, delta)
+    delta["copy_offset"] = offset
+    delta["copy_length"] = length
+    return
+
+def flush_delta_copy(soc, delta):
+    if delta["copy_length"]:
+        meta = DELTA_COPY.pack(DELTA_KIND_COPY, delta["copy_offset"], delta["copy_length"])
+        send_frame(soc, OP_DATA, delta["request_id"], [meta], flags=FLAG_MORE)
+        delta["copy_length"] = 0
+    return
+
+def send_delta_literal(soc, delta, data):
+    flush_delta_copy(soc, delta)
+    for start in range(0, len(data), DELTA_LITERAL_SIZE):
+        piece = data[start:start + DELTA_LITERAL_SIZE]
+        send_frame(soc, OP_DATA, delta["request_id"], [DELTA_LITERAL.pack(DELTA_KIND_LITERAL), piece], flags=FLAG_MORE)
+        delta["literal"] += len(piece)
+    return
+
+def store_file_as_delta(soc, buffer_size, request):
+    # Walk the local file block by block: a block the server holds becomes a COPY of its bytes, anything else
+    # is sent as a LITERAL. Only where the block at the current position is unknown are shifted positions searched
+    file_name = request["file_name"]
+    signatures = request["signatures"]
+    block_size = request["block_size"]
+    delta = {"request_id": request["request_id"], "copy_offset": 0, "copy_length": 0, "literal": 0}
+    tree = create_chunk_tree()
+    send_frame(soc, OP_DELTA, request["request_id"], [file_name.encode('utf-8')], flags=FLAG_CHUNKED)
+
+    # data holds the file from byte base on; position is where the next block starts, literal_start where
+    # the bytes not sent yet start
+    data = b""
+    base = position = literal_start = 0
+    misses = skipped = 0
+    end_of_file = False
+    with open(file_name, "rb") as content:
+        while True:
+            if not end_of_file and position + 2 * block_size > base + len(data):
+                piece = content.read(DELTA_READ_SIZE)
+                end_of_file = not piece
+                update_chunk_tree(tree, piece)
+                keep = min(literal_start, position) - base
+                data = data[keep:] + piece
+                base += keep
+                continue
+            if position + block_size > base + len(data):
+                break
+            view = memoryview(data)[position - base:]
+            offset = match_block(signatures, view[:block_size])
+            if offset is None and (misses < DELTA_SEARCH_MISSES or skipped >= DELTA_SEARCH_INTERVAL):
+                skipped = 0
+                shift, offset = find_shifted_block(signatures, view, block_size)
+                if offset is None:
+                    misses += 1
+                else:
+                    position += shift
+            elif offset is None:
+                skipped += 1
+
+            if offset is None:
+                position += block_size
+                if position - literal_start >= DELTA_LITERAL_SIZE:
+                    send_delta_literal(soc, delta, memoryview(data)[literal_start - base:position - base])
+                    literal_start = position
+                continue
+            if literal_start < position:
+                send_delta_literal(soc, delta, memoryview(data)[literal_start - base:position - base])
+            send_delta_copy(soc, delta, offset, block_size)
+            position += block_size
+            literal_start = position
+            misses = 0
+
+    # The tail shorter than a block, and whatever did not match before it
+    send_delta_literal(soc, delta, memoryview(data)[literal_start - base:])
+    flush_delta_copy(soc, delta)
+    send_frame(soc, OP_DATA, request["request_id"], [DELTA_END.pack(DELTA_KIND_END, merkle_root(finish_chunk_tree(tree)))])
+    request["literal"] = delta["literal"]
+    return
+
+def receive_delta_response(soc, buffer_size, request, status, flags, payload_length):
+    if status != STATUS_OK:
+        discard_payload(soc, payload_length)
+        fail_request(request, f"\nServer could not rebuild {request['file_name']} from the delta (status {status}).")
         return
+    upload_time, upload_size, literal_size = DELTA_RESPONSE.unpack(recv_exact(soc, payload_length))
+    LOG.info(f"\tSent file: {request['file_name']} as a delta, {literal_size} literal bytes, "
+             f"{upload_size - literal_size} bytes reused from the server's copy")
+    LOG.info(f"\nTime elapsed: {upload_time}s\nFile size: {upload_size} bytes")
+    request["result"] = {"size": upload_size, "elapsed": upload_time, "literal_bytes": literal_size}
+    return
+
+def query_file_hash(soc, buffer_size, request):
+    send_frame(soc, OP_HASH, request["request_id"], [request["file_name"].encode('utf-8')])
+    return
 
+def receive_file_hash(soc, buffer_size, request, status, flags, payload_length):
+    payload = recv_exact(soc, payload_length)
+    if status == STATUS_NOT_FOUND:
+        fail_request(request, "File does not exist. Make sure the name was entered correctly", logging.WARNING)
+        return
+    if status != STATUS_OK:
+        fail_request(request, f"\nServer could not hash {request['file_name']} (status {status}).")
+        return
+    root = HASH_RESPONSE.unpack(payload)[0]
+    LOG.info(f"\tMerkle root: {root.hex()}")
+    request["result"] = {"root": root.hex(), "local_match": None}
+    # A local file of the same name is hashed the same way for comparison
     try:
-        # Confirm user wants to delete file
-        confirm_delete = input(f"\nAre you sure you want to delete '{file_name}'? (Y/N)\nCommand: ").upper()
-        while confirm_delete not in ["Y", "y", "N", "n", "YES", "yes", "NO", "no"]:
-            print("Command not recognized, try again")
-            confirm_delete = input(f"\nAre you sure you want to delete '{file_name}'? (Y/N)\nCommand: ").upper()
-    except KeyboardInterrupt:
-        print("Action interrupted by user.")
+        local_root = merkle_root(hash_file(request["file_name"]))
+    except OSError:
         return
-    except Exception as e:
-        print(f"\nUnexpected error while confirming deletion status: {e}")
+    LOG.info(f"\tLocal copy {'matches' if local_root == root else 'differs'}")
+    request["result"]["local_match"] = local_root == root
+    return
+
+def query_statistics(soc, buffer_size, request):
+    send_frame(soc, OP_STAT, request["request_id"])
+    return
+
+def receive_statistics(soc, buffer_size, request, status, flags, payload_length):
+    payload = recv_exact(soc, payload_length)
+    if status != STATUS_OK:
+        fail_request(request, f"\nServer could not report its statistics (status {status}).")
+        return
+    snapshot = json.loads(payload)
+    request["result"] = {"snapshot": snapshot}
+    stats = snapshot["stats"]
+    # In --workers mode the numbers belong to the worker serving this session
+    LOG.info(f"\tStatistics of {snapshot['scope']} {snapshot['pid']}, up {snapshot['uptime']:.0f}s")
+    LOG.info(f"\tSessions: {stats['sessions']} ({stats['active_sessions']} active), commands: {stats['commands']}, "
+             f"errors: {stats['errors']}")
+    LOG.info(f"\tBytes in: {stats['bytes_in']}, bytes out: {stats['bytes_out']}")
+    LOG.info(f"\tCache: {stats['cache_hits']} hits, {stats['cache_misses']} misses, "
+             f"{stats['cache_evictions']} evictions, {stats['cache_bytes']} bytes")
+    LOG.info(f"\n\t{'Command':<10}{'Count':>8}{'Errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for command, entry in sorted(snapshot["commands"].items()):
+        LOG.info(f"\t{command:<10}{entry['count']:>8}{entry['errors']:>8}{entry['p50'] * 1000:>10.2f}"
+                 f"{entry['p95'] * 1000:>10.2f}{entry['p99'] * 1000:>10.2f}")
+    return
+
+def delete_file_from_server(soc, buffer_size, request):
+    # Send delete request
+    send_frame(soc, OP_DEL, request["request_id"], [request["file_name"].encode('utf-8')])
+    return
+
+def receive_delete_response(soc, buffer_size, request, status, flags, payload_length):
+    payload = recv_exact(soc, payload_length)
+    if status == STATUS_OK:
+        time_elapsed = DEL_RESPONSE.unpack(payload)[0]
+        LOG.info("\n\tFile successfully deleted!")
+    elif status == STATUS_NOT_FOUND:
+        fail_request(request, "\nThe file does not exist on the server", logging.WARNING)
+        return
+    else:
+        fail_request(request, "\nFile failed to delete")
         return
+    LOG.info(f"\nTime elapsed: {time_elapsed}s")
+    request["result"] = {"elapsed": time_elapsed}
+    return
+
+class DataFrameWriter:
+    # File object a directory upload is packed into: what tarfile writes leaves in DATA frames of
+    # COMPRESSION_CHUNK_SIZE, each compressed if that shrinks it
+
+    def __init__(self, soc, request_id, totals):
+        self.soc = soc
+        self.request_id = request_id
+        self.totals = totals
+        self.buffer = bytearray()
+        self.failed = False
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= COMPRESSION_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        codec, payload = encode_chunk(data, self.totals)
+        try:
+            send_frame(self.soc, OP_DATA, self.request_id, [CHUNK_HEADER.pack(len(data)), payload],
+                       flags=(codec << CODEC_SHIFT) | FLAG_MORE)
+        except OSError:
+            # The connection is gone, unlike a local file that could not be read
+            self.failed = True
+            raise
+        self.totals["raw"] += len(data)
+        self.totals["wire"] += CHUNK_HEADER.size + len(payload)
+        return
+
+class DataFrameReader:
+    # File object a directory download is unpacked from: the decoded DATA frames of the request, up to the one
+    # without FLAG_MORE
 
+    def __init__(self, soc, request, totals):
+        self.soc = soc
+        self.request = request
+        self.totals = totals
+        self.pending = memoryview(b"")
+        self.more = True
+        self.failed = False
+
+    def read(self, size=-1):
+        while not self.pending and self.more:
+            try:
+                data, flags = recv_chunk(self.soc, self.request, self.totals)
+            except Exception:
+                # Whatever broke, the stream can no longer be followed frame by frame
+                self.failed = True
+                raise
+            self.more = bool(flags & FLAG_MORE)
+            self.pending = memoryview(data)
+        size = len(self.pending) if size < 0 else size
+        data = bytes(self.pending[:size])
+        self.pending = self.pending[size:]
+        return data
+
+    def drain(self):
+        # Reads what the archive left, such as the padding after its end, so the next frame is found
+        while self.more:
+            self.pending = memoryview(b"")
+            self.read()
+        return
+
+def remove_tree(path):
     try:
-        # Send confirmation
-        if confirm_delete in ["Y", "y", "YES", "yes"]:
-            soc.send("Y".encode())
-            delete_status = struct.unpack("i", soc.recv(4))[0]
-            if delete_status == 1:
-                print("\n\tFile successfully deleted!")
-            else:
-                print("\nFile failed to delete")
-        else:
-            soc.send("N".encode())
-            print("Delete abandoned by user!")
-    except struct.error:
-        print("\nError unpacking deletion status.")
+        shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
+    return
+
+def replace_tree(staging, directory):
+    # The old tree moves aside before the new one takes its name, so the name is only missing between two renames
+    replaced = directory + REPLACED_SUFFIX
+    remove_tree(replaced)
+    if os.path.isdir(directory):
+        os.rename(directory, replaced)
+    os.rename(staging, directory)
+    remove_tree(replaced)
+    return
+
+def count_member(member, counts):
+    if member.isfile():
+        counts["files"] += 1
+        counts["bytes"] += member.size
+    return
+
+def pack_directory(directory, output, counts):
+    # The tree under directory as a tar stream with names relative to it, regular files and directories only,
+    # with their mtimes; partial downloads are left out
+    def admit(member):
+        if not (member.isfile() or member.isdir()) or member.name.endswith(PARTIAL_SUFFIX):
+            return None
+        member.uid = member.gid = 0
+        member.uname = member.gname = ""
+        count_member(member, counts)
+        return member
+
+    # GNU headers keep mtimes to the second; PAX would add an extended header to every file for the fraction
+    with tarfile.open(fileobj=output, mode="w|", format=tarfile.GNU_FORMAT) as archive:
+        archive.add(directory, arcname=".", filter=admit)
+    output.flush()
+    return
+
+def safe_members(archive, counts):
+    # Regular files and directories that stay inside the target, never setuid; links, devices and paths leading
+    # out are skipped
+    for member in archive:
+        path = os.path.normpath(member.name)
+        if os.path.isabs(path) or path == ".." or path.startswith(".." + os.sep) or \
+                not (member.isfile() or member.isdir()):
+            LOG.warning(f"\tSkipping archive member {member.name}")
+            continue
+        member.mode = (member.mode & 0o755) | (0o700 if member.isdir() else 0o600)
+        member.uid = member.gid = 0
+        member.uname = member.gname = ""
+        count_member(member, counts)
+        yield member
+
+def store_directory_to_server(soc, buffer_size, request):
+    # Upload a directory tree as a tar archive packed while it is sent, never written out in full
+    if not os.path.isdir(request["directory"]):
+        raise FileNotFoundError(request["directory"])
+    send_frame(soc, OP_PUTDIR, request["request_id"], [request["file_name"].encode('utf-8')])
+    request["compression"] = create_compression_totals(request["codec"])
+    writer = DataFrameWriter(soc, request["request_id"], request["compression"])
+    status = STATUS_OK
+    try:
+        pack_directory(request["directory"], writer, {"files": 0, "bytes": 0})
+    except(OSError, tarfile.TarError) as e:
+        if writer.failed:
+            raise
+        # The archive breaks off here; the last frame tells the server to throw away what it unpacked
+        request["local_error"] = e
+        status = STATUS_ERROR
+    send_frame(soc, OP_DATA, request["request_id"], [CHUNK_HEADER.pack(0)], status=status)
+    return
+
+def receive_directory_store_response(soc, buffer_size, request, status, flags, payload_length):
+    payload = recv_exact(soc, payload_length)
+    directory = request["directory"]
+    if "local_error" in request:
+        fail_request(request, f"\nCould not read {directory}: {request['local_error']}")
         return
-    except socket.error:
-        print("\nSocket error occurred during deletion process.")
+    if status != STATUS_OK:
+        fail_request(request, f"\nServer could not store directory {request['file_name']} (status {status}).")
         return
-    except Exception as e:
-        print(f"\nUnexpected error during file deletion: {e}")
+    _, files, size = DIR_SUMMARY.unpack(payload)
+    elapsed = time.time() - request["start_time"]
+    LOG.info(f"\tSuccessfully uploaded {directory} as {request['file_name']}")
+    LOG.info(f"\nTime elapsed: {elapsed}s\nFiles: {files}\nSize: {size} bytes")
+    if request["codec"] != CODEC_NONE:
+        LOG.info(format_compression_totals(request["compression"]))
+    request["result"] = {"files": files, "size": size, "elapsed": elapsed}
+    return
+
+def retrieve_directory_from_server(soc, buffer_size, request):
+    send_frame(soc, OP_GETDIR, request["request_id"], [request["file_name"].encode('utf-8')])
+    return
+
+def receive_directory_response(soc, buffer_size, request, status, flags, payload_length):
+    directory = request["file_name"]
+    discard_payload(soc, payload_length)
+    if status == STATUS_NOT_FOUND:
+        fail_request(request, "Directory does not exist. Make sure the name was entered correctly", logging.WARNING)
+        return
+    if status != STATUS_OK:
+        fail_request(request, f"\nServer could not send directory {directory} (status {status}).")
+        return
+
+    # The tree is unpacked as the archive arrives, next to the old one, and takes its place once the server
+    # confirms the archive is complete
+    staging = directory + PARTIAL_SUFFIX
+    remove_tree(staging)
+    totals = create_compression_totals(CODEC_NONE)
+    counts = {"files": 0, "bytes": 0}
+    reader = DataFrameReader(soc, request, totals)
+    error = None
+    LOG.info("\nDownloading...\n")
+    try:
+        with tarfile.open(fileobj=reader, mode="r|") as archive:
+            archive.extractall(staging, members=safe_members(archive, counts), **EXTRACT_OPTIONS)
+    except(OSError, tarfile.TarError) as e:
+        if reader.failed:
+            raise
+        error = e
+    reader.drain()
+    _, status, _, request_id, payload_length = recv_frame(soc)
+    if request_id != request["request_id"]:
+        raise ConnectionError(f"response {request_id} does not match request {request['request_id']}")
+    payload = recv_exact(soc, payload_length)
+    if error is None and status != STATUS_OK:
+        error = f"the server could not finish the archive (status {status})"
+    if error is None:
+        try:
+            replace_tree(staging, directory)
+        except OSError as e:
+            error = e
+    if error is not None:
+        remove_tree(staging)
+        fail_request(request, f"\nCould not download directory {directory}: {error}")
+        return
+
+    _, files, size = DIR_SUMMARY.unpack(payload)
+    elapsed = time.time() - request["start_time"]
+    LOG.info(f"\tSuccessfully downloaded {directory}")
+    LOG.info(f"\nTime elapsed: {elapsed}s\nFiles: {files}\nSize: {size} bytes")
+    if totals["codec"] != CODEC_NONE:
+        LOG.info(format_compression_totals(totals))
+    request["result"] = {"files": files, "size": size, "elapsed": elapsed}
+    return
+
+# Request sender and response reader of every command sent to the server
+REQUEST_HANDLERS = {
+    "STOR": (store_file_to_server, receive_store_response),
+    "LIST": (list_files_from_server, receive_list_response),
+    "RETR": (retrieve_file_from_server, receive_retrieve_response),
+    "DEL": (delete_file_from_server, receive_delete_response),
+    "PSTOR": (store_file_in_segments, receive_commit_response),
+    "PRETR": (retrieve_file_in_segments, receive_hash_response),
+    "DSTOR": (store_file_as_delta, receive_delta_response),
+    "HASH": (query_file_hash, receive_file_hash),
+    "STAT": (query_statistics, receive_statistics),
+    "PUTDIR": (store_directory_to_server, receive_directory_store_response),
+    "GETDIR": (retrieve_directory_from_server, receive_directory_response),
+}
+
+def list_server_files(soc, request_id):
+    # Every file name on the server, read page by page without printing them; None if the server cannot list
+    send_frame(soc, OP_LIST, request_id, [LIST_REQUEST.pack(0, 0, 0)])
+    names = []
+    while True:
+        _, status, flags, response_id, payload_length = recv_frame(soc)
+        if response_id != request_id:
+            raise ConnectionError(f"response {response_id} does not match request {request_id}")
+        payload = recv_exact(soc, payload_length)
+        if not flags & FLAG_MORE:
+            return names if status == STATUS_OK else None
+        names.extend(file_name for file_name, _ in parse_list_page(payload))
+
+def match_files(names, patterns):
+    # Names matching any of the glob patterns, each once, in name order
+    return sorted(name for name in set(names) if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns))
+
+def expand_bulk_requests(soc, requests, request_ids):
+    # MSTOR and MRETR give way to one STOR or RETR per matching file, in their place in the pipeline: local files
+    # for MSTOR, the server's listing for MRETR
+    expanded = []
+    for request in requests:
+        if request["command"] not in BULK_COMMANDS:
+            expanded.append(request)
+            continue
+        request["start_time"] = time.time()
+        if request["command"] == "MSTOR":
+            names = [name for pattern in request["patterns"] for name in glob.glob(pattern) if os.path.isfile(name)]
+        else:
+            names = list_server_files(soc, next(request_ids))
+            if names is None:
+                fail_request(request, f"\nServer could not list its files for {request['command']}.")
+                continue
+        request["files"] = [create_parsed_transfer_request(BULK_COMMANDS[request["command"]], next(request_ids),
+                                                           name, TRANSFER_DEFAULTS, request["session_options"])
+                            for name in match_files(names, request["patterns"])]
+        if not request["files"]:
+            fail_request(request, f"\nNo files match {' '.join(request['patterns'])}", logging.WARNING)
+        expanded.extend(request["files"])
+    return expanded
+
+def finish_bulk_request(request):
+    # Per-file outcomes and the aggregate throughput of an MSTOR or MRETR, once all of its transfers are done
+    if not request.get("files"):
         return
+    elapsed = time.time() - request["start_time"]
+    files = [{"file_name": transfer["file_name"], "ok": "result" in transfer, "error": transfer["error"],
+              **transfer.get("result", {})} for transfer in request["files"]]
+    failed = sum(not outcome["ok"] for outcome in files)
+    size = sum(outcome.get("size", 0) for outcome in files)
+    throughput = size / elapsed if elapsed > 0 else 0.0
+    LOG.info(f"\n{request['command']} {' '.join(request['patterns'])}: {len(files) - failed} of {len(files)} files, "
+             f"{size} bytes in {elapsed:.3f}s ({throughput / (1024 * 1024):.2f} MiB/s)")
+    if failed:
+        fail_request(request, f"\n{failed} of {len(files)} files failed")
+    request["result"] = {"count": len(files), "failed": failed, "size": size, "elapsed": elapsed,
+                         "throughput": throughput, "files": files}
+    return
 
+def send_requests(soc, buffer_size, requests):
+    # Runs on its own thread so requests keep flowing while responses are being read
+    for index, request in enumerate(requests):
+        try:
+            request["start_time"] = time.time()
+            REQUEST_HANDLERS[request["command"]][0](soc, buffer_size, request)
+        except FileNotFoundError:
+            request["error"] = "File not found. Make sure the file name was entered correctly."
+        except(socket.error, OSError) as e:
+            # The stream is broken: nothing after this request can be sent either
+            for failed in requests[index:]:
+                failed["error"] = f"Socket error: {e}"
+                failed["sent"].set()
+            return
+        request["sent"].set()
+    return
+
+def fail_pending(requests, message):
+    # The connection failed: every request without an outcome yet gets this one
+    LOG.error(message)
+    for request in requests:
+        if request["error"] is None and "result" not in request:
+            request["error"] = message.strip()
+    return
+
+def run_commands(soc, buffer_size, requests, request_ids=None):
+    # Pipeline: every request is sent without waiting for the previous response,
+    # and responses come back in request order. False if the connection cannot be used any more.
+    # request_ids hands out the ids of the transfers MSTOR and MRETR expand into
+    sender = None
+    bulk_requests = [request for request in requests if request["command"] in BULK_COMMANDS]
     try:
-        # Tell the server that the client is ready to receive the download performance details
-        soc.send("1".encode())
-
-        # Get performance details
-        time_elapsed = struct.unpack("f", soc.recv(4))[0]
-        print(f"\nTime elapsed: {time_elapsed}s")
-    except(struct.error, socket.error):
-        print("\nError occurred while receiving performance details.")
+        requests = expand_bulk_requests(soc, requests, request_ids)
+        # Uploads the server can link from content it already holds never enter the pipeline
+        requests = link_known_uploads(soc, requests)
+        # Resumed and delta uploads need the server's answer first, so those queries go out before the pipeline starts
+        for request in requests:
+            if request.get("resume"):
+                query_partial_upload(soc, request)
+            elif request["command"] == "DSTOR":
+                query_signatures(soc, request)
+
+        sender = threading.Thread(target=send_requests, args=(soc, buffer_size, requests), daemon=True)
+        sender.start()
+        for request in requests:
+            LOG.info(f"\n{request['command']} {request.get('file_name', '')}".rstrip())
+            # A response cannot arrive before its request left, and an unsent request has no response
+            request["sent"].wait()
+            if request["error"] is not None:
+                LOG.error(f"\n{request['error']}")
+                continue
+
+            opcode, status, flags, request_id, payload_length = recv_frame(soc)
+            if request_id != request["request_id"]:
+                raise ConnectionError(f"response {request_id} does not match request {request['request_id']}")
+            request["status"] = status
+            REQUEST_HANDLERS[request["command"]][1](soc, buffer_size, request, status, flags, payload_length)
+    except struct.error:
+        fail_pending(requests, "\nError unpacking struct data. Data may be corrupted or incomplete.")
+        return False
+    except socket.timeout:
+        fail_pending(requests, "\nTimed out waiting for the server.")
+        return False
+    except(socket.error, OSError) as e:
+        fail_pending(requests, f"\nSocket error: {e}")
+        return False
+    except UnicodeDecodeError:
+        fail_pending(requests, "\nError decoding file name. Data encoding may not match.")
+        return False
     except Exception as e:
-        print(f"\nUnexpected error while receiving performance details: {e}")
+        fail_pending(requests, f"\nAn unexpected error occurred: {e}")
+        return False
     finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
-    return
+        if sender is not None:
+            sender.join()
+        for request in bulk_requests:
+            finish_bulk_request(request)
+        flush_log()
+    return True
 
-def close_connection(soc, command, buffer_size):
+def close_connection(soc, request_id):
     try:
-        soc.send(command.encode('utf-8'))
+        send_frame(soc, OP_QUIT, request_id)
         # Wait for server go-ahead
-        soc.recv(buffer_size)
+        recv_frame(soc)
         soc.close()
-        print("Client connection ended.")
+        LOG.info("Client connection ended.")
     except BrokenPipeError:
-        print("\nServer connection not started or already closed.")
+        LOG.info("\nServer connection not started or already closed.")
     except(OSError, socket.error):
-        print("\nError closing server connection.")
+        LOG.error("\nError closing server connection.")
     except Exception as e:
-        print(f"\nUnexpected error while closing connection: {e}")
-    return 
+        LOG.error(f"\nUnexpected error while closing connection: {e}")
+    return
 
 def clear_terminal():
     os.system('cls' if os.name == 'nt' else 'clear')
@@ -370,50 +1783,197 @@ def clear_terminal():
 def display_commands():
     # Display all commands
     print("\nAvailable Commands:")
-    print("\n\tSTOR filename     : Upload file")
-    print("\tRETR filename       : Download file")
+    print("\n\tSTOR [-r] filename  : Upload file, -r resumes an interrupted upload")
+    print("\tRETR filename       : Download file, resuming an interrupted download")
+    print("\tSTOR/RETR -p [N] filename : Transfer in ranges over N parallel sessions (tuned if N is left out)")
+    print("\tSTOR -d filename    : Upload only what changed since the server's copy")
+    print("\tMSTOR/MRETR pattern ... : Upload local files or download server files matching glob patterns")
+    print("\tPUTDIR/GETDIR directory : Upload or download a directory tree as one tar stream")
+    print("\tHASH filename       : Show the server's Merkle root of a file, compared with a local copy")
     print("\tDEL filename        : Delete file")
-    print("\tLIST/LS             : List all files")
+    print("\tSTAT                : Show the server's counters and command latencies")
+    print("\tLIST/LS [options]   : List files, page by page")
+    print("\t    -s              : Sort by name")
+    print("\t    -p N            : Entries per page")
+    print("\t    -n N            : Stop after N entries")
+    print("\t    -a NAME         : Continue after NAME (name order)")
     print("\tSHOW/DISPLAY        : Display all commands")
     print("\tCLEAR               : Clear terminal")
     print("\tQUIT/EXIT/BYE       : Exit")
+    print("\n\tSeparate commands with ';' to pipeline them, e.g. STOR a.txt; STOR b.txt; LIST")
     return
 
-def handle_client(soc, buffer_size, quiet_mode):   
+def confirm_deletion(file_name):
+    # Confirm user wants to delete file
+    confirm_delete = input(f"\nAre you sure you want to delete '{file_name}'? (Y/N)\nCommand: ").upper()
+    while confirm_delete not in ["Y", "N", "YES", "NO"]:
+        print("Command not recognized, try again")
+        confirm_delete = input(f"\nAre you sure you want to delete '{file_name}'? (Y/N)\nCommand: ").upper()
+    return confirm_delete in ["Y", "YES"]
+
+def create_request(command, request_id, file_name=None):
+    request = {"command": command, "request_id": request_id, "sent": threading.Event(), "error": None}
+    if file_name is not None:
+        request["file_name"] = file_name
+    return request
+
+def parse_list_options(arguments):
+    # Options of LIST with their default values; raises ValueError on anything else
+    options = {"sorted": False, "page_size": 0, "limit": 0, "cursor": ""}
+    arguments = arguments.split()
+    while arguments:
+        option = arguments.pop(0)
+        if option == "-s":
+            options["sorted"] = True
+        elif option in ("-p", "-n", "-a") and arguments:
+            value = arguments.pop(0)
+            if option == "-a":
+                options["cursor"] = value
+            elif option == "-p":
+                options["page_size"] = int(value)
+            else:
+                options["limit"] = int(value)
+        else:
+            raise ValueError(f"unknown LIST option '{option}'")
+    if not 0 <= options["page_size"] <= 0xFFFFFFFF or options["limit"] < 0:
+        raise ValueError("page size or limit out of range")
+    return options
+
+def parse_transfer_arguments(arguments):
+    # Options in front of the file name of STOR and RETR; raises ValueError on unknown ones
+    options = dict(TRANSFER_DEFAULTS)
+    arguments = arguments.strip()
+    while arguments.startswith("-"):
+        option, _, arguments = arguments.partition(" ")
+        arguments = arguments.strip()
+        if option == "-r":
+            options["resume"] = True
+        elif option == "-d":
+            options["delta"] = True
+        elif option == "-p":
+            # The stream count is optional; a lone number is the file name
+            count, _, rest = arguments.partition(" ")
+            if count.isdigit() and rest.strip():
+                options["streams"] = int(count)
+                arguments = rest.strip()
+            else:
+                options["streams"] = 0
+        else:
+            raise ValueError(f"unknown option '{option}'")
+    return options, arguments
+
+def create_bulk_request(command, request_id, arguments, session_options):
+    # Glob patterns or plain names, quoted if they hold spaces; raises ValueError if there are none
+    patterns = shlex.split(arguments)
+    if not patterns:
+        raise ValueError(f"{command} needs at least one file name or pattern")
+    request = create_request(command, request_id)
+    request["patterns"] = patterns
+    request["session_options"] = session_options
+    return request
+
+def create_directory_request(command, request_id, directory, session_options):
+    # PUTDIR takes a local path and stores the tree under its last component; raises ValueError without a name
+    if not directory:
+        raise ValueError(f"{command} needs a directory name")
+    name = os.path.basename(os.path.normpath(directory)) if command == "PUTDIR" else directory
+    request = create_request(command, request_id, name)
+    request["directory"] = directory
+    request["codec"] = session_options["--compress"]
+    return request
+
+def create_transfer_request(command, request_id, arguments, session_options):
+    options, file_name = parse_transfer_arguments(arguments)
+    return create_parsed_transfer_request(command, request_id, file_name, options, session_options)
+
+def create_parsed_transfer_request(command, request_id, file_name, options, session_options):
+    # STOR or RETR, or their segmented variant when a stream count was asked for
+    if options["streams"] is not None:
+        request = create_request("P" + command, request_id, file_name)
+        request["streams"] = options["streams"]
+    elif options["delta"] and command == "STOR":
+        # Falls back to a plain STOR if the server has no copy yet
+        request = create_request("DSTOR", request_id, file_name)
+        request["resume"] = False
+        request["codec"] = session_options["--compress"]
+    else:
+        request = create_request(command, request_id, file_name)
+        request["resume"] = options["resume"]
+        request["codec"] = session_options["--compress"]
+    request["dedup"] = command == "STOR" and session_options["--dedup"]
+    return request
+
+def create_command_request(choice, request_id, session_options):
+    # The request for a server command as typed at the prompt or read from a script, or None if the text is not
+    # one; raises ValueError on bad options
+    command = choice[:4].upper()
+    if choice[:5].upper() in BULK_COMMANDS:
+        return create_bulk_request(choice[:5].upper(), request_id, choice[5:], session_options)
+    if command in ("STOR", "RETR"):
+        return create_transfer_request(command, request_id, choice[4:], session_options)
+    if command == "LIST" or choice[:2].upper() == "LS":
+        request = create_request("LIST", request_id)
+        request.update(parse_list_options(choice[4:] if command == "LIST" else choice[2:]))
+        return request
+    if command == "HASH":
+        return create_request("HASH", request_id, choice[4:].strip())
+    if choice[:6].upper() in ("PUTDIR", "GETDIR"):
+        return create_directory_request(choice[:6].upper(), request_id, choice[6:].strip(), session_options)
+    if command == "STAT":
+        return create_request("STAT", request_id)
+    if choice[:3].upper() == "DEL":
+        return create_request("DEL", request_id, choice[3:].strip())
+    return None
+
+def handle_client(soc, buffer_size, session_options):
     # Display all commands
     display_commands()
-    
+
+    # Bulk commands take ids from the same count for the transfers they expand into
+    request_ids = itertools.count(1)
     try:
-        choice = None
         while True:
-            choice = input("\nEnter a command: ")
-            if choice[:4].upper() == "STOR":
-                store_file_to_server(soc, buffer_size, choice[:4].upper(), choice[4:].strip(), quiet_mode)
-            elif choice[:4].upper() == "LIST" or choice[:2].upper() == "LS":
-                list_files_from_server(soc, choice.upper(), quiet_mode)
-            elif choice[:4].upper() == "RETR":
-                retrieve_file_from_server(soc, buffer_size, choice[:4].upper(), choice[4:].strip(), quiet_mode)
-            elif choice[:3].upper() == "DEL":
-                delete_file_from_server(soc, buffer_size, choice[:3].upper(), choice[3:].strip(), quiet_mode)
-            elif choice[:4].upper() == "SHOW" or choice[:7].upper() == "DISPLAY":
-                display_commands()
-            elif choice[:5].upper() == "CLEAR":
-                clear_terminal()
-            elif choice[:4].upper() == "QUIT" or choice[:4].upper() == "EXIT" or choice[:3].upper() == "BYE":
+            requests = []
+            quit_requested = False
+            # Commands on one line are pipelined; local commands run right away
+            for choice in input("\nEnter a command: ").split(";"):
+                choice = choice.strip()
+                request_id = next(request_ids)
+                if choice[:4].upper() == "SHOW" or choice[:7].upper() == "DISPLAY":
+                    display_commands()
+                    continue
+                elif choice[:5].upper() == "CLEAR":
+                    clear_terminal()
+                    continue
+                elif choice[:4].upper() == "QUIT" or choice[:4].upper() == "EXIT" or choice[:3].upper() == "BYE":
+                    quit_requested = True
+                    break
+
+                try:
+                    request = create_command_request(choice, request_id, session_options)
+                except ValueError as e:
+                    print(f"Error: {e}")
+                    continue
+                if request is None:
+                    print(f"Command '{choice}' not recognized, try again.")
+                elif request["command"] == "DEL" and not confirm_deletion(request["file_name"]):
+                    print("Delete abandoned by user!")
+                else:
+                    requests.append(request)
+
+            if requests:
+                run_commands(soc, buffer_size, requests, request_ids)
+            if quit_requested:
                 print("Client shutting down...")
-                close_connection(soc, choice.upper(), buffer_size)
+                close_connection(soc, next(request_ids))
                 break
-            else:
-                print("Command not recognized, try again.")
     except KeyboardInterrupt:
         print("\nClient interrupted by user.")
-        if(choice is not None):
-            close_connection(soc, choice.upper(), buffer_size)
+        close_connection(soc, next(request_ids))
         exit(1)
     except Exception as e:
         print(f"\nUnexpected error: {e}")
-        if(choice is not None):
-            close_connection(soc, choice.upper(), buffer_size)
+        close_connection(soc, next(request_ids))
         exit(1)
     return
 
@@ -422,12 +1982,16 @@ def main():
     correct_usage_parameters_message()
 
     # Create socket connection
-    soc, buffer_size, quiet_mode = create_socket_connection()
-        
+    soc, buffer_size, quiet_mode, options = create_socket_connection()
+
     print("\nWelcome to FTP Server!\n")
+    configure_logging(quiet_mode)
 
-    # Handle client requests
-    handle_client(soc, buffer_size, quiet_mode)
+    try:
+        # Handle client requests
+        handle_client(soc, buffer_size, options)
+    finally:
+        LOGGING["listener"].stop()
     return
 
 if __name__ == "__main__":
@@ -1,6 +1,88 @@
-import socket, struct, sys, os, time
+import hashlib, json, logging, logging.handlers, queue, socket, struct, sys, os, time
 from sys import argv
 
+# Results and errors of commands go through this logger; a background thread writes them out
+LOG = logging.getLogger("ftp.client")
+# -n shows every result, -q only warnings and errors
+LOG_LEVELS = {"-n": logging.INFO, "-q": logging.WARNING}
+# Results read like the rest of the console, without a timestamp or level
+LOG_FORMAT = "%(message)s"
+LOGGING = {"listener": None, "records": None}
+
+# STOR, RETR and DEL go out as one request datagram: the command, a newline, a REQUEST_HEADER of the transfer id the
+# client picked and the size and chunk size of the file to store (0 otherwise), then the file name. The server
+# answers with a REPLY_HEADER of the id, 1 to go ahead or 0 if the file cannot be stored, found or deleted, and the
+# size and chunk size of a file to retrieve. TRANSFER_DETAILS close the request: the id, the seconds elapsed and the
+# Merkle root of the bytes that went through, zeros after DEL. A request left without an answer is sent again, and
+# the server answers a request it already carried out with the datagrams it answered it with
+REQUEST_HEADER = struct.Struct("!IQI")
+REPLY_HEADER = struct.Struct("!cIBQI")
+TRANSFER_DETAILS = struct.Struct("!cId32s")
+# Both ends hash the content as it goes by, as a Merkle tree over chunks of this size like the TCP server does
+MERKLE_CHUNK_SIZE = 1024 * 1024
+# Every LIST datagram starts with one of these markers; the END datagram carries the totals and closes the listing
+LIST_PAGE_MARKER = b"PAGE\n"
+LIST_END_MARKER = b"END\n"
+# Largest UDP payload, so a listing page fits whatever buffer size the server was started with
+MAX_DATAGRAM_SIZE = 65535
+# Seconds to wait for the next listing page before giving up on the rest
+LIST_TIMEOUT = 5
+
+# STOR and RETR data moves as numbered chunks, each datagram a DATA_HEADER of kind, transfer id, sequence number and
+# file offset ahead of at most BUFFER_SIZE - DATA_HEADER.size bytes. Every data datagram is answered with an
+# ACK_HEADER: the transfer id, the number of chunks received in order, the sequence number that prompted it, and a
+# bitmap of the chunks received past the first missing one. Kinds are control bytes, so a late datagram is never
+# taken for a command, and the id tells datagrams left over from an earlier transfer from those of the current one
+DATA_HEADER = struct.Struct("!cIIQ")
+ACK_HEADER = struct.Struct("!cIIIQ")
+DATA_KIND = b"\x01"
+ACK_KIND = b"\x02"
+REPLY_KIND = b"\x03"
+DETAILS_KIND = b"\x04"
+KINDS = (DATA_KIND, ACK_KIND, REPLY_KIND, DETAILS_KIND)
+# Every datagram of a kind carries the transfer id right after it
+TRANSFER_ID = struct.Struct("!I")
+SACK_BITS = 64
+# Chunks in flight: the window starts small, doubles per round trip up to the threshold, then grows by one chunk
+# per round trip up to WINDOW_SIZE; a loss halves it and a timeout takes it back to MIN_WINDOW
+WINDOW_SIZE = SACK_BITS
+INITIAL_WINDOW = 4
+MIN_WINDOW = 1
+# A chunk is sent again once this many chunks past it were acknowledged, or when the retransmission timer of the
+# first unacknowledged one runs out. The timer follows the measured round trip time as in RFC 6298, with bounds
+# suited to a LAN, and doubles on every timeout; the transfer fails after MAX_TIMEOUTS timeouts in a row
+DUPLICATE_THRESHOLD = 3
+INITIAL_RTO = 1.0
+MIN_RTO = 0.05
+MAX_RTO = 4.0
+MAX_TIMEOUTS = 8
+# Seconds a receiver waits for the next data datagram before giving up on the transfer
+RECEIVE_TIMEOUT = 10
+# Seconds to wait for an answer to a request before sending it again, and how many times it is sent again
+CONTROL_TIMEOUT = 1.0
+CONTROL_RETRIES = 5
+# Kernel socket buffers asked for, so a full window fits; Linux caps them at net.core.rmem_max and wmem_max
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+# Downloads are received into <name>.ftp-part and only take the place of the file once the roots match
+PARTIAL_SUFFIX = ".ftp-part"
+
+def configure_logging(quiet_mode):
+    # Records below the level are dropped before they are built, so quiet mode costs nothing
+    LOGGING["records"] = queue.Queue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    LOG.handlers = [logging.handlers.QueueHandler(LOGGING["records"])]
+    LOG.setLevel(LOG_LEVELS.get(quiet_mode, logging.INFO))
+    LOG.propagate = False
+    LOGGING["listener"] = logging.handlers.QueueListener(LOGGING["records"], handler)
+    LOGGING["listener"].start()
+    return
+
+def flush_log():
+    # Wait until every queued record is written, so results never show up after the next prompt
+    LOGGING["records"].join()
+    return
+
 def correct_usage_parameters_message():
     if len(argv) != 5:
         print("Usage: python3 client-udp.py <IP> <PORT> <BUFFER_SIZE> [-q <quiet_mode> -n <not_quiet_mode>]")
@@ -12,9 +94,12 @@ def create_socket():
         UDP_PORT = int(argv[2])
         BUFFER_SIZE = int(argv[3])
         QUIET_MODE = argv[4]
-        server_address = (UDP_IP, UDP_PORT)
+        # Resolved once: datagrams are matched against the server's address, and sendto skips the lookup
+        server_address = (socket.gethostbyname(UDP_IP), UDP_PORT)
 
         soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        soc.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        soc.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
         print("Connection successful!")
 
     except socket.error as e:
@@ -37,117 +122,382 @@ def create_socket():
         exit(1)
     return soc, server_address, BUFFER_SIZE, QUIET_MODE
 
-def store_file_to_server(soc, server_addr, buffer_size, command, file_name, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
+def create_chunk_tree():
+    # Chunk digests of a stream of bytes, filled in as the bytes go by
+    return {"leaves": [], "chunk": hashlib.sha256(), "filled": 0}
 
-    if not os.path.exists(file_name):
-        print("\nFile does not exist.")
+def update_chunk_tree(tree, view):
+    view = memoryview(view)
+    while view:
+        size = min(len(view), MERKLE_CHUNK_SIZE - tree["filled"])
+        tree["chunk"].update(view[:size])
+        tree["filled"] += size
+        view = view[size:]
+        if tree["filled"] == MERKLE_CHUNK_SIZE:
+            tree["leaves"].append(tree["chunk"].digest())
+            tree["chunk"] = hashlib.sha256()
+            tree["filled"] = 0
+    return
+
+def merkle_root(tree):
+    # Root over every chunk digest, the last chunk possibly short: pairs of digests hash into their parent until
+    # one is left, an odd digest out moving up as it is
+    level = tree["leaves"] + ([tree["chunk"].digest()] if tree["filled"] or not tree["leaves"] else [])
+    while len(level) > 1:
+        level = [hashlib.sha256(level[index] + level[index + 1]).digest() if index + 1 < len(level) else level[index]
+                 for index in range(0, len(level), 2)]
+    return level[0]
+
+def write_all(output_file, view):
+    # Unbuffered file writes may be partial
+    while view:
+        written = output_file.write(view)
+        view = view[written:]
+    return
+
+def preallocate_file(output_file, file_size):
+    # Reserve every block up front so the file is laid out in one piece instead of growing chunk by chunk
+    if file_size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(output_file.fileno(), 0, file_size)
+        except OSError:
+            # Not every file system supports it; the writes work without it
+            pass
+    return
+
+def read_at(input_file, offset, size):
+    input_file.seek(offset)
+    return input_file.read(size)
+
+def new_transfer_id():
+    # Random, so a new transfer is unlikely to take a datagram of an earlier one for its own
+    return int.from_bytes(os.urandom(TRANSFER_ID.size), "big")
+
+def transfer_of(data):
+    # The transfer id of a DATA, ACK, REPLY or DETAILS datagram, None for a datagram of no transfer
+    if data[:1] not in KINDS or len(data) < 1 + TRANSFER_ID.size:
+        return None
+    return TRANSFER_ID.unpack_from(data, 1)[0]
+
+def send_reliable(soc, addr, read_chunk, file_size, chunk_size, transfer_id, tree=None, request=None, reply=None):
+    # Send file_size bytes, read with read_chunk(offset, size), as numbered chunks over a sliding window, and hash
+    # them into tree on their first sending. Returns the transfer figures along with the details of the transfer, or
+    # the first datagram from the peer that belongs to no transfer, which ends it: the receiver only speaks otherwise
+    # once done. The request the transfer answers, should it come again, gets the reply again
+    total = -(-file_size // chunk_size)
+    # sequence number -> time of the latest sending, and how many times it was sent, for chunks not yet acknowledged
+    sent_at = {}
+    sendings = {}
+    sacked = set()
+    base = next_sequence = 0
+    window, threshold = INITIAL_WINDOW, WINDOW_SIZE
+    # No window cut for losses among the chunks in flight when the window was last cut
+    recovery = 0
+    srtt, rttvar, rto = None, 0.0, INITIAL_RTO
+    timeouts = 0
+    figures = {"retransmissions": 0, "bytes_sent": 0, "srtt": 0.0, "reply": None}
+    buffer = bytearray(MAX_DATAGRAM_SIZE)
+
+    def send_chunk(sequence):
+        offset = sequence * chunk_size
+        chunk = read_chunk(offset, min(chunk_size, file_size - offset))
+        if len(chunk) != min(chunk_size, file_size - offset):
+            raise OSError("the file shrank while being sent")
+        if sequence in sendings:
+            figures["retransmissions"] += 1
+        elif tree is not None:
+            update_chunk_tree(tree, chunk)
+        header = DATA_HEADER.pack(DATA_KIND, transfer_id, sequence, offset)
+        figures["bytes_sent"] += soc.sendto(b"".join((header, chunk)), addr)
+        sent_at[sequence] = time.monotonic()
+        sendings[sequence] = sendings.get(sequence, 0) + 1
         return
 
+    previous_timeout = soc.gettimeout()
     try:
-        soc.sendto(command.encode('utf-8'), server_addr)
-        soc.sendto(file_name.encode('utf-8'), server_addr)
-        response, _ = soc.recvfrom(buffer_size)
-        if response != b"1":
-            print("\nError: Server did not acknowledge file name.")
-            return
+        while base < total:
+            while next_sequence < min(total, base + int(window)):
+                send_chunk(next_sequence)
+                next_sequence += 1
+            try:
+                soc.settimeout(max(sent_at[base] + rto - time.monotonic(), 0.001))
+                size, peer = soc.recvfrom_into(buffer)
+            except socket.timeout:
+                timeouts += 1
+                if timeouts > MAX_TIMEOUTS:
+                    raise socket.timeout(f"no acknowledgement after {MAX_TIMEOUTS} retransmissions")
+                rto = min(rto * 2, MAX_RTO)
+                threshold, window = max(int(window) // 2, MIN_WINDOW), MIN_WINDOW
+                recovery = next_sequence
+                send_chunk(base)
+                continue
+            if peer != addr:
+                continue
+            if buffer[:1] != ACK_KIND or size < ACK_HEADER.size:
+                data = bytes(buffer[:size])
+                if request is not None and data == request:
+                    # The reply to the request was lost
+                    soc.sendto(reply, addr)
+                    continue
+                transfer = transfer_of(data)
+                if transfer is not None and (data[:1] != DETAILS_KIND or transfer != transfer_id):
+                    # A reply sent again, or a datagram of an earlier transfer
+                    continue
+                figures["reply"] = data
+                break
+            _, acked_id, received, echoed, bitmap = ACK_HEADER.unpack_from(buffer)
+            if acked_id != transfer_id or received > next_sequence:
+                # Left over from an earlier transfer, or acknowledging chunks never sent
+                continue
+
+            # Karn's rule: a chunk sent more than once does not tell which sending was acknowledged
+            if sendings.get(echoed) == 1:
+                sample = time.monotonic() - sent_at[echoed]
+                if srtt is None:
+                    srtt, rttvar = sample, sample / 2
+                else:
+                    rttvar = 0.75 * rttvar + 0.25 * abs(srtt - sample)
+                    srtt = 0.875 * srtt + 0.125 * sample
+                rto = min(max(srtt + 4 * rttvar, MIN_RTO), MAX_RTO)
+            if received > base:
+                for sequence in range(base, received):
+                    del sent_at[sequence], sendings[sequence]
+                    sacked.discard(sequence)
+                window += received - base if window < threshold else (received - base) / window
+                window = min(window, WINDOW_SIZE)
+                base = received
+                timeouts = 0
+            early = (received + 1 + bit for bit in range(SACK_BITS) if bitmap >> bit & 1)
+            sacked.update(sequence for sequence in early if base <= sequence < next_sequence)
+
+            # Holes with enough chunks acknowledged past them are resent, at most once per round trip
+            if sacked:
+                now = time.monotonic()
+                last = min(max(sacked) - DUPLICATE_THRESHOLD + 1, next_sequence)
+                lost = [sequence for sequence in range(base, last)
+                        if sequence not in sacked and now - sent_at[sequence] > (srtt or rto)]
+                if lost and base >= recovery:
+                    threshold = window = max(int(window) // 2, MIN_WINDOW)
+                    recovery = next_sequence
+                for sequence in lost:
+                    send_chunk(sequence)
+    finally:
+        soc.settimeout(previous_timeout)
+    figures["srtt"] = srtt or 0.0
+    return figures
+
+def acknowledgement(transfer_id, received, echoed, early):
+    bitmap = 0
+    for sequence in early:
+        if sequence - received - 1 < SACK_BITS:
+            bitmap |= 1 << (sequence - received - 1)
+    return ACK_HEADER.pack(ACK_KIND, transfer_id, received, echoed, bitmap)
+
+def receive_reliable(soc, output_file, file_size, chunk_size, tree, transfer_id, request=None, reply=None):
+    # Write the chunks at their offsets as they arrive and acknowledge every one, hashing them into tree in order.
+    # Only chunks cut as the sender announced, chunk_size bytes at sequence * chunk_size, are taken.
+    # Chunks that arrive ahead of a missing one are kept until it comes, at most a window of them. Returns the
+    # sender's address, None for an empty file, and the figures of the transfer, with the last acknowledgement sent.
+    # The request the transfer answers, should it come again, gets the reply again
+    received = received_bytes = 0
+    early = {}
+    addr = None
+    figures = {"duplicates": 0, "bytes_received": 0, "ack": acknowledgement(transfer_id, 0, 0, ())}
+    buffer = bytearray(MAX_DATAGRAM_SIZE)
+    view = memoryview(buffer)
+
+    previous_timeout = soc.gettimeout()
+    soc.settimeout(RECEIVE_TIMEOUT)
+    try:
+        while received_bytes < file_size:
+            size, addr = soc.recvfrom_into(buffer)
+            if buffer[:1] != DATA_KIND or size < DATA_HEADER.size:
+                if request is not None and buffer[:size] == request:
+                    # The reply to the request was lost
+                    soc.sendto(reply, addr)
+                continue
+            _, data_id, sequence, offset = DATA_HEADER.unpack_from(buffer)
+            if data_id != transfer_id:
+                # Left over from an earlier transfer
+                continue
+            chunk = view[DATA_HEADER.size:size]
+            if offset != sequence * chunk_size or not 0 < len(chunk) == min(chunk_size, file_size - offset):
+                # Not a chunk of this file: it would land at the wrong place or past the end
+                continue
+            figures["bytes_received"] += len(chunk)
+            if sequence == received:
+                output_file.seek(offset)
+                write_all(output_file, chunk)
+                update_chunk_tree(tree, chunk)
+                received, received_bytes = received + 1, received_bytes + len(chunk)
+                while received in early:
+                    chunk = early.pop(received)
+                    update_chunk_tree(tree, chunk)
+                    received, received_bytes = received + 1, received_bytes + len(chunk)
+            elif sequence > received and sequence not in early and sequence - received <= WINDOW_SIZE:
+                output_file.seek(offset)
+                write_all(output_file, chunk)
+                early[sequence] = bytes(chunk)
+            else:
+                figures["duplicates"] += 1
+            figures["ack"] = acknowledgement(transfer_id, received, sequence, early)
+            soc.sendto(figures["ack"], addr)
+    finally:
+        soc.settimeout(previous_timeout)
+    return addr, figures
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return
 
+def create_request(command, transfer_id, file_name, file_size=0, chunk_size=0):
+    return b"".join((command.encode('utf-8'), b"\n", REQUEST_HEADER.pack(transfer_id, file_size, chunk_size),
+                     file_name.encode('utf-8')))
+
+def await_answer(soc, server_addr, request, transfer_id, kind, ack=None):
+    # The REPLY or DETAILS datagram of the transfer, sending the request again each time CONTROL_TIMEOUT passes
+    # without it. Datagrams of other kinds or transfers are skipped, and while downloading, chunks sent again because
+    # the last acknowledgement was lost are acknowledged once more: the server is still there
+    previous_timeout = soc.gettimeout()
+    retries = 0
+    deadline = time.monotonic() + CONTROL_TIMEOUT
+    try:
+        while True:
+            soc.settimeout(max(deadline - time.monotonic(), 0.001))
+            try:
+                data, addr = soc.recvfrom(MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                retries += 1
+                if retries > CONTROL_RETRIES:
+                    raise socket.timeout(f"no answer from the server after {CONTROL_RETRIES} retries")
+                soc.sendto(request, server_addr)
+                deadline = time.monotonic() + CONTROL_TIMEOUT
+                continue
+            if transfer_of(data) != transfer_id:
+                continue
+            if data[:1] == kind:
+                return data
+            if data[:1] == DATA_KIND and ack is not None:
+                soc.sendto(ack, addr)
+                deadline = time.monotonic() + CONTROL_TIMEOUT
+    finally:
+        soc.settimeout(previous_timeout)
+
+def store_file_to_server(soc, server_addr, buffer_size, command, file_name):
+    if not os.path.exists(file_name):
+        LOG.warning("\nFile does not exist.")
+        return
+
+    try:
         file_size = os.path.getsize(file_name)
-        soc.sendto(struct.pack("i", file_size), server_addr)
+        transfer_id = new_transfer_id()
+        chunk_size = buffer_size - DATA_HEADER.size
+        request = create_request(command, transfer_id, file_name, file_size, chunk_size)
+        soc.sendto(request, server_addr)
+        _, _, ok, _, _ = REPLY_HEADER.unpack(await_answer(soc, server_addr, request, transfer_id, REPLY_KIND))
+        if not ok:
+            LOG.error("\nError: Server could not store the file.")
+            return
 
+        # Hashed as it is sent, to compare with the root of what the server wrote
+        tree = create_chunk_tree()
         with open(file_name, "rb") as f:
-            bytes_sent = 0
-            while bytes_sent < file_size:
-                data = f.read(buffer_size)
-                soc.sendto(data, server_addr)
-                bytes_sent += len(data)
-        print("\n\tFile stored successfully.")
+            figures = send_reliable(soc, server_addr, lambda offset, size: read_at(f, offset, size), file_size,
+                                    chunk_size, transfer_id, tree)
+        LOG.info("\n\tFile stored successfully.")
     except Exception as e:
-        print(f"\nError storing file: {e}")
+        LOG.error(f"\nError storing file: {e}")
         return
 
     try:
-        # Get performance details from server
-        time_elapsed = struct.unpack("f", soc.recv(4))[0]
-        print(f"\nTime elapsed: {time_elapsed}s\nFile size: {file_size} bytes")
+        # Get performance details from server; the server may have sent them before its last acknowledgements came
+        details = figures["reply"]
+        if details is None or details[:1] != DETAILS_KIND:
+            details = await_answer(soc, server_addr, request, transfer_id, DETAILS_KIND)
+        _, _, time_elapsed, root = TRANSFER_DETAILS.unpack(details)
+        LOG.info(f"\nTime elapsed: {time_elapsed}s\nFile size: {file_size} bytes")
+        LOG.info(f"Retransmissions: {figures['retransmissions']}, smoothed RTT: {figures['srtt'] * 1000:.3f} ms")
+        if root != merkle_root(tree):
+            LOG.error("\nIntegrity check failed: the file was damaged in transit.")
     except Exception as e:
-        print(f"\nError retrieving performance details: {e}")
-    finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        LOG.error(f"\nError retrieving performance details: {e}")
     return
 
-def retrieve_file_from_server(soc, server_addr, buffer_size, command, file_name, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-
+def retrieve_file_from_server(soc, server_addr, buffer_size, command, file_name):
+    partial_name = file_name + PARTIAL_SUFFIX
     try:
-        soc.sendto(command.encode('utf-8'), server_addr)
-        soc.sendto(file_name.encode('utf-8'), server_addr)
-        response, _ = soc.recvfrom(buffer_size)
-        if response != b"1":
-            print("\nError: File not found on server.")
+        transfer_id = new_transfer_id()
+        request = create_request(command, transfer_id, file_name)
+        soc.sendto(request, server_addr)
+        answer = await_answer(soc, server_addr, request, transfer_id, REPLY_KIND)
+        _, _, ok, file_size, chunk_size = REPLY_HEADER.unpack(answer)
+        if not ok:
+            LOG.warning("\nError: File not found on server.")
             return
 
-        file_size, _ = soc.recvfrom(4)
-        file_size = struct.unpack("i", file_size)[0]
-
-        with open(file_name, "wb") as f:
-            bytes_received = 0
-            while bytes_received < file_size:
-                data, _ = soc.recvfrom(buffer_size)
-                f.write(data)
-                bytes_received += len(data)
-        print(f"\n\tSuccessfully downloaded {file_name}")
+        # Unbuffered file, each chunk written at its offset as it arrives; the old file stays until the new one
+        # is known to be whole
+        with open(partial_name, "wb", buffering=0) as f:
+            preallocate_file(f, file_size)
+            tree = create_chunk_tree()
+            _, figures = receive_reliable(soc, f, file_size, chunk_size, tree, transfer_id)
+    except socket.timeout:
+        LOG.error("\nError retrieving file: timed out waiting for the server.")
+        remove_if_exists(partial_name)
+        return
     except Exception as e:
-        print(f"\nError retrieving file: {e}")
+        LOG.error(f"\nError retrieving file: {e}")
+        remove_if_exists(partial_name)
         return
     
     try:
-        # Get performance details from server
-        time_elapsed = struct.unpack("f", soc.recv(4))[0]
-        print(f"\nTime elapsed: {time_elapsed}s\nFile size: {file_size} bytes")
+        # Get performance details from server, acknowledging again whatever it sends before them
+        details = await_answer(soc, server_addr, request, transfer_id, DETAILS_KIND, figures["ack"])
+        _, _, time_elapsed, root = TRANSFER_DETAILS.unpack(details)
+        if root != merkle_root(tree):
+            LOG.error("\nIntegrity check failed: the file was damaged in transit.")
+            remove_if_exists(partial_name)
+            return
+        os.replace(partial_name, file_name)
+        LOG.info(f"\n\tSuccessfully downloaded {file_name}")
+        LOG.info(f"\nTime elapsed: {time_elapsed}s\nFile size: {file_size} bytes")
+        LOG.info(f"Duplicate datagrams: {figures['duplicates']}")
     except Exception as e:
-        print(f"\nError retrieving performance details: {e}")
-    finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        LOG.error(f"\nError retrieving performance details: {e}")
+        remove_if_exists(partial_name)
     return
 
-def list_files_from_server(soc, server_addr, buffer_size, command, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-
+def list_files_from_server(soc, server_addr, buffer_size, command):
+    previous_timeout = soc.gettimeout()
     try:
         soc.sendto(command.encode('utf-8'), server_addr)
-        data, _ = soc.recvfrom(buffer_size)
-        print("\nFiles on server:\n")
-        print(data.decode('utf-8'))
+        soc.settimeout(LIST_TIMEOUT)
+        LOG.info("\nFiles on server:\n")
+        # Pages are printed as they arrive, until the END datagram with the totals
+        while True:
+            data, _ = soc.recvfrom(MAX_DATAGRAM_SIZE)
+            if data.startswith(LIST_END_MARKER):
+                LOG.info(data[len(LIST_END_MARKER):].decode('utf-8'))
+                break
+            if data.startswith(LIST_PAGE_MARKER):
+                # Pages end with a newline of their own
+                LOG.info(data[len(LIST_PAGE_MARKER):].decode('utf-8', 'replace').rstrip("\n"))
+    except socket.timeout:
+        LOG.warning("\nListing incomplete: timed out waiting for the server.")
     except Exception as e:
-        print(f"\nError listing files: {e}")
+        LOG.error(f"\nError listing files: {e}")
         return
     finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        soc.settimeout(previous_timeout)
     return
 
-def delete_file_from_server(soc, server_addr, buffer_size, command, file_name, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-
+def delete_file_from_server(soc, server_addr, buffer_size, command, file_name):
     try:
         # Confirm if user wants to delete file
+        flush_log()
         confirm_delete = input(f"\nAre you sure you want to delete '{file_name}'? (Y/N)\nCommand: ").upper()
         while confirm_delete not in ["Y", "y", "N", "n", "YES", "Yes", "yes", "NO", "No", "no"]:
             print("Command not recognized, try again")
@@ -156,46 +506,72 @@ def delete_file_from_server(soc, server_addr, buffer_size, command, file_name, q
         print("\nAction interrupted by user.")
         return
     except Exception as e:
-        print(f"\nUnexpected error while confirming deletion status: {e}")
+        LOG.error(f"\nUnexpected error while confirming deletion status: {e}")
         return
 
     try:
-        soc.sendto(command.encode('utf-8'), server_addr)
-        soc.sendto(file_name.encode('utf-8'), server_addr)
-        response, _ = soc.recvfrom(buffer_size)
-        if response == b"1":
-            print("\n\tFile deleted successfully.")
+        transfer_id = new_transfer_id()
+        request = create_request(command, transfer_id, file_name)
+        soc.sendto(request, server_addr)
+        _, _, ok, _, _ = REPLY_HEADER.unpack(await_answer(soc, server_addr, request, transfer_id, REPLY_KIND))
+        if ok:
+            LOG.info("\n\tFile deleted successfully.")
         else:
-            print("\nError: File not found on server.")
+            LOG.error("\nError: File not found on server.")
             return
     except Exception as e:
-        print(f"\nError deleting file: {e}")
+        LOG.error(f"\nError deleting file: {e}")
         return
     
     try:
         # Get performance details from server
-        time_elapsed = struct.unpack("f", soc.recv(4))[0]
-        print(f"\nTime elapsed: {time_elapsed}s")
+        details = await_answer(soc, server_addr, request, transfer_id, DETAILS_KIND)
+        time_elapsed = TRANSFER_DETAILS.unpack(details)[2]
+        LOG.info(f"\nTime elapsed: {time_elapsed}s")
+    except Exception as e:
+        LOG.error(f"\nError retrieving performance details: {e}")
+    return
+
+def show_statistics(soc, server_addr, command):
+    previous_timeout = soc.gettimeout()
+    try:
+        soc.sendto(command.encode('utf-8'), server_addr)
+        soc.settimeout(LIST_TIMEOUT)
+        data, _ = soc.recvfrom(MAX_DATAGRAM_SIZE)
+        snapshot = json.loads(data)
+        stats = snapshot["stats"]
+        LOG.info(f"\n\tStatistics of server {snapshot['pid']}, up {snapshot['uptime']:.0f}s")
+        LOG.info(f"\tCommands: {stats['commands']}, errors: {stats['errors']}")
+        LOG.info(f"\tBytes in: {stats['bytes_in']}, bytes out: {stats['bytes_out']}")
+        LOG.info(f"\tCache: {stats['cache_hits']} hits, {stats['cache_misses']} misses, "
+                 f"{stats['cache_evictions']} evictions, {stats['cache_bytes']} bytes")
+        LOG.info(f"\n\t{'Command':<10}{'Count':>8}{'Errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for name, entry in sorted(snapshot["commands"].items()):
+            LOG.info(f"\t{name:<10}{entry['count']:>8}{entry['errors']:>8}{entry['p50'] * 1000:>10.2f}"
+                     f"{entry['p95'] * 1000:>10.2f}{entry['p99'] * 1000:>10.2f}")
+    except socket.timeout:
+        LOG.error("\nTimed out waiting for the server's statistics.")
     except Exception as e:
-        print(f"\nError retrieving performance details: {e}")
+        LOG.error(f"\nError retrieving statistics: {e}")
     finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        soc.settimeout(previous_timeout)
     return
 
 def close_socket(soc, buffer_size, server_addr, command):
     try:
         soc.sendto(command.encode('utf-8'), server_addr)
-        # Wait for server go-ahead
-        soc.recv(buffer_size)
+        # Wait for server go-ahead, though not forever: the client closes either way
+        soc.settimeout(CONTROL_TIMEOUT * CONTROL_RETRIES)
+        try:
+            soc.recv(buffer_size)
+        except socket.timeout:
+            LOG.warning("\nThe server did not confirm closing.")
         soc.close()
-        print("Client closed successfully.")
+        LOG.info("Client closed successfully.")
     except BrokenPipeError:
-        print("\nClient socket not started or already closed.")
+        LOG.info("\nClient socket not started or already closed.")
     except(OSError, socket.error):
-        print("\nError closing server socket.")
+        LOG.error("\nError closing server socket.")
     return
 
 def clear_terminal():
@@ -209,28 +585,32 @@ def display_commands():
     print("\tRETR filename       : Download file")
     print("\tDEL filename        : Delete file")
     print("\tLIST/LS             : List all files")
+    print("\tSTAT                : Show the server's counters and command latencies")
     print("\tSHOW/DISPLAY        : Display all commands")
     print("\tCLEAR               : Clear terminal")
     print("\tQUIT/EXIT/BYE       : Exit")
     return
 
-def handle_client(soc, server_addr, buffer_size, quiet_mode):
+def handle_client(soc, server_addr, buffer_size):
     # Display all commands
     display_commands()
 
     try:
         choice = None
         while True:
+            flush_log()
             choice = input("\nEnter your command: ")
 
             if choice[:4].upper() == 'STOR':
-                store_file_to_server(soc, server_addr, buffer_size, choice[:4], choice[4:].strip(), quiet_mode)
+                store_file_to_server(soc, server_addr, buffer_size, choice[:4], choice[4:].strip())
             elif choice[:4].upper() == 'RETR':
-                retrieve_file_from_server(soc, server_addr, buffer_size, choice[:4], choice[4:].strip(), quiet_mode)
+                retrieve_file_from_server(soc, server_addr, buffer_size, choice[:4], choice[4:].strip())
             elif choice[:3].upper() == 'DEL':
-                delete_file_from_server(soc, server_addr, buffer_size, choice[:3], choice[3:].strip(), quiet_mode)
+                delete_file_from_server(soc, server_addr, buffer_size, choice[:3], choice[3:].strip())
             elif choice[:4].upper() == 'LIST' or choice[:2].upper() == 'LS':
-                list_files_from_server(soc, server_addr, buffer_size, choice, quiet_mode)
+                list_files_from_server(soc, server_addr, buffer_size, choice)
+            elif choice[:4].upper() == 'STAT':
+                show_statistics(soc, server_addr, choice[:4])
             elif choice[:4].upper() == 'SHOW' or choice[:7].upper() == 'DISPLAY':
                 display_commands()
             elif choice[:5].upper() == 'CLEAR':
@@ -261,9 +641,13 @@ def main():
     soc, server_address, buffer_size, quiet_mode = create_socket()
 
     print("\nWelcome to FTP Server!")
-    
-    # Handle client requests
-    handle_client(soc, server_address, buffer_size, quiet_mode)
+    configure_logging(quiet_mode)
+
+    try:
+        # Handle client requests
+        handle_client(soc, server_address, buffer_size)
+    finally:
+        LOGGING["listener"].stop()
     return
 
 if __name__ == "__main__":
@@ -0,0 +1,454 @@
+import asyncio, contextlib, json, os, socket, struct, sys, time
+from sys import argv
+
+from ftp_client import PROTOCOL, STATUS_NAMES
+
+# asyncio client for fan-out jobs: many RETR and STOR transfers to and from several servers at once, all on one
+# event loop. Each server gets a pool of connections, one transfer at a time on each; a limit on transfers in
+# flight bounds the whole run; every transfer can have a timeout and can be cancelled like any task. Disk writes
+# and hashing go to the loop's thread pool, so the next buffer is received while the last one is written.
+#
+#   async with AsyncSession("127.0.0.1", 2121) as session:
+#       result = await session.retr("report.pdf")
+#
+#   results = asyncio.run(run_transfers([("10.0.0.1", 2121, "RETR", "a.bin", "a-1.bin"),
+#                                        ("10.0.0.2", 2121, "RETR", "a.bin", "a-2.bin")], concurrency=64))
+
+# Transfers in flight over all servers, and connections kept open to each server
+CONCURRENCY = 16
+SESSIONS_PER_SERVER = 4
+# Downloads fill a buffer of this size before it is handed to a thread to hash and write, while the other one
+# of a pair is received
+WRITE_BUFFER_SIZE = 1024 * 1024
+TRANSFER_COMMANDS = ("RETR", "STOR")
+
+def transfer_result(command, file_name, address, error=None, status=None, **figures):
+    # Same shape as the results of ftp_client.py, plus the server the transfer went to
+    result = {"command": command, "file_name": file_name, "server": f"{address[0]}:{address[1]}",
+              "ok": error is None, "error": error}
+    if status is not None:
+        result["status"] = STATUS_NAMES.get(status, status)
+    result.update(figures)
+    return result
+
+def read_partial(partial_name):
+    # Size of a partial download left from before and the digest of its last bytes, offered to resume from
+    try:
+        with open(partial_name, "rb") as partial:
+            offset = os.fstat(partial.fileno()).st_size
+            return offset, PROTOCOL.overlap_digest(partial, offset) if offset else bytes(32)
+    except FileNotFoundError:
+        return 0, bytes(32)
+
+def open_partial(partial_name, offset, file_size, journal_name):
+    # The partial download cut to the offset the server continues from, with the chunk digests of what it kept;
+    # downloads of more than one chunk journal them, so resuming does not read that part again
+    output_file = open(partial_name, "r+b" if offset else "wb", buffering=0)
+    try:
+        output_file.truncate(offset)
+        output_file.seek(offset)
+        tree = PROTOCOL.resume_chunk_tree(output_file.fileno(), offset,
+                                          journal_name if file_size > PROTOCOL.MERKLE_CHUNK_SIZE else None)
+    except OSError:
+        output_file.close()
+        raise
+    try:
+        PROTOCOL.preallocate_file(output_file, file_size)
+    except OSError:
+        close_partial(output_file, tree, journal_name, True)
+        raise
+    return output_file, tree
+
+def write_chunk(output_file, tree, view):
+    # Runs in the thread pool: hashing and writing one buffer while the event loop receives the next
+    PROTOCOL.update_chunk_tree(tree, view)
+    PROTOCOL.write_all(output_file, view)
+    return
+
+def close_partial(output_file, tree, journal_name, keep):
+    # Keep exactly what reached the disk, not the preallocated tail, and its journal, so the download can resume
+    # from there
+    PROTOCOL.close_tree_journal(tree)
+    if keep:
+        output_file.truncate()
+    else:
+        PROTOCOL.remove_if_exists(journal_name)
+    output_file.close()
+    return
+
+class AsyncSession:
+    # One connection to the server, opened on first use and again after a transfer failed or was cancelled
+    # halfway. Transfers on one session run one after the other; use several sessions to run them concurrently
+
+    def __init__(self, host, port):
+        self.address = (host, int(port))
+        self.soc = None
+        self.buffer_size = None
+        self.request_id = 0
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        soc.setblocking(False)
+        soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            await loop.sock_connect(soc, self.address)
+            self.soc = soc
+            opcode, _, _, _, payload_length = await self.recv_frame()
+            if opcode != PROTOCOL.OP_HELLO:
+                raise struct.error("the server did not greet with HELLO")
+            self.buffer_size, _ = PROTOCOL.HELLO_PAYLOAD.unpack(await self.recv_exact(payload_length))
+            # Content is transferred raw; the codecs would only cost this loop CPU time the others need
+            await self.send_frame(PROTOCOL.OP_HELLO, 0, [PROTOCOL.CLIENT_HELLO.pack(PROTOCOL.CODEC_NONE)])
+        except BaseException:
+            soc.close()
+            self.soc = None
+            raise
+        return
+
+    async def close(self):
+        # Say goodbye to the server if the connection is still in step; a broken one is just closed. Waits for
+        # a transfer still running on the session, such as one finishing its cleanup after being cancelled
+        async with self.lock:
+            if self.soc is None:
+                return
+            try:
+                await self.send_frame(PROTOCOL.OP_QUIT, self.next_request_id())
+                await asyncio.wait_for(self.recv_frame(), 5)
+            except (OSError, struct.error, asyncio.TimeoutError):
+                pass
+            finally:
+                self.abort()
+        return
+
+    def abort(self):
+        if self.soc is not None:
+            self.soc.close()
+            self.soc = None
+        return
+
+    def next_request_id(self):
+        self.request_id = self.request_id % 0xFFFFFFFF + 1
+        return self.request_id
+
+    async def recv_exact(self, size):
+        loop = asyncio.get_running_loop()
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            count = await loop.sock_recv_into(self.soc, view[received:])
+            if count == 0:
+                raise ConnectionError("Connection closed by server.")
+            received += count
+        return bytes(data)
+
+    async def recv_frame(self):
+        return PROTOCOL.FRAME_HEADER.unpack(await self.recv_exact(PROTOCOL.FRAME_HEADER.size))
+
+    async def send_frame(self, opcode, request_id, parts=(), data_length=0):
+        payload_length = sum(len(part) for part in parts) + data_length
+        header = PROTOCOL.FRAME_HEADER.pack(opcode, PROTOCOL.STATUS_OK, 0, request_id, payload_length)
+        await asyncio.get_running_loop().sock_sendall(self.soc, b"".join([header, *parts]))
+        return
+
+    async def recv_response(self, request_id):
+        opcode, status, flags, response_id, payload_length = await self.recv_frame()
+        if response_id != request_id:
+            raise struct.error(f"response to request {response_id} while waiting for {request_id}")
+        return status, flags, payload_length
+
+    async def discard_payload(self, size):
+        while size:
+            size -= len(await self.recv_exact(min(size, self.buffer_size)))
+        return
+
+    async def retr(self, file_name, local_name=None):
+        # Downloads file_name into local_name (file_name by default), resuming a partial download of it
+        return await self.transfer("RETR", file_name, local_name or file_name)
+
+    async def stor(self, file_name, local_name=None):
+        # Uploads local_name (file_name by default) to the server as file_name
+        return await self.transfer("STOR", file_name, local_name or file_name)
+
+    async def transfer(self, command, file_name, local_name):
+        # A transfer that fails or is cancelled midway leaves the stream out of step, so the connection is dropped
+        # and the next transfer starts on a new one; a cancelled transfer raises CancelledError as usual
+        async with self.lock:
+            start_time = time.time()
+            try:
+                if self.soc is None:
+                    await self.connect()
+                if command == "RETR":
+                    return await self.receive_file(file_name, local_name, start_time)
+                return await self.send_file(file_name, local_name, start_time)
+            except (OSError, struct.error) as e:
+                self.abort()
+                return transfer_result(command, file_name, self.address, f"Connection error: {e}")
+            except BaseException:
+                self.abort()
+                raise
+
+    async def receive_file(self, file_name, local_name, start_time):
+        loop = asyncio.get_running_loop()
+        partial_name = local_name + PROTOCOL.PARTIAL_SUFFIX
+        journal_name = local_name + PROTOCOL.TREE_SUFFIX
+        offset, digest = await loop.run_in_executor(None, read_partial, partial_name)
+        request_id = self.next_request_id()
+        await self.send_frame(PROTOCOL.OP_RETR, request_id, [PROTOCOL.RETR_REQUEST.pack(offset, digest),
+                                                             file_name.encode('utf-8')])
+        status, flags, payload_length = await self.recv_response(request_id)
+        if status != PROTOCOL.STATUS_OK:
+            await self.discard_payload(payload_length)
+            message = "File does not exist" if status == PROTOCOL.STATUS_NOT_FOUND else "Server could not send it"
+            return transfer_result("RETR", file_name, self.address, message, status)
+
+        # The server continues from the offset we hold, or from zero when our copy did not match
+        offset, root = PROTOCOL.RETR_RESPONSE.unpack(await self.recv_exact(PROTOCOL.RETR_RESPONSE.size))
+        remaining = payload_length - PROTOCOL.RETR_RESPONSE.size
+        output_file, tree = await loop.run_in_executor(None, open_partial, partial_name, offset, offset + remaining,
+                                                     journal_name)
+        buffers = [memoryview(bytearray(WRITE_BUFFER_SIZE)) for _ in range(2)]
+        pending_write = None
+        try:
+            received = 0
+            index = 0
+            while received < remaining:
+                # Fill one buffer from the socket while the thread pool writes out the other
+                view = buffers[index][:min(WRITE_BUFFER_SIZE, remaining - received)]
+                filled = 0
+                while filled < len(view):
+                    size = await loop.sock_recv_into(self.soc, view[filled:])
+                    if size == 0:
+                        raise ConnectionError("Connection closed by server.")
+                    filled += size
+                if pending_write is not None:
+                    await pending_write
+                pending_write = loop.run_in_executor(None, write_chunk, output_file, tree, view)
+                received += filled
+                index ^= 1
+            if pending_write is not None:
+                # An empty file, or nothing left to resume, never starts a write
+                await pending_write
+            pending_write = None
+            leaves = PROTOCOL.finish_chunk_tree(tree)
+            if flags & PROTOCOL.FLAG_TRAILER:
+                # Without cached digests the server hashed the file as it sent it; the root follows the content
+                root = await self.recv_root_trailer(request_id)
+            if root == bytes(32):
+                # The server could not hash its copy while sending it; it is asked to hash it now
+                root = await self.query_root(file_name)
+            verified = root == PROTOCOL.merkle_root(leaves)
+        except BaseException:
+            if pending_write is not None:
+                # The write in flight finishes before the file is cut, even when the transfer was cancelled
+                await asyncio.wait([pending_write])
+            await loop.run_in_executor(None, close_partial, output_file, tree, journal_name, True)
+            raise
+        await loop.run_in_executor(None, close_partial, output_file, tree, journal_name, False)
+        if not verified:
+            # Resuming from bytes that do not hash right would only repeat the mismatch
+            await loop.run_in_executor(None, os.remove, partial_name)
+            return transfer_result("RETR", file_name, self.address, "Download does not match the server's copy")
+        await loop.run_in_executor(None, os.replace, partial_name, local_name)
+        return transfer_result("RETR", file_name, self.address, size=offset + remaining,
+                               elapsed=time.time() - start_time, offset=offset)
+
+    async def recv_root_trailer(self, request_id):
+        status, _, payload_length = await self.recv_response(request_id)
+        payload = await self.recv_exact(payload_length)
+        if status != PROTOCOL.STATUS_OK:
+            return bytes(32)
+        return PROTOCOL.HASH_RESPONSE.unpack(payload)[0]
+
+    async def query_root(self, file_name):
+        request_id = self.next_request_id()
+        await self.send_frame(PROTOCOL.OP_HASH, request_id, [file_name.encode('utf-8')])
+        status, _, payload_length = await self.recv_response(request_id)
+        payload = await self.recv_exact(payload_length)
+        if status != PROTOCOL.STATUS_OK:
+            return None
+        return PROTOCOL.HASH_RESPONSE.unpack(payload)[0]
+
+    async def send_file(self, file_name, local_name, start_time):
+        loop = asyncio.get_running_loop()
+        try:
+            content = await loop.run_in_executor(None, open, local_name, "rb")
+        except OSError as e:
+            return transfer_result("STOR", file_name, self.address, f"Cannot read {local_name}: {e.strerror}")
+        with content:
+            file_size = os.fstat(content.fileno()).st_size
+            name = file_name.encode('utf-8')
+            request_id = self.next_request_id()
+            await self.send_frame(PROTOCOL.OP_STOR, request_id, [PROTOCOL.STOR_REQUEST.pack(0, len(name)), name],
+                                  file_size)
+            # The file goes out with sendfile range by range; the thread pool hashes each range once it is sent, from
+            # the page cache, while the next one goes out
+            tree = PROTOCOL.create_chunk_tree()
+            hashing = None
+            try:
+                sent = 0
+                while sent < file_size:
+                    size = min(PROTOCOL.SENDFILE_RANGE_SIZE, file_size - sent)
+                    # The frame announced file_size bytes: a file that shrank would leave it short
+                    if await loop.sock_sendfile(self.soc, content, sent, size) != size:
+                        raise OSError("file shrank while being sent")
+                    if hashing is not None:
+                        await hashing
+                    hashing = loop.run_in_executor(None, PROTOCOL.hash_range, content.fileno(), tree, sent,
+                                                   sent + size)
+                    sent += size
+                status, _, payload_length = await self.recv_response(request_id)
+                payload = await self.recv_exact(payload_length)
+                if hashing is not None:
+                    await hashing
+            except BaseException:
+                if hashing is not None:
+                    # The file stays open until the hash in flight is done, even when the transfer was cancelled
+                    await asyncio.wait([hashing])
+                raise
+            leaves = PROTOCOL.finish_chunk_tree(tree)
+        if status != PROTOCOL.STATUS_OK:
+            return transfer_result("STOR", file_name, self.address, "Server could not store it", status)
+        _, stored, root = PROTOCOL.STOR_RESPONSE.unpack(payload)
+        if root != PROTOCOL.merkle_root(leaves):
+            return transfer_result("STOR", file_name, self.address, "Stored copy does not match the local file")
+        return transfer_result("STOR", file_name, self.address, size=stored, elapsed=time.time() - start_time)
+
+class AsyncSessionPool:
+    # Up to size sessions to one server, connected when first needed and kept open between uses
+
+    def __init__(self, host, port, size=SESSIONS_PER_SERVER):
+        self.address = (host, int(port))
+        self.idle = []
+        self.sessions = []
+        self.available = asyncio.Semaphore(size)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        # async with pool.session() as session: ... hands the session back afterwards
+        async with self.available:
+            if self.idle:
+                session = self.idle.pop()
+            else:
+                session = AsyncSession(*self.address)
+                self.sessions.append(session)
+            try:
+                yield session
+            finally:
+                self.idle.append(session)
+
+    async def close(self):
+        await asyncio.gather(*(session.close() for session in self.sessions))
+        return
+
+async def run_transfers(transfers, concurrency=CONCURRENCY, per_server=SESSIONS_PER_SERVER, timeout=None,
+                        on_result=None):
+    # transfers: (host, port, "RETR" or "STOR", file name[, local name]) tuples. Returns one result per transfer,
+    # in order, and hands each to on_result as soon as it is done. Raises ValueError on an unknown command
+    transfers = [tuple(transfer) for transfer in transfers]
+    for transfer in transfers:
+        if transfer[2] not in TRANSFER_COMMANDS:
+            raise ValueError(f"command '{transfer[2]}' not recognized")
+    pools = {}
+    in_flight = asyncio.Semaphore(concurrency)
+
+    async def run_transfer(host, port, command, file_name, local_name=None):
+        address = (host, int(port))
+        if address not in pools:
+            pools[address] = AsyncSessionPool(host, port, per_server)
+        async with in_flight, pools[address].session() as session:
+            method = session.retr if command == "RETR" else session.stor
+            try:
+                result = await asyncio.wait_for(method(file_name, local_name), timeout)
+            except asyncio.TimeoutError:
+                result = transfer_result(command, file_name, address, f"Timed out after {timeout}s")
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    try:
+        return await asyncio.gather(*(run_transfer(*transfer) for transfer in transfers))
+    finally:
+        await asyncio.gather(*(pool.close() for pool in pools.values()))
+
+def read_transfers(transfers_file):
+    # One transfer per line: IP PORT RETR|STOR FILE [LOCAL_NAME]; blank lines and '#' comments skipped
+    for line in transfers_file:
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        if not 4 <= len(fields) <= 5:
+            raise ValueError(f"expected IP PORT COMMAND FILE [LOCAL_NAME], got '{line.strip()}'")
+        fields[1] = int(fields[1])
+        fields[2] = fields[2].upper()
+        yield tuple(fields)
+    return
+
+def parse_optional_arguments(arguments):
+    options = {"--concurrency": CONCURRENCY, "--per-server": SESSIONS_PER_SERVER, "--timeout": None}
+    for index in range(0, len(arguments), 2):
+        if arguments[index] not in options or index + 1 >= len(arguments):
+            raise NameError(f"unknown or incomplete option {arguments[index]}")
+        value = arguments[index + 1]
+        options[arguments[index]] = float(value) if arguments[index] == "--timeout" else int(value)
+        if options[arguments[index]] <= 0:
+            raise ValueError(f"{arguments[index]} must be positive")
+    return options
+
+def correct_usage_parameters_message():
+    if len(argv) < 2:
+        print("Usage: python3 ftp_async.py <TRANSFERS|-> [--concurrency N] [--per-server N] [--timeout SECONDS]")
+        exit(1)
+
+def main():
+    # Run the transfers listed in a file, print one JSON result per transfer as it completes; the exit status
+    # is 1 if any of them failed
+    correct_usage_parameters_message()
+
+    try:
+        options = parse_optional_arguments(argv[2:])
+        if argv[1] == "-":
+            transfers = list(read_transfers(sys.stdin))
+        else:
+            with open(argv[1]) as transfers_file:
+                transfers = list(read_transfers(transfers_file))
+    except(NameError, ValueError) as e:
+        print(f"Error: {e}")
+        exit(1)
+    except OSError as e:
+        print(f"Error opening transfer list: {e}")
+        exit(1)
+
+    def print_result(result):
+        print(json.dumps(result), flush=True)
+
+    try:
+        results = asyncio.run(run_transfers(transfers, options["--concurrency"], options["--per-server"],
+                                            options["--timeout"], print_result))
+    except ValueError as e:
+        print(f"Error: {e}")
+        exit(1)
+    except KeyboardInterrupt:
+        # Cancelling the run cancels every transfer; downloads keep their partial files to resume
+        print("\nTransfers cancelled.")
+        exit(1)
+    if not all(result["ok"] for result in results):
+        exit(1)
+    return
+
+if __name__ == "__main__":
+    main()
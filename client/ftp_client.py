@@ -0,0 +1,275 @@
+import contextlib, importlib.util, json, logging, os, queue, sys, threading
+from sys import argv
+
+# Importable TCP client: sessions that stay connected and return every result as a dict, a pool of them, and a
+# batch mode that runs a command script. The protocol is client-tcp.py's own, loaded as a module, so commands are
+# sent, pipelined and checked exactly as at its prompt.
+#
+#   with Session("127.0.0.1", 2121) as session:
+#       result = session.stor("report.pdf")
+#       if not result["ok"]:
+#           print(result["error"])
+#
+#   with SessionPool("127.0.0.1", 2121, size=8) as pool, pool.session() as session:
+#       session.retr("report.pdf")
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "client-tcp.py")
+# Requests sent in one go by the batch mode before the first response is read
+BATCH_SIZE = 32
+STATUS_NAMES = {0: "ok", 1: "not_found", 2: "error", 3: "bad_request"}
+
+def load_protocol():
+    # client-tcp.py is a script with a dash in its name, so it is loaded from its path
+    spec = importlib.util.spec_from_file_location("client_tcp", CLIENT)
+    protocol = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(protocol)
+    return protocol
+
+PROTOCOL = load_protocol()
+# A library logs nothing unless the application configures the ftp.client logger
+PROTOCOL.LOG.addHandler(logging.NullHandler())
+
+def request_result(request):
+    # What callers get back for one command: ok, the error if it failed, and the figures of the response; a bulk
+    # command with some failed files has both its figures and an error
+    result = {"command": request["command"], "file_name": request.get("file_name"),
+              "ok": "result" in request and request["error"] is None, "error": request["error"]}
+    if "status" in request:
+        result["status"] = STATUS_NAMES.get(request["status"], request["status"])
+    result.update(request.get("result", {}))
+    return result
+
+class Session:
+    # One connection to the server, opened on first use and again after it failed. Not for use by several threads
+    # at once; give each thread a session of its own or take them from a SessionPool
+
+    def __init__(self, host, port, compress="none", dedup=True):
+        # Same choices as the --compress and --dedup options of client-tcp.py; raises NameError on unknown ones
+        self.address = (host, int(port))
+        self.options = PROTOCOL.parse_optional_arguments(["--compress", compress,
+                                                          "--dedup", "on" if dedup else "off"])
+        self.soc = None
+        self.buffer_size = None
+        self.request_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        # Raises socket.error or struct.error if the server cannot be reached or does not greet properly
+        self.soc, self.buffer_size, server_codecs = PROTOCOL.open_session(self.address)
+        codec = self.options["--compress"]
+        if codec != PROTOCOL.CODEC_NONE and not server_codecs & (1 << codec):
+            # Like the interactive client: the transfers stay uncompressed
+            self.options["--compress"] = codec = PROTOCOL.CODEC_NONE
+        PROTOCOL.send_frame(self.soc, PROTOCOL.OP_HELLO, 0, [PROTOCOL.CLIENT_HELLO.pack(codec)])
+        return
+
+    def close(self):
+        if self.soc is not None:
+            PROTOCOL.close_connection(self.soc, self.next_request_id())
+            self.soc = None
+        return
+
+    def next_request_id(self):
+        self.request_id = self.request_id % 0xFFFFFFFF + 1
+        return self.request_id
+
+    def execute(self, requests):
+        # Pipeline the requests on this session's connection; one result per request, in order
+        if self.soc is None:
+            self.connect()
+        for request in requests:
+            if request["command"] == "LIST":
+                request["entries"] = []
+        if not PROTOCOL.run_commands(self.soc, self.buffer_size, requests, iter(self.next_request_id, None)):
+            # The stream is out of step or gone; the next call starts on a new connection
+            self.soc.close()
+            self.soc = None
+        return [request_result(request) for request in requests]
+
+    def run(self, commands):
+        # Commands in the syntax of the interactive prompt, such as "STOR -p 4 disk.img" or "LIST -s -n 10",
+        # sent as one pipeline; DEL asks no confirmation. Raises ValueError on a command it does not know
+        requests = []
+        for command in commands:
+            request = PROTOCOL.create_command_request(command.strip(), self.next_request_id(), self.options)
+            if request is None:
+                raise ValueError(f"command '{command}' not recognized")
+            requests.append(request)
+        return self.execute(requests)
+
+    def stor(self, file_name, resume=False, streams=None, delta=False):
+        # streams: upload in segments over that many connections, 0 to let the client tune the count
+        return self.transfer("STOR", file_name, resume, streams, delta)
+
+    def retr(self, file_name, streams=None):
+        return self.transfer("RETR", file_name, False, streams, False)
+
+    def transfer(self, command, file_name, resume, streams, delta):
+        options = {"resume": resume, "streams": streams, "delta": delta}
+        request = PROTOCOL.create_parsed_transfer_request(command, self.next_request_id(), file_name, options,
+                                                          self.options)
+        return self.execute([request])[0]
+
+    def mstor(self, *patterns):
+        # Every local file matching the glob patterns, uploaded back to back; the result holds the totals and the
+        # outcome of each file in "files"
+        return self.bulk("MSTOR", patterns)
+
+    def mretr(self, *patterns):
+        # Every file on the server matching the glob patterns, downloaded back to back
+        return self.bulk("MRETR", patterns)
+
+    def bulk(self, command, patterns):
+        if not patterns:
+            raise ValueError(f"{command} needs at least one file name or pattern")
+        request = PROTOCOL.create_request(command, self.next_request_id())
+        request.update({"patterns": list(patterns), "session_options": self.options})
+        return self.execute([request])[0]
+
+    def putdir(self, directory):
+        # The tree under a local directory, stored on the server under its last path component; the result holds
+        # files, size and elapsed
+        return self.execute([PROTOCOL.create_directory_request("PUTDIR", self.next_request_id(), directory,
+                                                               self.options)])[0]
+
+    def getdir(self, directory):
+        return self.execute([PROTOCOL.create_directory_request("GETDIR", self.next_request_id(), directory,
+                                                               self.options)])[0]
+
+    def list(self, sort=False, page_size=0, limit=0, cursor=""):
+        # The result holds the (name, size) pairs in "entries" and, when limited, the cursor to continue after
+        request = PROTOCOL.create_request("LIST", self.next_request_id())
+        request.update({"sorted": sort, "page_size": page_size, "limit": limit, "cursor": cursor})
+        return self.execute([request])[0]
+
+    def delete(self, file_name):
+        return self.execute([PROTOCOL.create_request("DEL", self.next_request_id(), file_name)])[0]
+
+    def hash(self, file_name):
+        return self.execute([PROTOCOL.create_request("HASH", self.next_request_id(), file_name)])[0]
+
+    def stat(self):
+        return self.execute([PROTOCOL.create_request("STAT", self.next_request_id())])[0]
+
+class SessionPool:
+    # Up to size sessions to one server, connected when first needed and kept open between uses
+
+    def __init__(self, host, port, size=4, **session_options):
+        self.address = (host, port)
+        self.session_options = session_options
+        self.idle = queue.LifoQueue()
+        # Sessions that may still be created
+        self.available = threading.Semaphore(size)
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def acquire(self):
+        # An idle session if there is one, otherwise a new one while under size, otherwise wait for one
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            if self.available.acquire(blocking=False):
+                session = Session(*self.address, **self.session_options)
+                with self.lock:
+                    self.sessions.append(session)
+                return session
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def release(self, session):
+        self.idle.put(session)
+        return
+
+    @contextlib.contextmanager
+    def session(self):
+        # with pool.session() as session: ... hands the session back afterwards
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions:
+                session.close()
+        return
+
+def read_script(script_file):
+    # One or more commands per line separated by ';', blank lines and '#' comments skipped
+    for line in script_file:
+        line = line.split("#", 1)[0]
+        for command in line.split(";"):
+            if command.strip():
+                yield command.strip()
+    return
+
+def correct_usage_parameters_message():
+    if len(argv) < 4:
+        print("Usage: python3 ftp_client.py <IP> <PORT> <SCRIPT|-> [--compress zlib|lzma|bz2] [--dedup on|off] "
+              "[--batch N]")
+        exit(1)
+
+def main():
+    # Batch mode: run the commands of a script, BATCH_SIZE requests pipelined at a time, and print one JSON
+    # result per command; the exit status is 1 if any of them failed
+    correct_usage_parameters_message()
+
+    try:
+        arguments = argv[4:]
+        batch_size = BATCH_SIZE
+        if "--batch" in arguments:
+            index = arguments.index("--batch")
+            batch_size = int(arguments[index + 1])
+            del arguments[index:index + 2]
+        options = dict(zip(arguments[::2], arguments[1::2]))
+        if len(arguments) % 2 or not set(options) <= {"--compress", "--dedup"}:
+            raise NameError(f"unknown or incomplete options {' '.join(arguments)}")
+        session = Session(argv[1], argv[2], compress=options.get("--compress", "none"),
+                          dedup=options.get("--dedup", "on") == "on")
+        script_file = open(argv[3]) if argv[3] != "-" else None
+    except(NameError, ValueError, IndexError) as e:
+        print(f"Error: {e}")
+        exit(1)
+    except OSError as e:
+        print(f"Error opening script: {e}")
+        exit(1)
+
+    failed = 0
+    try:
+        commands = list(read_script(script_file or sys.stdin))
+        with session:
+            for start in range(0, len(commands), batch_size):
+                for result in session.run(commands[start:start + batch_size]):
+                    print(json.dumps(result), flush=True)
+                    failed += not result["ok"]
+    except ValueError as e:
+        print(f"Error: {e}")
+        exit(1)
+    except OSError as e:
+        print(f"Connection unsuccessful. Error: {e}")
+        exit(1)
+    finally:
+        if script_file is not None:
+            script_file.close()
+    if failed:
+        exit(1)
+    return
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,343 @@
-import socket, struct, sys, time, os
+import asyncio, bisect, bz2, collections, functools, hashlib, heapq, itertools, json, logging, logging.handlers, math, queue, selectors, shutil, signal, socket, struct, sys, tarfile, tempfile, threading, time, os, zlib
+from concurrent.futures import ThreadPoolExecutor
 from sys import argv
 
+try:
+    import lzma
+except ImportError:
+    # Python builds without liblzma have no lzma module; the codec is then simply not offered
+    lzma = None
+
+# Every message goes through this logger; records are queued and written by a background thread
+LOG = logging.getLogger("ftp.server")
+# -n logs everything from INFO up, -q only warnings and errors
+LOG_LEVELS = {"-n": logging.INFO, "-q": logging.WARNING}
+LOG_FORMAT = "%(asctime)s %(process)d %(levelname)s %(message)s"
+# The background writer of this process and the quiet mode it was configured with; a forked worker starts its own
+LOGGING = {"listener": None, "quiet_mode": "-n"}
+
+# Pending connections the kernel queues while the event loop is busy
+LISTEN_BACKLOG = 128
+# Threads used for blocking disk work so the event loop never stalls
+DISK_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# Seconds between two statistics reports from a worker to the supervisor
+STATS_REPORT_INTERVAL = 1.0
+# Seconds between two aggregated statistics summaries printed by the supervisor
+STATS_SUMMARY_INTERVAL = 60.0
+# Bytes of the last report a worker has not been able to write to the supervisor yet
+STATS_REPORT = {"pending": b""}
+
+# Receive chunks are sized to take in TUNE_CHUNK_SECONDS of the measured throughput, and at least one
+# bandwidth-delay product, rounded up to a power of two between these bounds; "auto" as BUFFER_SIZE starts at
+# TUNE_INITIAL_CHUNK
+TUNE_MIN_CHUNK = 64 * 1024
+TUNE_MAX_CHUNK = 8 * 1024 * 1024
+TUNE_INITIAL_CHUNK = 256 * 1024
+TUNE_CHUNK_SECONDS = 0.002
+# Socket buffers are grown to two bandwidth-delay products, up to this size
+TUNE_MAX_SOCKET_BUFFER = 32 * 1024 * 1024
+# A long upload is measured again every TUNE_INTERVAL seconds; stretches shorter than TUNE_MIN_BYTES say more about
+# latency than throughput and are left out. Each new rate counts for TUNE_SMOOTHING of the session's estimate
+TUNE_INTERVAL = 0.5
+TUNE_MIN_BYTES = 1024 * 1024
+TUNE_SMOOTHING = 0.5
+# Leading fields of the Linux struct tcp_info: eight one-byte fields, then rto, ato, snd_mss, rcv_mss, unacked,
+# sacked, lost, retrans, fackets, four last_* timestamps, pmtu, rcv_ssthresh, rtt, rttvar, snd_ssthresh, snd_cwnd
+TCP_INFO = struct.Struct("=8B19I")
+
+# --tune 0 keeps every session at BUFFER_SIZE; the measurements are still reported
+AUTO_TUNE = {"enabled": True}
+
+# Counters of this process; in --workers mode each worker reports them to the supervisor
+STATS = {
+    "sessions": 0,
+    "active_sessions": 0,
+    "commands": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "cache_evictions": 0,
+    "cache_bytes": 0,
+    "errors": 0,
+}
+# Counters that describe the current state of a worker rather than its history; they die with it
+STATS_GAUGES = ("active_sessions", "cache_bytes")
+# Upper bounds in seconds of the command latency histogram buckets; one more bucket takes anything slower
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+# Latency histogram of every command this process served, by command name: count, sum of seconds, error responses
+# and one count per bucket. Reported to the supervisor along with STATS
+LATENCY = {}
+# Quantiles STAT reports for every command, estimated from the histogram buckets
+LATENCY_QUANTILES = (0.5, 0.95, 0.99)
+# Seconds between two dumps of the metrics file in Prometheus text format
+METRICS_INTERVAL = 10.0
+# Where --metrics-file dumps the metrics; "scope" tells STAT whether they cover the server or one of its workers
+METRICS = {"path": None, "scope": "server", "started": time.time()}
+# Prometheus name, type and help text of every STATS counter
+METRIC_FAMILIES = (
+    ("sessions", "ftp_sessions_total", "counter", "Sessions accepted."),
+    ("active_sessions", "ftp_active_sessions", "gauge", "Sessions currently open."),
+    ("commands", "ftp_commands_total", "counter", "Commands received."),
+    ("bytes_in", "ftp_received_bytes_total", "counter", "Bytes received from clients."),
+    ("bytes_out", "ftp_sent_bytes_total", "counter", "Bytes sent to clients."),
+    ("errors", "ftp_errors_total", "counter", "Error responses and sessions dropped by an error."),
+    ("cache_hits", "ftp_cache_hits_total", "counter", "Downloads served from the hot-file cache."),
+    ("cache_misses", "ftp_cache_misses_total", "counter", "Downloads read from disk."),
+    ("cache_evictions", "ftp_cache_evictions_total", "counter", "Files evicted from the hot-file cache."),
+    ("cache_bytes", "ftp_cache_bytes", "gauge", "Bytes held by the hot-file cache."),
+)
+
+# Every message is a frame: opcode, status, flags, request id and payload length, in network byte order
+FRAME_HEADER = struct.Struct("!BBHIQ")
+OP_HELLO = 1
+OP_STOR = 2
+OP_RETR = 3
+OP_LIST = 4
+OP_DEL = 5
+OP_QUIT = 6
+OP_REST = 7
+OP_SIZE = 8
+OP_HASH = 9
+OP_GET = 10
+OP_PUT = 11
+OP_COMMIT = 12
+OP_DATA = 13
+OP_LINK = 14
+OP_SIGS = 15
+OP_DELTA = 16
+OP_TREE = 17
+OP_STAT = 18
+OP_PUTDIR = 19
+OP_GETDIR = 20
+OPCODE_NAMES = {OP_HELLO: "HELLO", OP_STOR: "STOR", OP_RETR: "RETR", OP_LIST: "LIST", OP_DEL: "DEL", OP_QUIT: "QUIT",
+                OP_REST: "REST", OP_SIZE: "SIZE", OP_HASH: "HASH", OP_GET: "GET", OP_PUT: "PUT", OP_COMMIT: "COMMIT",
+                OP_DATA: "DATA", OP_LINK: "LINK",
+                OP_SIGS: "SIGS", OP_DELTA: "DELTA", OP_TREE: "TREE", OP_STAT: "STAT", OP_PUTDIR: "PUTDIR",
+                OP_GETDIR: "GETDIR"}
+# Status of a response frame; requests carry STATUS_OK, except the last DATA frame of a directory upload the client
+# could not finish
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_ERROR = 2
+STATUS_BAD_REQUEST = 3
+# Frame flags
+FLAG_MORE = 0x0001                      # more frames for the same request follow this one
+FLAG_CHUNKED = 0x0002                   # STOR or RETR whose content follows as DATA frames instead of in the payload
+FLAG_TRAILER = 0x0004                   # RETR without a root, hashed as it is sent: a HASH frame follows the content
+CODEC_SHIFT = 8                         # DATA frames carry the codec of their chunk in bits 8 to 11
+CODEC_MASK = 0x0F00
+# Payload layouts
+HELLO_PAYLOAD = struct.Struct("!IH")    # buffer size, bit mask of the codecs the server can decode and encode
+CLIENT_HELLO = struct.Struct("!B")      # codec the client wants its downloads compressed with
+CHUNK_HEADER = struct.Struct("!I")      # size of the chunk once decoded, followed by the encoded chunk
+STOR_REQUEST = struct.Struct("!QH")     # offset, file name length, followed by the name and the content from the offset
+STOR_RESPONSE = struct.Struct("!dQ32s") # seconds elapsed, bytes stored, Merkle root of the stored file
+DEL_RESPONSE = struct.Struct("!d")      # seconds elapsed
+RETR_REQUEST = struct.Struct("!Q32s")   # offset, overlap digest of the client's copy, followed by the file name
+RETR_RESPONSE = struct.Struct("!Q32s")  # offset the content starts at, Merkle root if known (zeros if not), then the content
+REST_RESPONSE = struct.Struct("!Q32s")  # bytes of the partial upload, its overlap digest
+NAME_REQUEST = struct.Struct("")        # no fixed fields, just the file name
+SIZE_RESPONSE = struct.Struct("!Q")     # file size
+HASH_RESPONSE = struct.Struct("!32s")   # Merkle root of the whole file
+TREE_RESPONSE = struct.Struct("!QI")    # file size, chunk size, followed by the SHA-256 of every chunk
+# STAT takes no payload and answers with the metrics as one JSON document
+RANGE_REQUEST = struct.Struct("!QQ")    # offset, length, followed by the file name
+PUT_REQUEST = struct.Struct("!QH")      # offset, file name length, followed by the name and the segment content
+COMMIT_REQUEST = struct.Struct("!Q32s") # file size, Merkle root of the whole file, followed by the file name
+LINK_REQUEST = struct.Struct("!Q32s")   # file size, Merkle root of the content, followed by the file name to create
+SIGS_REQUEST = struct.Struct("!I")      # block size (0 lets the server choose), followed by the file name
+SIGNATURE = struct.Struct("!I16s")      # adler32 and BLAKE2b-128 of one block
+SIGS_SUMMARY = struct.Struct("!QI")     # file size, block size
+DELTA_COPY = struct.Struct("!BQQ")      # DELTA_KIND_COPY, offset in the server's copy, length
+DELTA_LITERAL = struct.Struct("!B")     # DELTA_KIND_LITERAL, followed by the bytes
+DELTA_END = struct.Struct("!B32s")      # DELTA_KIND_END, Merkle root of the whole new file
+DELTA_RESPONSE = struct.Struct("!dQQ")  # seconds elapsed, bytes stored, bytes sent as literals
+LIST_ENTRY = struct.Struct("!QH")       # file size, file name length, followed by the name
+LIST_REQUEST = struct.Struct("!BIQ")    # options, page size, entry limit, followed by the cursor name
+LIST_SUMMARY = struct.Struct("!QQ")     # entries listed, their total size, followed by the next cursor
+DIR_SUMMARY = struct.Struct("!dQQ")     # seconds elapsed, files in the archive, bytes of their content
+# LIST options
+LIST_SORTED = 0x01
+# Instructions of a delta upload, one per DATA frame
+DELTA_KIND_COPY = 1
+DELTA_KIND_LITERAL = 2
+DELTA_KIND_END = 3
+# Largest payload buffered in memory for a request that only carries a file name
+MAX_NAME_PAYLOAD = 4096
+# Uploads are written under this suffix and renamed into place once complete; a dropped upload keeps it to resume
+PARTIAL_SUFFIX = ".ftp-part"
+# A transfer resumes only if the last bytes before the offset hash the same on both sides
+RESUME_CHECK_SIZE = 1024 * 1024
+# Segmented uploads fill this file range by range, in any order, until COMMIT verifies and renames it
+SEGMENTS_SUFFIX = ".ftp-seg"
+# Delta uploads rebuild the file here from the old copy and the client's literals
+DELTA_SUFFIX = ".ftp-delta"
+# Journal of a partial upload: the digest of every chunk finished so far, so a resumed upload hashes none of them again
+TREE_SUFFIX = ".ftp-tree"
+# Files that are still being written and never show up in a listing
+TEMPORARY_SUFFIXES = (PARTIAL_SUFFIX, SEGMENTS_SUFFIX, DELTA_SUFFIX, TREE_SUFFIX)
+# A directory upload unpacks into name + PARTIAL_SUFFIX and only then takes the place of the old tree, which is
+# moved aside under this suffix and removed
+REPLACED_SUFFIX = ".ftp-old"
+# Chunks of a directory archive queued between the event loop and the thread that packs or unpacks it
+ARCHIVE_QUEUE_SIZE = 4
+# Unpacking refuses links, devices and paths outside the target; Pythons with extraction filters check it again
+EXTRACT_OPTIONS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+# Bytes read at a time when hashing a whole file
+HASH_BLOCK_SIZE = 1024 * 1024
+# Downloads hashed while sendfile sends them go out in ranges of this size, each hashed while the next is sent
+SENDFILE_RANGE_SIZE = 8 * 1024 * 1024
+# Files are hashed as a Merkle tree: SHA-256 of every chunk of this size, paired up level by level into one root,
+# so a transfer can check and repair each chunk on its own
+MERKLE_CHUNK_SIZE = 1024 * 1024
+# Chunk digests of stored files, one file per name holding the size and mtime they describe, then the digests
+DIGESTS_DIRECTORY = ".ftp-digests"
+DIGESTS_HEADER = struct.Struct("!QQ")
+# Tree journals start with the size and mtime (ns) of the file they describe, zeros for a partial file, whose own
+# length tells how many of the digests still hold
+TREE_JOURNAL_HEADER = struct.Struct("!QQ")
+PARTIAL_IDENTITY = (0, 0)
+# Delta blocks are about the square root of the file size, within these bounds
+DELTA_MIN_BLOCK_SIZE = 4 * 1024
+DELTA_MAX_BLOCK_SIZE = 128 * 1024
+# Bytes of the old copy read and signed per disk job; the next batch is read while one is being sent
+SIGNATURE_BATCH_SIZE = 8 * 1024 * 1024
+# Chunk codecs; every chunk is compressed on its own, so a chunk that does not shrink can go raw
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_BZ2 = 3
+# Name, compress function and decompressor factory of every codec this Python can use
+CODECS = {CODEC_ZLIB: ("zlib", functools.partial(zlib.compress, level=6), zlib.decompressobj),
+          CODEC_BZ2: ("bz2", bz2.compress, bz2.BZ2Decompressor)}
+if lzma is not None:
+    CODECS[CODEC_LZMA] = ("lzma", functools.partial(lzma.compress, preset=2), lzma.LZMADecompressor)
+# Raw bytes per compressed chunk, and the largest chunk accepted from a client
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Content is compressed only if a sample of this size from the transfer offset shrinks below COMPRESSIBLE_RATIO
+COMPRESSION_SAMPLE_SIZE = 256 * 1024
+COMPRESSIBLE_RATIO = 0.9
+# After this many chunks in a row that did not shrink, the rest of the transfer goes raw
+INCOMPRESSIBLE_CHUNKS = 4
+# Formats that are compressed already and never worth a sample
+COMPRESSED_EXTENSIONS = {".gz", ".tgz", ".bz2", ".xz", ".lz", ".lzma", ".zst", ".zip", ".7z", ".rar", ".jpg", ".jpeg",
+                         ".png", ".gif", ".webp", ".heic", ".mp3", ".mp4", ".m4a", ".mkv", ".avi", ".mov", ".webm",
+                         ".ogg", ".flac", ".pdf", ".docx", ".xlsx", ".pptx", ".jar", ".apk", ".whl"}
+# Append-only journal of the content index, one JSON record per line; a record without a root drops the name
+CONTENT_INDEX_FILE = ".ftp-index"
+# The journal is rewritten at startup once it holds this many more records than there are indexed names
+CONTENT_INDEX_SLACK = 10000
+# Largest file the hot-file cache holds, and how many recently missed files it remembers to decide what to admit
+FILE_CACHE_MAX_FILE_SIZE = 4 * 1024 * 1024
+FILE_CACHE_SEEN_ENTRIES = 4096
+# Entries per LIST page frame when the client leaves it to the server, and the most a client may ask for
+LIST_PAGE_SIZE = 1000
+MAX_LIST_PAGE_SIZE = 65536
+# Directories with more entries than this are never held in memory; LIST streams them from disk page by page,
+# sorting them through temporary runs of this many entries
+LISTING_CACHE_MAX_ENTRIES = 100000
+# A directory changed this recently may change again within the same timestamp tick, so its listing is not cached
+LISTING_CACHE_SETTLE_NS = 1000000000
+
+# Name-sorted (encoded name, size) entries of the working directory, or oversized when it has too many to
+# hold; STOR and DEL of this process drop it, and the directory mtime catches changes made by other workers
+LISTING_CACHE = {"mtime_ns": None, "entries": None, "oversized": False}
+
+# Merkle root (hex) -> names holding those bytes, and name -> its record, replayed from the journal; "offset" is how
+# far this process has read it, so records appended by other workers are picked up on the next lookup
+CONTENT_INDEX = {"offset": 0, "records": 0, "by_name": {}, "by_digest": {}, "lock": threading.Lock()}
+
+# Hot files served from memory: name -> {"key", "data", "root"} in least recently used order, within a budget of
+# bytes set by --cache-mb. "seen" remembers recent misses: a file is only copied in when it is asked for again, so
+# one-off downloads never push hot files out. Only the event loop thread touches it
+FILE_CACHE = {"entries": collections.OrderedDict(), "seen": collections.OrderedDict(), "bytes": 0, "budget": 0}
+
 def correct_usage_parameters_message():
-    if len(argv) != 5:
-        print("Usage: python3 server.py <IP> <PORT> <BUFFER_SIZE> [-q <quiet_mode> -n <not_quiet_mode>]")
+    if len(argv) < 5:
+        print("Usage: python3 server.py <IP> <PORT> <BUFFER_SIZE|auto> [-q <quiet_mode> -n <not_quiet_mode>] [--workers N] "
+              "[--cache-mb N] [--tune 1|0] [--metrics-file PATH]")
         exit(1)
 
+def parse_optional_arguments(arguments):
+    # Options that may follow the positional parameters, with their default values
+    options = {"--workers": 1, "--cache-mb": 64, "--tune": 1, "--metrics-file": None}
+    index = 0
+    while index < len(arguments):
+        option = arguments[index]
+        if option not in options or index + 1 >= len(arguments):
+            raise NameError(f"unknown or incomplete option '{option}'")
+        value = arguments[index + 1]
+        options[option] = value if option == "--metrics-file" else int(value)
+        index += 2
+    if options["--workers"] < 1 or options["--cache-mb"] < 0:
+        raise ValueError("the number of workers must be at least 1 and the cache size at least 0")
+    return options
+
+def configure_logging(quiet_mode):
+    # Sessions only put records on a queue; one thread formats and writes them, so a slow terminal never stalls
+    # the event loop. Records below the level are dropped before they are built, which makes quiet mode free
+    stop_logging()
+    LOGGING["quiet_mode"] = quiet_mode
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    LOG.handlers = [logging.handlers.QueueHandler(records)]
+    LOG.setLevel(LOG_LEVELS.get(quiet_mode, logging.INFO))
+    LOG.propagate = False
+    LOGGING["listener"] = logging.handlers.QueueListener(records, handler)
+    LOGGING["listener"].start()
+    return
+
+def stop_logging():
+    # Writes out every queued record and stops the writer thread
+    if LOGGING["listener"] is not None:
+        LOGGING["listener"].stop()
+        LOGGING["listener"] = None
+    return
+
+def log_transfer(session, command, file_name, size, start_time, **fields):
+    # One key=value record per finished transfer for log shippers; the fields also ride on the record as "transfer"
+    if not LOG.isEnabledFor(logging.INFO):
+        return
+    seconds = time.time() - start_time
+    record = {"peer": "{}:{}".format(*session["addr"]), "command": command, "file": file_name, "bytes": size,
+              "seconds": round(seconds, 6), "mib_s": round(size / seconds / 1024 ** 2, 2) if seconds > 0 else 0.0}
+    record.update(fields)
+    LOG.info("transfer %s", " ".join("{}={}".format(key, json.dumps(value)) for key, value in record.items()),
+             extra={"transfer": record})
+    return
+
+def create_listening_socket(address, reuse_port=False, listen=True):
+    # Create a socket to listen for incoming connections
+    soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Allow the socket to reuse the address in case it is in TIME_WAIT state
+    soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Every worker binds its own socket to the port and the kernel balances connections between them
+        soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    soc.bind(address)
+    if listen:
+        soc.listen(LISTEN_BACKLOG)
+        # The event loop drives every socket, so none of them may block
+        soc.setblocking(False)
+    return soc
+
 def create_socket_connection():
     try:
         # Set up server parameters
         TCP_IP = argv[1]
         TCP_PORT = int(argv[2])
-        BUFFER_SIZE = int(argv[3])
+        # The buffer size is where every session starts; it is tuned from there unless --tune 0
+        BUFFER_SIZE = TUNE_INITIAL_CHUNK if argv[3] == "auto" else int(argv[3])
         QUIET_MODE = argv[4]
+        OPTIONS = parse_optional_arguments(argv[5:])
+
+        # With several workers and SO_REUSEPORT the supervisor only reserves the port, each worker listens itself
+        reuse_port = OPTIONS["--workers"] > 1 and hasattr(socket, "SO_REUSEPORT")
+        soc = create_listening_socket((TCP_IP, TCP_PORT), reuse_port, listen=not reuse_port)
 
-        # Create a socket to listen for incoming connections
-        soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Allow the socket to reuse the address in case it is in TIME_WAIT state
-        soc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        soc.bind((TCP_IP, TCP_PORT))
-        soc.listen(1) # Disable when testing with multiple clients
-        
     except socket.error as e:
         print(f"Connection unsuccessful. Error: {e}")
         exit(1)
@@ -34,353 +351,2390 @@ def create_socket_connection():
         print(f"Error: {e}")
         exit(1)
     except ValueError as e:
-        print("Error: Port and buffer size must be integers.")
+        print("Error: Port, buffer size (or auto), number of workers, cache size and --tune must be integers.")
         exit(1)
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         exit(1)
-    return soc, BUFFER_SIZE, QUIET_MODE
+    return soc, (TCP_IP, TCP_PORT), BUFFER_SIZE, QUIET_MODE, OPTIONS, reuse_port
+
+def create_session(connect, addr, buffer_size):
+    # Per-connection state; "state" names the command the session is currently serving
+    return {
+        "connect": connect,
+        "addr": addr,
+        "buffer_size": buffer_size,
+        "state": "IDLE",
+        # Codec the client asked for in its HELLO; downloads are sent with it when the content compresses
+        "codec": CODEC_NONE,
+        # Bytes already received but not consumed yet, e.g. the start of a pipelined frame
+        "pending": bytearray(),
+        # Two receive buffers reused for every upload: one fills from the socket while the other is written out;
+        # both are replaced when tuning picks another buffer size
+        "receive_buffers": (memoryview(bytearray(buffer_size)), memoryview(bytearray(buffer_size))),
+        # Smoothed throughput (bytes per second), kernel RTT (seconds) and congestion window (bytes), the socket
+        # buffer sizes in effect and how often the buffer size changed
+        "tuning": {"rate": 0.0, "rtt": 0.0, "cwnd": 0, "sndbuf": 0, "rcvbuf": 0, "changes": 0},
+    }
 
-def store_file_to_server(connect, buffer_size, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-    
+def configure_socket(connect):
+    # Frames go out as soon as they are complete; headers in front of file data are corked instead
     try:
-        # Send message once server is ready to receive file details
-        connect.send(b"1")
+        connect.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+    return
 
-        # Receive file name length, then file name
-        file_name_size = struct.unpack("h", connect.recv(2))[0]
-        file_name = connect.recv(file_name_size).decode('utf-8')
+def cork_socket(connect, corked):
+    # While corked, the kernel only sends full segments, so a frame header leaves with the file bytes behind it;
+    # uncorking sends whatever is left at once. Linux only
+    if hasattr(socket, "TCP_CORK"):
+        try:
+            connect.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(corked))
+        except OSError:
+            pass
+    return
 
-    except struct.error:
-        print("\nError to unpack file name size.")
-        return
-    except socket.error:
-        print("\nError to send confirmation message or receive file name")
+def read_tcp_info(connect):
+    # Smoothed RTT (seconds) and congestion window (bytes) the kernel keeps for the connection, or None where
+    # TCP_INFO is not available
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        data = connect.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size)
+    except OSError:
+        return None
+    if len(data) < TCP_INFO.size:
+        return None
+    fields = TCP_INFO.unpack(data)
+    snd_mss, rtt, snd_cwnd = fields[10], fields[23], fields[26]
+    return {"rtt": rtt / 1000000, "cwnd": snd_cwnd * snd_mss}
+
+def size_socket_buffers(connect, tuning, wanted):
+    # Buffers only ever grow: Linux stops autotuning a buffer once it is set, so one already larger is left alone.
+    # Linux reports twice the size asked for, as it counts its bookkeeping too
+    wanted = min(int(wanted), TUNE_MAX_SOCKET_BUFFER)
+    for option, name in ((socket.SO_SNDBUF, "sndbuf"), (socket.SO_RCVBUF, "rcvbuf")):
+        try:
+            if wanted > connect.getsockopt(socket.SOL_SOCKET, option):
+                connect.setsockopt(socket.SOL_SOCKET, option, wanted)
+            tuning[name] = connect.getsockopt(socket.SOL_SOCKET, option)
+        except OSError:
+            pass
+    return
+
+def tune_session(session, byte_count, seconds):
+    # Fold one measured stretch of a transfer into the session's estimates and size its buffers to them
+    if byte_count < TUNE_MIN_BYTES or seconds <= 0:
         return
-    except Exception as e:
-        print(f"\nErro inesperado ao receber o nome do arquivo: {e}")
+    tuning = session["tuning"]
+    rate = byte_count / seconds
+    tuning["rate"] = rate if not tuning["rate"] else TUNE_SMOOTHING * rate + (1 - TUNE_SMOOTHING) * tuning["rate"]
+    info = read_tcp_info(session["connect"])
+    if info is not None:
+        tuning["rtt"] = info["rtt"]
+        tuning["cwnd"] = info["cwnd"]
+    if not AUTO_TUNE["enabled"]:
         return
-    
-    try:
-        # Send message to let client know server is ready for document content
-        connect.send(b"1")
 
-        # Receive file size
-        file_size = struct.unpack("i", connect.recv(4))[0]
+    # The congestion window is the sender's own estimate of the bandwidth-delay product
+    bdp = max(tuning["rate"] * tuning["rtt"], tuning["cwnd"])
+    target = int(max(bdp, tuning["rate"] * TUNE_CHUNK_SECONDS))
+    chunk = min(max(1 << max(target - 1, 0).bit_length(), TUNE_MIN_CHUNK), TUNE_MAX_CHUNK)
+    if chunk != session["buffer_size"]:
+        session["buffer_size"] = chunk
+        session["receive_buffers"] = (memoryview(bytearray(chunk)), memoryview(bytearray(chunk)))
+        tuning["changes"] += 1
+    size_socket_buffers(session["connect"], tuning, 2 * bdp)
+    return
+
+def format_tuning(session):
+    tuning = session["tuning"]
+    return "buffer {} KiB ({} changes), {:.1f} MiB/s, RTT {:.2f} ms, cwnd {} KiB, SO_SNDBUF {} KiB, SO_RCVBUF {} KiB".format(
+        session["buffer_size"] // 1024, tuning["changes"], tuning["rate"] / 1024 ** 2, tuning["rtt"] * 1000,
+        tuning["cwnd"] // 1024, tuning["sndbuf"] // 1024, tuning["rcvbuf"] // 1024)
 
-        # Initialize and enter loop to receive file content
-        start_time = time.time()
-        output_file = open(file_name, "wb")
+async def run_disk_job(function, *args):
+    # Hand blocking file system calls to the disk worker pool
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, function, *args)
+
+async def recv_data(connect, size):
+    loop = asyncio.get_running_loop()
+    data = await loop.sock_recv(connect, size)
+    STATS["bytes_in"] += len(data)
+    return data
+
+async def fill_pending(session, size):
+    # Read whole buffers so that several small pipelined frames cost one recv call
+    pending = session["pending"]
+    while len(pending) < size:
+        data = await recv_data(session["connect"], max(session["buffer_size"], size - len(pending)))
+        if not data:
+            return False
+        pending += data
+    return True
 
-        bytes_received = 0
-        print("\nReceiving...")
+async def recv_exact(session, size):
+    # Keep reading until exactly size bytes arrived; a short read is not an error in TCP
+    if not await fill_pending(session, size):
+        raise ConnectionError("Connection closed by client.")
+    pending = session["pending"]
+    data = bytes(pending[:size])
+    del pending[:size]
+    return data
+
+async def recv_frame(session):
+    # Returns (opcode, status, flags, request_id, payload_length), or None when the client closed cleanly
+    if not await fill_pending(session, FRAME_HEADER.size):
+        if session["pending"]:
+            raise ConnectionError("Connection closed in the middle of a frame header.")
+        return None
+    return FRAME_HEADER.unpack(await recv_exact(session, FRAME_HEADER.size))
+
+async def discard_payload(session, size):
+    # Skip a payload we cannot use so the next frame is still found at the right place
+    while size > 0:
+        size -= len(await recv_exact(session, min(size, session["buffer_size"])))
+    return
+
+async def send_buffers(connect, buffers):
+    # Scatter-gather: header and payload leave in one sendmsg call instead of one send per piece
+    loop = asyncio.get_running_loop()
+    total = sum(len(buffer) for buffer in buffers)
+    sent = 0
+    if hasattr(connect, "sendmsg"):
+        try:
+            sent = connect.sendmsg(buffers)
+        except(BlockingIOError, InterruptedError):
+            sent = 0
+    # Whatever the kernel did not take right away is sent piece by piece once the socket is writable
+    for buffer in buffers:
+        if sent >= len(buffer):
+            sent -= len(buffer)
+            continue
+        await loop.sock_sendall(connect, memoryview(buffer)[sent:])
+        sent = 0
+    STATS["bytes_out"] += total
+    return
+
+async def send_frame(session, opcode, request_id, payload=b"", status=STATUS_OK, flags=0, data_length=0):
+    # data_length counts bytes the caller streams right after the frame, such as a file sent with sendfile
+    header = FRAME_HEADER.pack(opcode, status, flags, request_id, len(payload) + data_length)
+    if status in (STATUS_ERROR, STATUS_BAD_REQUEST):
+        # Missing files are an answer, not a failure; only server errors and malformed requests count
+        record_error(OPCODE_NAMES.get(opcode, "UNKNOWN"))
+    await send_buffers(session["connect"], [header, payload] if payload else [header])
+    return
+
+def write_all(output_file, view, tree=None):
+    # Runs on the disk worker pool; unbuffered file writes may be partial. A chunk tree, if given, hashes what is written
+    if tree is not None:
+        update_chunk_tree(tree, view)
+    while view:
+        written = output_file.write(view)
+        view = view[written:]
+    return
+
+def preallocate_file(output_file, file_size):
+    # Reserve every block up front so the file is laid out in one piece instead of growing chunk by chunk
+    if file_size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(output_file.fileno(), 0, file_size)
+        except OSError:
+            # Not every file system supports it; the writes work without it
+            pass
+    return
+
+async def recv_into_file(session, output_file, file_size, tree=None):
+    # Fill the session's reused buffers with recv_into and hand full buffers to the disk pool,
+    # so no bytes object is allocated per chunk and one buffer fills while the other is written
+    loop = asyncio.get_running_loop()
+    connect = session["connect"]
+    pending_write = None
+    bytes_received = 0
+    index = 0
+
+    # Content that arrived together with the frame header is written first
+    pending = session["pending"]
+    if pending and file_size:
+        head = bytes(pending[:file_size])
+        del pending[:len(head)]
+        await run_disk_job(write_all, output_file, head, tree)
+        bytes_received += len(head)
+
+    # Long uploads are measured every TUNE_INTERVAL, and the buffers may change size between two chunks
+    mark_time = time.monotonic()
+    mark_bytes = bytes_received
+    try:
         while bytes_received < file_size:
-            data = connect.recv(buffer_size)
-            output_file.write(data)
-            bytes_received += len(data)
+            buffers = session["receive_buffers"]
+            view = buffers[index][:min(len(buffers[index]), file_size - bytes_received)]
+            filled = 0
+            while filled < len(view):
+                size = await loop.sock_recv_into(connect, view[filled:])
+                if size == 0:
+                    raise ConnectionError("Connection closed by client.")
+                filled += size
+            STATS["bytes_in"] += filled
+
+            # Writes stay in order: the previous buffer must be on disk before the next one is queued
+            if pending_write is not None:
+                await pending_write
+            pending_write = loop.run_in_executor(None, write_all, output_file, view, tree)
+            bytes_received += filled
+            index ^= 1
+            if time.monotonic() - mark_time >= TUNE_INTERVAL:
+                tune_session(session, bytes_received - mark_bytes, time.monotonic() - mark_time)
+                mark_time = time.monotonic()
+                mark_bytes = bytes_received
+        if pending_write is not None:
+            await pending_write
+            pending_write = None
+        tune_session(session, bytes_received - mark_bytes, time.monotonic() - mark_time)
+    finally:
+        # Never let the file be closed while a write is still running
+        if pending_write is not None:
+            await asyncio.gather(pending_write, return_exceptions=True)
+    return bytes_received
+
+def create_chunk_tree():
+    # Chunk digests of a stream of bytes, filled in as the bytes go by
+    return {"leaves": [], "chunk": hashlib.sha256(), "filled": 0}
+
+def update_chunk_tree(tree, view):
+    view = memoryview(view)
+    while view:
+        size = min(len(view), MERKLE_CHUNK_SIZE - tree["filled"])
+        tree["chunk"].update(view[:size])
+        tree["filled"] += size
+        view = view[size:]
+        if tree["filled"] == MERKLE_CHUNK_SIZE:
+            tree["leaves"].append(tree["chunk"].digest())
+            if "journal" in tree:
+                tree["journal"].write(tree["leaves"][-1])
+            tree["chunk"] = hashlib.sha256()
+            tree["filled"] = 0
+    return
+
+def hash_range(content, tree, offset, end):
+    # Runs on the disk worker pool: feed bytes offset to end of an open file, or of cached content, to a chunk tree
+    while offset < end:
+        data = read_at(content, min(HASH_BLOCK_SIZE, end - offset), offset)
+        if not data:
+            raise OSError("file shrank while it was being hashed")
+        update_chunk_tree(tree, data)
+        offset += len(data)
+    return tree
+
+def catch_up_chunk_tree(content, tree, end):
+    # Runs on the disk worker pool: feed a chunk tree the bytes of the first end it has not taken yet
+    return hash_range(content, tree, len(tree["leaves"]) * MERKLE_CHUNK_SIZE + tree["filled"], end)
+
+def load_tree_journal(journal_name, identity=PARTIAL_IDENTITY):
+    # The digests a journal holds, none if there is no journal or it describes another version of the file
+    try:
+        with open(journal_name, "rb") as journal:
+            data = journal.read()
+    except FileNotFoundError:
+        return []
+    if len(data) < TREE_JOURNAL_HEADER.size or TREE_JOURNAL_HEADER.unpack_from(data) != tuple(identity):
+        return []
+    # A digest cut short by a crash is dropped with the rest of its chunk
+    end = len(data) - (len(data) - TREE_JOURNAL_HEADER.size) % 32
+    return [data[start:start + 32] for start in range(TREE_JOURNAL_HEADER.size, end, 32)]
+
+def resume_chunk_tree(content, offset, journal_name, identity=PARTIAL_IDENTITY):
+    # Runs on the disk worker pool: chunk tree of the first offset bytes of a file, from the digests its journal
+    # kept; only the chunks the journal misses are read, normally just the last, unfinished one. With a journal
+    # name, the journal is rewritten to match and records every chunk finished from here on
+    tree = create_chunk_tree()
+    if journal_name is not None:
+        tree["leaves"] = load_tree_journal(journal_name, identity)[:offset // MERKLE_CHUNK_SIZE]
+    hash_range(content, tree, len(tree["leaves"]) * MERKLE_CHUNK_SIZE, offset)
+    if journal_name is not None:
+        journal = open(journal_name, "wb", buffering=0)
+        journal.write(TREE_JOURNAL_HEADER.pack(*identity) + b"".join(tree["leaves"]))
+        tree["journal"] = journal
+    return tree
+
+def close_tree_journal(tree):
+    # Runs on the disk worker pool; the journal stays for a resumed transfer until the caller removes it
+    journal = tree.pop("journal", None)
+    if journal is not None:
+        journal.close()
+    return
+
+def finish_chunk_tree(tree):
+    # All chunk digests, the last chunk possibly short; no bytes at all still make one chunk
+    if tree["filled"] or not tree["leaves"]:
+        tree["leaves"].append(tree["chunk"].digest())
+        tree["chunk"] = hashlib.sha256()
+        tree["filled"] = 0
+    return tree["leaves"]
+
+def merkle_root(leaves):
+    # Pairs of digests hash into their parent until one is left; an odd digest out moves up as it is
+    level = leaves
+    while len(level) > 1:
+        level = [hashlib.sha256(level[index] + level[index + 1]).digest() if index + 1 < len(level) else level[index]
+                 for index in range(0, len(level), 2)]
+    return level[0]
+
+def read_at(content, size, offset):
+    # Runs on the disk worker pool: size bytes at offset of an open file, or of the content of a cached one
+    if isinstance(content, bytes):
+        return content[offset:offset + size]
+    return os.pread(content.fileno(), size, offset)
+
+def overlap_digest(content, offset):
+    # Runs on the disk worker pool: sha256 of the RESUME_CHECK_SIZE bytes before offset
+    start = max(0, offset - RESUME_CHECK_SIZE)
+    return hashlib.sha256(read_at(content, offset - start, start)).digest()
+
+def open_partial_file(partial_name, offset):
+    # Runs on the disk worker pool: a fresh file, or the partial upload cut back to offset
+    if offset == 0:
+        return open(partial_name, "wb", 0)
+    output_file = open(partial_name, "r+b", 0)
+    try:
+        if os.fstat(output_file.fileno()).st_size < offset:
+            raise ValueError("the partial upload is shorter than the offset")
+        output_file.truncate(offset)
+        output_file.seek(offset)
+    except ValueError:
         output_file.close()
-        print("\nReceived file: {}".format(file_name))
+        raise
+    return output_file
+
+async def send_frame_with_file(session, opcode, request_id, payload, content, offset, count, flags=0, tree=None):
+    # Corked, the frame header leaves in the same segment as the first file bytes; returns the file bytes sent.
+    # With a chunk tree, the file is also hashed from byte 0 to the last byte sent
+    connect = session["connect"]
+    hashing = None
+    cork_socket(connect, True)
+    try:
+        await send_frame(session, opcode, request_id, payload, flags=flags, data_length=count)
+        start_time = time.monotonic()
+        if tree is None:
+            sent = await send_file(connect, content, offset, count)
+        else:
+            sent, hashing = await send_file_hashing(connect, content, offset, count, tree)
+    finally:
+        cork_socket(connect, False)
+    tune_session(session, sent, time.monotonic() - start_time)
+    # The last bytes leave before the last range is hashed
+    if hashing is not None:
+        try:
+            await hashing
+        except BaseException:
+            await asyncio.gather(hashing, return_exceptions=True)
+            raise
+    return sent
+
+async def send_file_hashing(connect, content, offset, count, tree):
+    # sendfile range by range; the disk pool hashes each range once it is sent, from the page cache, while the next
+    # one goes out. Returns the bytes sent and the hash job of the last range, still running
+    end = offset + count
+    start = offset
+    hashing = None
+    try:
+        while offset < end:
+            size = min(SENDFILE_RANGE_SIZE, end - offset)
+            sent = await send_file(connect, content, offset, size)
+            # Chunk trees take their bytes in order, one hash job after the other
+            if hashing is not None:
+                await hashing
+            hashing = asyncio.ensure_future(run_disk_job(catch_up_chunk_tree, content, tree, offset + sent))
+            offset += sent
+            if sent < size:
+                break
+    except BaseException:
+        # Never let the file be closed under a hash that is still running
+        if hashing is not None:
+            await asyncio.gather(hashing, return_exceptions=True)
+        raise
+    return offset - start, hashing
+
+async def send_file(connect, content, offset, count):
+    # The kernel copies file pages straight into the socket (sendfile), so file data never
+    # passes through Python; where sendfile is unavailable asyncio falls back to read + send
+    if count == 0:
+        # sock_sendfile rejects an empty range, and there is nothing to send anyway
+        return 0
+    loop = asyncio.get_running_loop()
+    sent = await loop.sock_sendfile(connect, content, offset, count, fallback=True)
+    STATS["bytes_out"] += sent
+    return sent
+
+def worth_compressing(content, file_name, offset, codec):
+    # Runs on the disk worker pool: skip formats that are compressed already, then try a sample
+    if codec == CODEC_NONE or os.path.splitext(file_name)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    sample = read_at(content, COMPRESSION_SAMPLE_SIZE, offset)
+    return len(sample) > 0 and len(CODECS[codec][1](sample)) < len(sample) * COMPRESSIBLE_RATIO
+
+def create_compression_totals(codec):
+    # Raw and wire bytes of one transfer, and the CPU seconds spent compressing or decompressing them
+    return {"codec": codec, "raw": 0, "wire": 0, "cpu": 0.0, "incompressible": 0}
+
+def read_chunk(content, offset, size, totals, tree=None):
+    # Runs on the disk worker pool: read and compress one chunk, or leave it raw if it does not shrink; with a chunk
+    # tree, hash it too, after whatever comes before it
+    chunk = read_at(content, size, offset)
+    if tree is not None:
+        catch_up_chunk_tree(content, tree, offset)
+        update_chunk_tree(tree, chunk)
+    codec, compressed = encode_chunk(chunk, totals)
+    return codec, chunk, compressed
+
+def encode_chunk(chunk, totals):
+    # The codec and compressed bytes of a chunk, or CODEC_NONE and nothing if it does not shrink
+    if totals["codec"] == CODEC_NONE or totals["incompressible"] >= INCOMPRESSIBLE_CHUNKS:
+        return CODEC_NONE, b""
+    start_cpu = time.thread_time()
+    compressed = CODECS[totals["codec"]][1](chunk)
+    totals["cpu"] += time.thread_time() - start_cpu
+    if len(compressed) < len(chunk):
+        totals["incompressible"] = 0
+        return totals["codec"], compressed
+    totals["incompressible"] += 1
+    return CODEC_NONE, b""
+
+def decode_chunk(codec, data, raw_size, totals):
+    # The decompressor stops one byte past the announced size, so a chunk can never expand beyond it
+    if codec != CODEC_NONE:
+        if codec not in CODECS:
+            raise ValueError("unknown codec {}".format(codec))
+        start_cpu = time.thread_time()
+        try:
+            data = CODECS[codec][2]().decompress(data, raw_size + 1)
+        except(zlib.error, OSError, EOFError) as e:
+            raise ValueError("undecodable chunk: {}".format(e))
+        totals["cpu"] += time.thread_time() - start_cpu
+    if len(data) != raw_size:
+        raise ValueError("chunk does not decode to its announced size")
+    return data
+
+def write_chunk(output_file, codec, data, raw_size, totals, tree=None):
+    # Runs on the disk worker pool
+    write_all(output_file, decode_chunk(codec, data, raw_size, totals), tree)
+    return
+
+async def recv_chunks_into_file(session, request_id, output_file, totals, tree=None):
+    # Content sent as DATA frames until one without FLAG_MORE; decoding and writing run on the disk pool
+    while True:
+        frame = await recv_frame(session)
+        if frame is None:
+            raise ConnectionError("Connection closed by client.")
+        opcode, _, flags, chunk_request_id, payload_length = frame
+        if opcode != OP_DATA or chunk_request_id != request_id or \
+                not CHUNK_HEADER.size <= payload_length <= CHUNK_HEADER.size + MAX_CHUNK_SIZE:
+            # The stream can no longer be followed frame by frame
+            raise ConnectionError("Malformed DATA frame for request {}.".format(request_id))
+        raw_size = CHUNK_HEADER.unpack(await recv_exact(session, CHUNK_HEADER.size))[0]
+        data = await recv_exact(session, payload_length - CHUNK_HEADER.size)
+        if raw_size > MAX_CHUNK_SIZE:
+            raise ConnectionError("Chunk of request {} is too large.".format(request_id))
+        try:
+            codec = (flags & CODEC_MASK) >> CODEC_SHIFT
+            await run_disk_job(write_chunk, output_file, codec, data, raw_size, totals, tree)
+        except ValueError as e:
+            raise ConnectionError("Bad chunk for request {}: {}".format(request_id, e))
+        totals["raw"] += raw_size
+        totals["wire"] += payload_length
+        if not flags & FLAG_MORE:
+            return
 
+async def send_file_chunks(session, request_id, content, offset, count, totals, tree=None):
+    # The next chunk is read, compressed and with a chunk tree hashed on the disk pool while the current one is sent
+    end = offset + count
+    job = None
+    try:
+        if count == 0:
+            await send_frame(session, OP_DATA, request_id, CHUNK_HEADER.pack(0))
+            return
+        size = min(COMPRESSION_CHUNK_SIZE, count)
+        job = asyncio.ensure_future(run_disk_job(read_chunk, content, offset, size, totals, tree))
+        while offset < end:
+            codec, chunk, compressed = await job
+            job = None
+            if not chunk:
+                raise ConnectionError("File changed while it was being sent.")
+            offset += len(chunk)
+            if offset < end:
+                size = min(COMPRESSION_CHUNK_SIZE, end - offset)
+                job = asyncio.ensure_future(run_disk_job(read_chunk, content, offset, size, totals, tree))
+            data = compressed if codec != CODEC_NONE else chunk
+            flags = (codec << CODEC_SHIFT) | (FLAG_MORE if offset < end else 0)
+            await send_frame(session, OP_DATA, request_id, CHUNK_HEADER.pack(len(chunk)) + data, flags=flags)
+            totals["raw"] += len(chunk)
+            totals["wire"] += CHUNK_HEADER.size + len(data)
+    finally:
+        # Never let the file be closed under a read that is still running
+        if job is not None:
+            await asyncio.gather(job, return_exceptions=True)
+    return
+
+async def discard_chunks(session, request_id):
+    # Skip the DATA frames of an upload we cannot store so the next request is still found
+    while True:
+        frame = await recv_frame(session)
+        if frame is None or frame[0] != OP_DATA or frame[3] != request_id:
+            raise ConnectionError("Malformed DATA frame for request {}.".format(request_id))
+        await discard_payload(session, frame[4])
+        if not frame[2] & FLAG_MORE:
+            return
+
+async def store_file_to_server(session, request_id, flags, payload_length):
+    # With FLAG_CHUNKED the content follows as DATA frames instead of inside this frame
+    chunked = bool(flags & FLAG_CHUNKED)
+    consumed = 0
+    try:
+        # Payload: offset, file name length, file name, then the file content from the offset to the end of the frame.
+        # Nothing is read past the frame, so a bad length cannot swallow the next request
+        if payload_length < STOR_REQUEST.size:
+            raise ValueError("frame shorter than the request")
+        offset, file_name_size = STOR_REQUEST.unpack(await recv_exact(session, STOR_REQUEST.size))
+        consumed = STOR_REQUEST.size
+        if consumed + file_name_size > payload_length:
+            raise ValueError("file name longer than the frame")
+        name = await recv_exact(session, file_name_size)
+        consumed += file_name_size
+        file_name = name.decode('utf-8')
+        file_size = payload_length - consumed
+        if chunked and file_size:
+            raise ValueError("content in the frame of a chunked upload")
+        if not valid_name(file_name):
+            raise ValueError("invalid file name")
+    except(struct.error, UnicodeDecodeError, ValueError):
+        LOG.error("Error to unpack file name.")
+        await discard_payload(session, payload_length - consumed)
+        if chunked:
+            await discard_chunks(session, request_id)
+        await send_frame(session, OP_STOR, request_id, status=STATUS_BAD_REQUEST)
+        return
+
+    try:
+        # Open a temporary file unbuffered so received slices go straight to the kernel
+        start_time = time.time()
+        partial_name = file_name + PARTIAL_SUFFIX
+        output_file = await run_disk_job(open_partial_file, partial_name, offset)
+    except(OSError, ValueError):
+        LOG.error("Error opening %s for writing at byte %s.", file_name, offset)
+        await discard_payload(session, file_size)
+        if chunked:
+            await discard_chunks(session, request_id)
+        await send_frame(session, OP_STOR, request_id, status=STATUS_ERROR)
+        return
+
+    # Uploads of more than one chunk keep a journal of their chunk digests, for resuming without hashing the prefix
+    journal_name = file_name + TREE_SUFFIX if chunked or offset + file_size > MERKLE_CHUNK_SIZE else None
+    tree = None
+    try:
+        # Receive file content
+        LOG.info("Receiving %s from byte %s...", file_name, offset)
+        try:
+            # The content is hashed as it is written, for the client to check, after the prefix kept from before
+            tree = await run_disk_job(resume_chunk_tree, output_file, offset, journal_name)
+            if chunked:
+                totals = create_compression_totals(CODEC_NONE)
+                await recv_chunks_into_file(session, request_id, output_file, totals, tree)
+                file_size = totals["raw"]
+            else:
+                await run_disk_job(preallocate_file, output_file, offset + file_size)
+                await recv_into_file(session, output_file, file_size, tree)
+        except(ConnectionError, asyncio.CancelledError):
+            # Keep exactly what reached the disk, not the preallocated tail, so the upload can resume from there
+            await run_disk_job(output_file.truncate)
+            raise
+        finally:
+            if tree is not None:
+                await run_disk_job(close_tree_journal, tree)
+            await run_disk_job(output_file.close)
+        # Readers never see a half-written file, and the rename bumps the directory mtime for every worker
+        await run_disk_job(os.replace, partial_name, file_name)
+        await run_disk_job(remove_if_exists, file_name + TREE_SUFFIX)
+        invalidate_listing_cache()
+        drop_cached_file(file_name)
+        leaves = finish_chunk_tree(tree)
+        await index_content(file_name, leaves)
+        if chunked:
+            log_transfer(session, "STOR", file_name, file_size, start_time, offset=offset, wire_bytes=totals["wire"],
+                         codec_cpu=round(totals["cpu"], 3))
+        else:
+            log_transfer(session, "STOR", file_name, file_size, start_time, offset=offset)
+    except ConnectionError:
+        # The stream is broken, the session ends here; the partial file waits for a resumed upload
+        LOG.error("Error receiving file content from client.")
+        raise
     except OSError:
-        print("\nError writing file.")
+        LOG.error("Error writing file.")
+        await run_disk_job(remove_if_exists, partial_name)
+        await run_disk_job(remove_if_exists, file_name + TREE_SUFFIX)
+        await send_frame(session, OP_STOR, request_id, status=STATUS_ERROR)
         return
-    except struct.error:
-        print("\nError to unpack file size.")
+
+    # Send upload performance details
+    response = STOR_RESPONSE.pack(time.time() - start_time, offset + file_size, merkle_root(leaves))
+    await send_frame(session, OP_STOR, request_id, response)
+    return
+
+def read_partial_upload(partial_name):
+    # Runs on the disk worker pool: size and overlap digest of a partial upload
+    with open(partial_name, "rb") as content:
+        size = os.fstat(content.fileno()).st_size
+        return size, overlap_digest(content, size)
+
+async def query_partial_upload(session, request_id, payload_length):
+    if payload_length > MAX_NAME_PAYLOAD:
+        # Never buffer an oversized request; skip it in bounded chunks instead
+        LOG.warning("File name too long.")
+        await discard_payload(session, payload_length)
+        await send_frame(session, OP_REST, request_id, status=STATUS_BAD_REQUEST)
         return
-    except socket.error:
-        print("\nError to send confirmation message to client or receiving file content from client.")
+
+    try:
+        # Payload: the file name
+        file_name = (await recv_exact(session, payload_length)).decode('utf-8')
+    except UnicodeDecodeError:
+        LOG.error("Error decoding file name.")
+        await send_frame(session, OP_REST, request_id, status=STATUS_BAD_REQUEST)
         return
-    except Exception as e:
-        print(f"\nUnexpected error receiving file content: {e}")
+    if not valid_name(file_name):
+        LOG.warning("Invalid file name %s.", file_name)
+        await send_frame(session, OP_REST, request_id, status=STATUS_BAD_REQUEST)
         return
-    
+
     try:
-        # Send upload performance details
-        connect.send(struct.pack("f", time.time() - start_time))
-        connect.send(struct.pack("i", file_size))
-    except struct.error:
-        print("\nError to send performance details (struct).")
-    except socket.error:
-        print("\nError to send performance details (socket).")
-    except Exception as e:
-        print(f"\nUnexpected error sending performance details: {e}")
+        size, digest = await run_disk_job(read_partial_upload, file_name + PARTIAL_SUFFIX)
+    except(FileNotFoundError, IsADirectoryError):
+        await send_frame(session, OP_REST, request_id, status=STATUS_NOT_FOUND)
+        return
+    except OSError:
+        LOG.error("Error reading the partial upload of %s.", file_name)
+        await send_frame(session, OP_REST, request_id, status=STATUS_ERROR)
+        return
+
+    LOG.info("Partial upload of %s holds %s bytes", file_name, size)
+    await send_frame(session, OP_REST, request_id, REST_RESPONSE.pack(size, digest))
+    return
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return
+
+def invalidate_listing_cache():
+    LISTING_CACHE["mtime_ns"] = None
+    LISTING_CACHE["entries"] = None
+    LISTING_CACHE["oversized"] = False
+    return
+
+def scan_directory():
+    # Yields (encoded name, size) of every finished file; only one directory entry is held at a time
+    with os.scandir(".") as listing:
+        for entry in listing:
+            try:
+                if not entry.is_file() or entry.name.endswith(TEMPORARY_SUFFIXES) or entry.name == CONTENT_INDEX_FILE:
+                    continue
+                file_size = entry.stat().st_size
+            except FileNotFoundError:
+                # Removed between reading the directory and looking at the entry
+                continue
+            yield entry.name.encode('utf-8', 'surrogateescape'), file_size
+
+def load_listing():
+    # Runs on the disk worker pool; returns the sorted entries, or None for a directory too large to hold
+    mtime_ns = os.stat(".").st_mtime_ns
+    if LISTING_CACHE["mtime_ns"] == mtime_ns:
+        return None if LISTING_CACHE["oversized"] else LISTING_CACHE["entries"]
+
+    entries = []
+    scan = scan_directory()
+    try:
+        for entry in scan:
+            if len(entries) == LISTING_CACHE_MAX_ENTRIES:
+                entries = None
+                break
+            entries.append(entry)
     finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
-    return
-
-def list_files_from_server(connect, buffer_size, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-    
-    print("Listing files...")
-    
-    try:
-        # Get list of files in directory
-        listing = os.listdir(os.getcwd())
-        
-        # Send number of files in directory
-        connect.send(struct.pack("i", len(listing)))
-        
-        total_directory_size = 0
-        count_files = 0
-        for file in listing:
-            file_name_size = len(file)
-            
-            # Send file name and size
-            connect.send(struct.pack("i", file_name_size))
-            connect.send(file.encode('utf-8'))
-            
-            # Send file content size
-            file_size = os.path.getsize(file)
-            connect.send(struct.pack("i", file_size))
-            
-            total_directory_size += file_size
-            
-            # Wait for client confirmation
-            connect.recv(buffer_size)
-
-            count_files += 1
-        
-        # Send total directory size
-        connect.send(struct.pack("i", total_directory_size))
-        
-        # Send number of files in directory
-        connect.send(struct.pack("i", count_files))
-        
-        # Wait for client confirmation
-        connect.recv(buffer_size)
-        print("\nSuccessfully sent file listing")
+        scan.close()
+    if entries is not None:
+        entries.sort()
+
+    if time.time_ns() - mtime_ns > LISTING_CACHE_SETTLE_NS:
+        LISTING_CACHE["mtime_ns"] = mtime_ns
+        LISTING_CACHE["entries"] = entries
+        LISTING_CACHE["oversized"] = entries is None
+    return entries
+
+def read_page(scan, count):
+    # Runs on the disk worker pool: the next count entries of a directory or sorted scan
+    return list(itertools.islice(scan, count))
+
+def read_sorted_window(cursor, count):
+    # Runs on the disk worker pool: the count smallest names after the cursor, in one directory pass
+    # that holds a heap of count entries
+    return sorted(heapq.nsmallest(count, (entry for entry in scan_directory() if entry[0] > cursor)))
+
+def read_run(run_file):
+    run_file.seek(0)
+    while True:
+        header = run_file.read(LIST_ENTRY.size)
+        if not header:
+            return
+        file_size, file_name_size = LIST_ENTRY.unpack(header)
+        yield run_file.read(file_name_size), file_size
+
+def sorted_scan(cursor):
+    # Yields the entries after the cursor in name order: the directory is cut into sorted runs of
+    # LISTING_CACHE_MAX_ENTRIES entries kept in temporary files, which are then merged
+    entries = (entry for entry in scan_directory() if entry[0] > cursor)
+    runs = []
+    try:
+        while True:
+            run = sorted(itertools.islice(entries, LISTING_CACHE_MAX_ENTRIES))
+            if not runs and len(run) < LISTING_CACHE_MAX_ENTRIES:
+                # Everything fit in one run; no need to go through the disk
+                yield from run
+                return
+            if not run:
+                break
+            run_file = tempfile.TemporaryFile()
+            runs.append(run_file)
+            run_file.write(encode_list_page(run))
+        yield from heapq.merge(*(read_run(run_file) for run_file in runs))
+    finally:
+        entries.close()
+        for run_file in runs:
+            run_file.close()
+
+def encode_list_page(page):
+    parts = []
+    for file_name, file_size in page:
+        parts.append(LIST_ENTRY.pack(file_size, len(file_name)))
+        parts.append(file_name)
+    return b"".join(parts)
+
+async def list_files_from_server(session, request_id, payload_length):
+    if payload_length < LIST_REQUEST.size or payload_length > LIST_REQUEST.size + MAX_NAME_PAYLOAD:
+        LOG.warning("Malformed list request.")
+        await discard_payload(session, payload_length)
+        await send_frame(session, OP_LIST, request_id, status=STATUS_BAD_REQUEST)
+        return
+
+    # Payload: options, page size, entry limit (0 for all) and the name to continue after (empty to start)
+    options, page_size, limit = LIST_REQUEST.unpack(await recv_exact(session, LIST_REQUEST.size))
+    cursor = await recv_exact(session, payload_length - LIST_REQUEST.size)
+    page_size = min(page_size or LIST_PAGE_SIZE, MAX_LIST_PAGE_SIZE)
+    # A cursor is a name, so listings that continue from one or stop early to hand one out go in name order
+    in_order = bool(options & LIST_SORTED or cursor or limit)
+    LOG.info("Listing files...")
+
+    listed = 0
+    total_size = 0
+    status = STATUS_OK
+    scan = None
+    try:
+        entries = await run_disk_job(load_listing)
+        if entries is not None:
+            index = bisect.bisect_right(entries, (cursor, float("inf")))
+        elif in_order and 0 < limit <= LISTING_CACHE_MAX_ENTRIES:
+            # Too many entries to hold, but the limit is not: keep only the first ones after the cursor
+            entries = await run_disk_job(read_sorted_window, cursor, limit)
+            index = 0
+        elif in_order:
+            scan = sorted_scan(cursor)
+        else:
+            scan = scan_directory()
+
+        # Every page leaves as soon as it is read, flagged with FLAG_MORE; the summary frame closes the listing
+        while limit == 0 or listed < limit:
+            count = page_size if limit == 0 else min(page_size, limit - listed)
+            if entries is not None:
+                page = entries[index:index + count]
+                index += len(page)
+            else:
+                page = await run_disk_job(read_page, scan, count)
+            if page:
+                await send_frame(session, OP_LIST, request_id, encode_list_page(page), flags=FLAG_MORE)
+                listed += len(page)
+                total_size += sum(file_size for _, file_size in page)
+                cursor = page[-1][0]
+            if len(page) < count:
+                break
     except OSError as e:
-        print(f"\nOS error when accessing directory or file: {e}")
-    except struct.error as e:
-        print(f"\nError packing/unpacking struct data: {e}")
-    except socket.error as e:
-        print(f"\nSocket error when sending data: {e}")
-    except Exception as e:
-        print(f"\nAn unexpected error occurred: {e}")
+        LOG.error("OS error when accessing directory or file: %s", e)
+        status = STATUS_ERROR
     finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        if scan is not None:
+            scan.close()
+
+    # The cursor to continue from is only handed out when the limit cut the listing short
+    next_cursor = cursor if status == STATUS_OK and limit and listed == limit else b""
+    await send_frame(session, OP_LIST, request_id, LIST_SUMMARY.pack(listed, total_size) + next_cursor, status)
+    if status == STATUS_OK:
+        LOG.info("Successfully sent %s file entries", listed)
     return
 
-def retrieve_file_from_server(connect, buffer_size, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
+def file_cache_key(stat):
+    # A replaced file has a new inode, a rewritten one a new size or mtime
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+def lookup_cached_file(file_name, stat):
+    # The cache entry of file_name if it still holds the file as it is on disk, else None
+    if not FILE_CACHE["budget"]:
+        return None
+    entry = FILE_CACHE["entries"].get(file_name)
+    if entry is not None and entry["key"] == file_cache_key(stat):
+        FILE_CACHE["entries"].move_to_end(file_name)
+        STATS["cache_hits"] += 1
+        return entry
+    drop_cached_file(file_name)
+    STATS["cache_misses"] += 1
+    return None
+
+def admit_to_file_cache(file_name, stat):
+    # Small files are copied in the second time they are asked for while they are still remembered
+    if not 0 < stat.st_size <= min(FILE_CACHE_MAX_FILE_SIZE, FILE_CACHE["budget"]):
+        return False
+    key = (file_name,) + file_cache_key(stat)
+    seen = FILE_CACHE["seen"]
+    if key in seen:
+        del seen[key]
+        return True
+    seen[key] = True
+    if len(seen) > FILE_CACHE_SEEN_ENTRIES:
+        seen.popitem(last=False)
+    return False
+
+def read_file_for_cache(content):
+    # Runs on the disk worker pool: the whole file and the key it had while it was read, or None if it changed
+    before = os.fstat(content.fileno())
+    data = os.pread(content.fileno(), before.st_size, 0)
+    after = os.fstat(content.fileno())
+    if len(data) != before.st_size or file_cache_key(after) != file_cache_key(before):
+        return None
+    return data, file_cache_key(before)
+
+def store_cached_file(file_name, key, data, root):
+    # The least recently used files make room for the new one
+    drop_cached_file(file_name)
+    entry = {"key": key, "data": data, "root": root}
+    FILE_CACHE["entries"][file_name] = entry
+    FILE_CACHE["bytes"] += len(data)
+    while FILE_CACHE["bytes"] > FILE_CACHE["budget"]:
+        _, evicted = FILE_CACHE["entries"].popitem(last=False)
+        FILE_CACHE["bytes"] -= len(evicted["data"])
+        STATS["cache_evictions"] += 1
+    STATS["cache_bytes"] = FILE_CACHE["bytes"]
+    return entry
+
+def drop_cached_file(file_name):
+    # Called wherever this process replaces or removes a file; changes made elsewhere show in the key
+    entry = FILE_CACHE["entries"].pop(file_name, None)
+    if entry is not None:
+        FILE_CACHE["bytes"] -= len(entry["data"])
+        STATS["cache_bytes"] = FILE_CACHE["bytes"]
+    return
+
+async def retrieve_file_from_server(session, request_id, payload_length):
+    if payload_length < RETR_REQUEST.size or payload_length > RETR_REQUEST.size + MAX_NAME_PAYLOAD:
+        # Never buffer an oversized request; skip it in bounded chunks instead
+        LOG.warning("Malformed download request.")
+        await discard_payload(session, payload_length)
+        await send_frame(session, OP_RETR, request_id, status=STATUS_BAD_REQUEST)
+        return
 
     try:
-        # Send initial confirmation to client
-        connect.send(b"1")
-    
-        # Receive file name
-        file_name_length = struct.unpack("h", connect.recv(2))[0]
-        file_name = connect.recv(file_name_length).decode('utf-8')
-    except(struct.error, socket.error):
-        print("\nError sending initial confirmation to client or receiving file name.")
+        # Payload: the offset the client holds, the overlap digest of its copy, then the file name
+        offset, client_digest = RETR_REQUEST.unpack(await recv_exact(session, RETR_REQUEST.size))
+        file_name = (await recv_exact(session, payload_length - RETR_REQUEST.size)).decode('utf-8')
+    except UnicodeDecodeError:
+        LOG.error("Error decoding file name.")
+        await send_frame(session, OP_RETR, request_id, status=STATUS_BAD_REQUEST)
+        return
+    if not valid_name(file_name):
+        LOG.warning("Invalid file name %s.", file_name)
+        await send_frame(session, OP_RETR, request_id, status=STATUS_BAD_REQUEST)
+        return
+
+    content = None
+    start_time = time.time()
+    try:
+        # A hot file is served from memory; the stat only checks that it did not change since it was cached
+        stat = await run_disk_job(os.stat, file_name)
+        entry = lookup_cached_file(file_name, stat)
+        if entry is None:
+            # Open the file and take its size from the open descriptor
+            content = await run_disk_job(open, file_name, "rb")
+            file_size = os.fstat(content.fileno()).st_size
+        else:
+            file_size = len(entry["data"])
+    except(FileNotFoundError, IsADirectoryError):
+        LOG.warning("File name not valid")
+        await send_frame(session, OP_RETR, request_id, status=STATUS_NOT_FOUND)
         return
-    
+    except OSError:
+        LOG.error("Error opening %s for reading.", file_name)
+        await send_frame(session, OP_RETR, request_id, status=STATUS_ERROR)
+        return
+
     try:
-        # Check if file exists
-        if os.path.isfile(file_name):
-            # If the file exists, send the file size
-            connect.send(struct.pack("i", os.path.getsize(file_name)))
+        if entry is None and admit_to_file_cache(file_name, stat):
+            cached = await run_disk_job(read_file_for_cache, content)
+            if cached is not None:
+                # Without cached digests the root is taken from the copy in memory, not from the disk again
+                root = await run_disk_job(cached_root, file_name)
+                if root == bytes(32):
+                    root = merkle_root(finish_chunk_tree(await run_disk_job(catch_up_chunk_tree, cached[0],
+                                                                            create_chunk_tree(), len(cached[0]))))
+                entry = store_cached_file(file_name, cached[1], cached[0], root)
+                file_size = len(entry["data"])
+        source = content if entry is None else entry["data"]
+
+        # Resume only where the client's copy ends with the same bytes; otherwise start over
+        if 0 < offset <= file_size and await run_disk_job(overlap_digest, source, offset) == client_digest:
+            LOG.info("Resuming %s from byte %s", file_name, offset)
         else:
-            # If the file doesn't exist, send -1
-            print("\nFile name not valid")
-            connect.send(struct.pack("i", -1))
+            offset = 0
+        root = entry["root"] if entry is not None else await run_disk_job(cached_root, file_name)
+        # Without a cached root the file is hashed as it is sent, and the root follows the content
+        tree = create_chunk_tree() if root == bytes(32) else None
+        trailer = FLAG_TRAILER if tree is not None else 0
+
+        if await run_disk_job(worth_compressing, source, file_name, offset, session["codec"]):
+            # Compressible content leaves as DATA frames, one compressed chunk each
+            totals = create_compression_totals(session["codec"])
+            await send_frame(session, OP_RETR, request_id, RETR_RESPONSE.pack(offset, root),
+                             flags=FLAG_CHUNKED | trailer)
+            await send_file_chunks(session, request_id, source, offset, file_size - offset, totals, tree)
+            if tree is not None:
+                await send_root_trailer(session, request_id, source, file_name, stat, tree, file_size)
+            log_transfer(session, "RETR", file_name, file_size - offset, start_time, offset=offset,
+                         source="disk" if entry is None else "cache", codec=CODECS[totals["codec"]][0],
+                         wire_bytes=totals["wire"], codec_cpu=round(totals["cpu"], 3))
+            return
+
+        response = RETR_RESPONSE.pack(offset, root)
+        if entry is not None:
+            # Header, response and content leave from memory in one sendmsg call
+            header = FRAME_HEADER.pack(OP_RETR, STATUS_OK, 0, request_id, len(response) + file_size - offset)
+            await send_buffers(session["connect"], [header, response, memoryview(entry["data"])[offset:]])
+            log_transfer(session, "RETR", file_name, file_size - offset, start_time, offset=offset, source="cache")
             return
-    except(OSError, struct.error, socket.error):
-        print("\nError checking file existence or sending file size.")
+
+        # The frame announces the size of what follows, then the rest of the file leaves in one zero-copy call
+        sent = await send_frame_with_file(session, OP_RETR, request_id, response, content, offset, file_size - offset,
+                                          trailer, tree)
+        if sent != file_size - offset:
+            # The file shrank while being sent; the frame length can no longer be honoured
+            raise ConnectionError("{} changed while it was being sent.".format(file_name))
+        if tree is not None:
+            await send_root_trailer(session, request_id, content, file_name, stat, tree, file_size)
+        log_transfer(session, "RETR", file_name, sent, start_time, offset=offset, source="disk")
+    finally:
+        if content is not None:
+            await run_disk_job(content.close)
+    return
+
+async def send_root_trailer(session, request_id, content, file_name, stat, tree, file_size):
+    # The root of a file hashed while it was sent, in a HASH frame after the content, or status error if it could
+    # not be hashed; its digests are cached so the next download of it carries the root up front
+    try:
+        await run_disk_job(catch_up_chunk_tree, content, tree, file_size)
+    except OSError as e:
+        LOG.error("Error hashing %s: %s", file_name, e)
+        await send_frame(session, OP_HASH, request_id, status=STATUS_ERROR)
         return
-    
+    leaves = finish_chunk_tree(tree)
+    await send_frame(session, OP_HASH, request_id, HASH_RESPONSE.pack(merkle_root(leaves)))
     try:
-        # Wait for ok to send file
-        connect.recv(buffer_size)
-    
-        # Enter loop to send file
-        start_time = time.time()
-        print("Sending file", file_name)
+        await run_disk_job(save_sent_leaves, file_name, stat, leaves)
+    except OSError as e:
+        LOG.error("Error caching the digests of %s: %s", file_name, e)
+    return
+
+async def recv_name_request(session, opcode, request_id, payload_length, meta):
+    # Reads the fixed fields of a request followed by a file name; answers BAD_REQUEST and returns None if malformed
+    if payload_length < meta.size or payload_length > meta.size + MAX_NAME_PAYLOAD:
+        LOG.warning("Malformed %s request.", OPCODE_NAMES[opcode])
+        await discard_payload(session, payload_length)
+        await send_frame(session, opcode, request_id, status=STATUS_BAD_REQUEST)
+        return None
+    try:
+        fields = meta.unpack(await recv_exact(session, meta.size))
+        file_name = (await recv_exact(session, payload_length - meta.size)).decode('utf-8')
+    except UnicodeDecodeError:
+        LOG.error("Error decoding file name.")
+        await send_frame(session, opcode, request_id, status=STATUS_BAD_REQUEST)
+        return None
+    if not valid_name(file_name):
+        LOG.warning("Invalid file name %s.", file_name)
+        await send_frame(session, opcode, request_id, status=STATUS_BAD_REQUEST)
+        return None
+    return fields, file_name
+
+def hash_content(content):
+    # Runs on the disk worker pool: chunk tree of a whole open file, read into one reused buffer
+    tree = create_chunk_tree()
+    view = memoryview(bytearray(HASH_BLOCK_SIZE))
+    content.seek(0)
+    while True:
+        size = content.readinto(view)
+        if not size:
+            break
+        update_chunk_tree(tree, view[:size])
+    return tree
+
+def digests_path(file_name):
+    return os.path.join(DIGESTS_DIRECTORY, hashlib.sha256(file_name.encode('utf-8', 'surrogateescape')).hexdigest())
+
+def save_leaves(file_name, leaves):
+    # Runs on the disk worker pool: cache the chunk digests of file_name as it is now; returns its stat
+    stat = os.stat(file_name)
+    os.makedirs(DIGESTS_DIRECTORY, exist_ok=True)
+    descriptor, temporary_name = tempfile.mkstemp(dir=DIGESTS_DIRECTORY)
+    try:
+        with open(descriptor, "wb") as digests:
+            digests.write(DIGESTS_HEADER.pack(stat.st_size, stat.st_mtime_ns))
+            digests.write(b"".join(leaves))
+        os.replace(temporary_name, digests_path(file_name))
+    except OSError:
+        remove_if_exists(temporary_name)
+        raise
+    return stat
+
+def save_sent_leaves(file_name, stat, leaves):
+    # Runs on the disk worker pool: cache the digests of a file hashed while it was sent, unless it has changed
+    # since it was opened
+    if file_cache_key(os.stat(file_name)) == file_cache_key(stat):
+        save_leaves(file_name, leaves)
+    return
+
+def load_leaves(file_name):
+    # Runs on the disk worker pool: the cached chunk digests, or None if there are none for the file as it is now
+    stat = os.stat(file_name)
+    try:
+        with open(digests_path(file_name), "rb") as digests:
+            data = digests.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < DIGESTS_HEADER.size or (len(data) - DIGESTS_HEADER.size) % 32 or \
+            DIGESTS_HEADER.unpack_from(data) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    return [data[start:start + 32] for start in range(DIGESTS_HEADER.size, len(data), 32)]
+
+def file_leaves(file_name):
+    # Runs on the disk worker pool: cached chunk digests, or hash the file once and cache them
+    leaves = load_leaves(file_name)
+    if leaves is None:
         with open(file_name, "rb") as content:
-            while True:
-                data = content.read(buffer_size)
-                if not data:
-                    break
-                connect.send(data)
-    except(OSError, socket.error):
-        print("\nError receiving OK from client or reading/sending file data.")
+            leaves = finish_chunk_tree(hash_content(content))
+        try:
+            save_leaves(file_name, leaves)
+        except OSError as e:
+            LOG.error("Error caching the digests of %s: %s", file_name, e)
+    return leaves
+
+def cached_root(file_name):
+    # Runs on the disk worker pool: Merkle root from the cache, zeros when it would have to be computed
+    leaves = load_leaves(file_name)
+    return merkle_root(leaves) if leaves is not None else bytes(32)
+
+async def send_file_size(session, request_id, payload_length):
+    request = await recv_name_request(session, OP_SIZE, request_id, payload_length, NAME_REQUEST)
+    if request is None:
         return
-    
     try:
-        # Get client go-ahead, then send download details
-        connect.recv(buffer_size)
-        connect.send(struct.pack("f", time.time() - start_time))
-    except(struct.error, socket.error):
-        print("\nError sending download details.")
+        file_size = (await run_disk_job(os.stat, request[1])).st_size
+    except FileNotFoundError:
+        await send_frame(session, OP_SIZE, request_id, status=STATUS_NOT_FOUND)
+        return
+    except OSError:
+        await send_frame(session, OP_SIZE, request_id, status=STATUS_ERROR)
+        return
+    await send_frame(session, OP_SIZE, request_id, SIZE_RESPONSE.pack(file_size))
+    return
+
+async def send_file_hash(session, request_id, payload_length):
+    request = await recv_name_request(session, OP_HASH, request_id, payload_length, NAME_REQUEST)
+    if request is None:
+        return
+    try:
+        # Answered from the digest cache; only a file nobody hashed yet is read, on the disk pool
+        digest = merkle_root(await run_disk_job(file_leaves, request[1]))
+    except(FileNotFoundError, IsADirectoryError):
+        await send_frame(session, OP_HASH, request_id, status=STATUS_NOT_FOUND)
+        return
+    except OSError:
+        LOG.error("Error hashing %s.", request[1])
+        await send_frame(session, OP_HASH, request_id, status=STATUS_ERROR)
+        return
+    await send_frame(session, OP_HASH, request_id, HASH_RESPONSE.pack(digest))
+    return
+
+async def send_file_tree(session, request_id, payload_length):
+    request = await recv_name_request(session, OP_TREE, request_id, payload_length, NAME_REQUEST)
+    if request is None:
+        return
+    try:
+        leaves = await run_disk_job(file_leaves, request[1])
+        file_size = (await run_disk_job(os.stat, request[1])).st_size
+    except(FileNotFoundError, IsADirectoryError):
+        await send_frame(session, OP_TREE, request_id, status=STATUS_NOT_FOUND)
+        return
+    except OSError:
+        LOG.error("Error hashing %s.", request[1])
+        await send_frame(session, OP_TREE, request_id, status=STATUS_ERROR)
+        return
+    await send_frame(session, OP_TREE, request_id, TREE_RESPONSE.pack(file_size, MERKLE_CHUNK_SIZE) + b"".join(leaves))
+    return
+
+async def send_file_range(session, request_id, payload_length):
+    request = await recv_name_request(session, OP_GET, request_id, payload_length, RANGE_REQUEST)
+    if request is None:
+        return
+    (offset, length), file_name = request
+
+    start_time = time.time()
+    try:
+        content = await run_disk_job(open, file_name, "rb")
+    except(FileNotFoundError, IsADirectoryError):
+        await send_frame(session, OP_GET, request_id, status=STATUS_NOT_FOUND)
+        return
+    except OSError:
+        LOG.error("Error opening %s for reading.", file_name)
+        await send_frame(session, OP_GET, request_id, status=STATUS_ERROR)
+        return
+
+    try:
+        if offset + length > os.fstat(content.fileno()).st_size:
+            await send_frame(session, OP_GET, request_id, status=STATUS_BAD_REQUEST)
+            return
+        # One range of a segmented download: the frame carries exactly the requested bytes
+        if await send_frame_with_file(session, OP_GET, request_id, b"", content, offset, length) != length:
+            raise ConnectionError("{} changed while it was being sent.".format(file_name))
+        log_transfer(session, "GET", file_name, length, start_time, offset=offset)
     finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        await run_disk_job(content.close)
     return
 
-def delete_file_from_server(connect, buffer_size, quiet_mode):
-    start_time = 0
+def open_segments_file(segments_name, offset):
+    # Runs on the disk worker pool: the segments file is never truncated here, other sessions fill other ranges
+    output_file = open(os.open(segments_name, os.O_WRONLY | os.O_CREAT, 0o666), "wb", 0)
+    output_file.seek(offset)
+    return output_file
 
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
+async def store_file_range(session, request_id, payload_length):
+    consumed = 0
+    try:
+        # Payload: offset, file name length, file name, then the segment content up to the end of the frame
+        if payload_length < PUT_REQUEST.size:
+            raise ValueError("frame shorter than the request")
+        offset, file_name_size = PUT_REQUEST.unpack(await recv_exact(session, PUT_REQUEST.size))
+        consumed = PUT_REQUEST.size
+        if consumed + file_name_size > payload_length:
+            raise ValueError("file name longer than the frame")
+        name = await recv_exact(session, file_name_size)
+        consumed += file_name_size
+        file_name = name.decode('utf-8')
+        length = payload_length - consumed
+        if not valid_name(file_name):
+            raise ValueError("invalid file name")
+    except(struct.error, UnicodeDecodeError, ValueError):
+        LOG.error("Error to unpack file name.")
+        await discard_payload(session, payload_length - consumed)
+        await send_frame(session, OP_PUT, request_id, status=STATUS_BAD_REQUEST)
+        return
 
+    start_time = time.time()
     try:
-        connect.send(b"1")  # Send go-ahead
-    except socket.error:
-        print("\nError sending go-ahead signal to client.")
+        output_file = await run_disk_job(open_segments_file, file_name + SEGMENTS_SUFFIX, offset)
+    except OSError:
+        LOG.error("Error opening %s for writing.", file_name)
+        await discard_payload(session, length)
+        await send_frame(session, OP_PUT, request_id, status=STATUS_ERROR)
         return
-    
+
+    # Every chunk of the range is hashed as it is written, so the client can check and resend it on its own
+    tree = create_chunk_tree()
     try:
-        # Receive file name
-        file_name_length = struct.unpack("h", connect.recv(2))[0]
-        file_name = connect.recv(file_name_length).decode('utf-8')
-    except(struct.error, socket.error):
-        print("\nError receiving file details.")
+        # Same double-buffered receive as STOR, starting at the segment offset
+        await recv_into_file(session, output_file, length, tree)
+    except ConnectionError:
+        raise
+    except OSError:
+        LOG.error("Error writing file.")
+        await send_frame(session, OP_PUT, request_id, status=STATUS_ERROR)
+        return
+    finally:
+        await run_disk_job(output_file.close)
+    await send_frame(session, OP_PUT, request_id, b"".join(finish_chunk_tree(tree)))
+    log_transfer(session, "PUT", file_name, length, start_time, offset=offset)
+    return
+
+def commit_segments(file_name, file_size, expected_root):
+    # Runs on the disk worker pool: the whole file must hash as the client said before it replaces the old one;
+    # returns its chunk digests, or None if it does not match
+    segments_name = file_name + SEGMENTS_SUFFIX
+    with open(os.open(segments_name, os.O_RDWR | os.O_CREAT, 0o666), "r+b", 0) as content:
+        content.truncate(file_size)
+        leaves = finish_chunk_tree(hash_content(content))
+    if merkle_root(leaves) != expected_root:
+        os.remove(segments_name)
+        return None
+    os.replace(segments_name, file_name)
+    return leaves
+
+async def commit_file_segments(session, request_id, payload_length):
+    request = await recv_name_request(session, OP_COMMIT, request_id, payload_length, COMMIT_REQUEST)
+    if request is None:
         return
-    
+    (file_size, root), file_name = request
+
+    start_time = time.time()
     try:
-        # Check if file exists
-        if os.path.isfile(file_name):
-            connect.send(struct.pack("i", 1))
-        else:
-            # File doesn't exist
-            connect.send(struct.pack("i", -1))
-    except(OSError, struct.error, socket.error):
-        print("\nError checking file existence or sending file existence confirmation.")
+        leaves = await run_disk_job(commit_segments, file_name, file_size, root)
+    except OSError:
+        LOG.error("Error committing %s.", file_name)
+        await send_frame(session, OP_COMMIT, request_id, status=STATUS_ERROR)
+        return
+    if leaves is None:
+        LOG.warning("Segments of %s do not match the client's hash, dropped.", file_name)
+        await send_frame(session, OP_COMMIT, request_id, status=STATUS_ERROR)
         return
 
+    invalidate_listing_cache()
+
+    drop_cached_file(file_name)
+    await index_content(file_name, leaves)
+    LOG.info("Committed %s, %s bytes, in %.3fs", file_name, file_size, time.time() - start_time)
+    await send_frame(session, OP_COMMIT, request_id)
+    return
+
+def apply_index_record(record):
+    # A newer record for a name replaces the older one; a record without a root removes the name
+    file_name = record["name"]
+    previous = CONTENT_INDEX["by_name"].pop(file_name, None)
+    if previous is not None:
+        names = CONTENT_INDEX["by_digest"][previous["root"]]
+        names.discard(file_name)
+        if not names:
+            del CONTENT_INDEX["by_digest"][previous["root"]]
+    if record["root"] is not None:
+        CONTENT_INDEX["by_name"][file_name] = record
+        CONTENT_INDEX["by_digest"].setdefault(record["root"], set()).add(file_name)
+    return
+
+def refresh_content_index():
+    # Runs with the index lock held: replay the records appended since the last call, by this or any other worker
     try:
-        # Receive confirmation to delete file
-        confirm_delete = connect.recv(buffer_size).decode('utf-8')
-        print("Received deletion confirmation: {}".format(confirm_delete))
-        
-        start_time = time.time()
-        if confirm_delete == "Y":
+        with open(CONTENT_INDEX_FILE, "rb") as journal:
+            journal.seek(CONTENT_INDEX["offset"])
+            data = journal.read()
+    except FileNotFoundError:
+        return
+    # A record another worker is still appending waits for the next call
+    end = data.rfind(b"\n") + 1
+    for line in data[:end].splitlines():
+        try:
+            apply_index_record(json.loads(line))
+            CONTENT_INDEX["records"] += 1
+        except(ValueError, KeyError, TypeError):
+            # Torn by a crash in the middle of a write
+            continue
+    CONTENT_INDEX["offset"] += end
+    return
+
+def append_index_records(records):
+    # Runs with the index lock held; with O_APPEND every record lands whole after the others, whichever worker wrote it
+    data = "".join(json.dumps(record) + "\n" for record in records).encode('utf-8')
+    journal = os.open(CONTENT_INDEX_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(journal, data)
+    finally:
+        os.close(journal)
+    refresh_content_index()
+    return
+
+def record_content(file_name, leaves):
+    # Runs on the disk worker pool once file_name holds its final content: cache its chunk digests and index its
+    # root; None forgets the name
+    if leaves is None:
+        remove_if_exists(digests_path(file_name))
+    else:
+        stat = save_leaves(file_name, leaves)
+    with CONTENT_INDEX["lock"]:
+        refresh_content_index()
+        if leaves is None:
+            if file_name in CONTENT_INDEX["by_name"]:
+                append_index_records([{"name": file_name, "root": None}])
+            return
+        # Size and mtime tell later lookups whether the file still holds these bytes
+        append_index_records([{"name": file_name, "root": merkle_root(leaves).hex(), "size": stat.st_size,
+                               "mtime_ns": stat.st_mtime_ns}])
+    return
+
+async def index_content(file_name, leaves):
+    # The file itself is already in place; a failing index only costs a future deduplication or a rehash
+    try:
+        await run_disk_job(record_content, file_name, leaves)
+    except OSError as e:
+        LOG.error("Error updating the content index for %s: %s", file_name, e)
+    return
+
+def find_content(root, file_size):
+    # Runs on the disk worker pool: a name that still holds exactly these bytes, or None. Names changed behind
+    # the server's back no longer match their size and mtime and are dropped from the index
+    with CONTENT_INDEX["lock"]:
+        refresh_content_index()
+        stale = []
+        for file_name in sorted(CONTENT_INDEX["by_digest"].get(root.hex(), ())):
+            record = CONTENT_INDEX["by_name"][file_name]
             try:
-                # Delete file
-                os.remove(file_name)
-                connect.send(struct.pack("i", 1))
-            except OSError:
-                # Error deleting file
-                print("\nFailed to delete {}".format(file_name))
-                connect.send(struct.pack("i", -1))
-                return
-        else:
-            print("\nDelete abandoned by client!")
-    except socket.error:
-        print("\nError receiving deletion confirmation from client.")
+                stat = os.stat(file_name)
+            except FileNotFoundError:
+                stale.append(file_name)
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (record["size"], record["mtime_ns"]):
+                stale.append(file_name)
+            elif record["size"] == file_size:
+                return file_name
+        if stale:
+            append_index_records([{"name": file_name, "root": None} for file_name in stale])
+    return None
+
+def link_content(source, file_name):
+    # Runs on the disk worker pool: give file_name the content of source without reading it
+    if os.path.abspath(source) == os.path.abspath(file_name):
         return
+    partial_name = file_name + PARTIAL_SUFFIX
+    remove_if_exists(partial_name)
+    try:
+        # Stored files are only ever replaced, never written in place, so sharing the inode is safe
+        os.link(source, partial_name)
+    except OSError:
+        # No hard links on this file system; copyfile still copies inside the kernel
+        shutil.copyfile(source, partial_name)
+    os.replace(partial_name, file_name)
+    return
 
+def compact_content_index():
+    # Runs once at startup, before any worker appends: rewrite the journal with one record per indexed name
+    refresh_content_index()
+    if CONTENT_INDEX["records"] <= len(CONTENT_INDEX["by_name"]) + CONTENT_INDEX_SLACK:
+        return
+    compact_name = CONTENT_INDEX_FILE + PARTIAL_SUFFIX
+    with open(compact_name, "w", encoding='utf-8') as journal:
+        for record in CONTENT_INDEX["by_name"].values():
+            journal.write(json.dumps(record) + "\n")
+    os.replace(compact_name, CONTENT_INDEX_FILE)
+    CONTENT_INDEX["offset"] = os.stat(CONTENT_INDEX_FILE).st_size
+    CONTENT_INDEX["records"] = len(CONTENT_INDEX["by_name"])
+    return
+
+async def link_known_content(session, request_id, payload_length):
+    request = await recv_name_request(session, OP_LINK, request_id, payload_length, LINK_REQUEST)
+    if request is None:
+        return
+    (file_size, root), file_name = request
+
+    start_time = time.time()
     try:
-        # Get client go-ahead, then send download details
-        connect.recv(buffer_size)
-        connect.send(struct.pack("f", time.time() - start_time))
-    except(struct.error, socket.error):
-        print("\nError sending download details.")
+        source = await run_disk_job(find_content, root, file_size)
+        if source is None:
+            # Unknown content; the client sends it with a regular STOR
+            await send_frame(session, OP_LINK, request_id, status=STATUS_NOT_FOUND)
+            return
+        leaves = await run_disk_job(file_leaves, source)
+        await run_disk_job(link_content, source, file_name)
+    except OSError:
+        LOG.error("Error linking %s.", file_name)
+        await send_frame(session, OP_LINK, request_id, status=STATUS_ERROR)
+        return
+    invalidate_listing_cache()
+    drop_cached_file(file_name)
+    await index_content(file_name, leaves)
+    LOG.info("Linked %s to the content of %s", file_name, source)
+
+    # Same details as a STOR, no content was transferred
+    await send_frame(session, OP_LINK, request_id, STOR_RESPONSE.pack(time.time() - start_time, file_size, root))
+    return
+
+def delta_block_size(file_size):
+    # Square root of the size rounded up to 1 KiB: about as many blocks as bytes per block
+    return min(DELTA_MAX_BLOCK_SIZE, max(DELTA_MIN_BLOCK_SIZE, (math.isqrt(file_size) + 1023) // 1024 * 1024))
+
+def read_signatures(content, offset, length, block_size):
+    # Runs on the disk worker pool: one read for a whole batch, then adler32 and BLAKE2b-128 of every block in it,
+    # both computed in C
+    data = memoryview(os.pread(content.fileno(), length, offset))
+    return b"".join(SIGNATURE.pack(zlib.adler32(data[start:start + block_size]),
+                                   hashlib.blake2b(data[start:start + block_size], digest_size=16).digest())
+                    for start in range(0, len(data), block_size))
+
+async def send_signatures(session, request_id, payload_length):
+    request = await recv_name_request(session, OP_SIGS, request_id, payload_length, SIGS_REQUEST)
+    if request is None:
+        return
+    (block_size,), file_name = request
+
+    try:
+        content = await run_disk_job(open, file_name, "rb")
+        file_size = os.fstat(content.fileno()).st_size
+    except(FileNotFoundError, IsADirectoryError):
+        # Nothing to diff against; the client uploads the whole file
+        await send_frame(session, OP_SIGS, request_id, status=STATUS_NOT_FOUND)
+        return
+    except OSError:
+        LOG.error("Error opening %s for reading.", file_name)
+        await send_frame(session, OP_SIGS, request_id, status=STATUS_ERROR)
+        return
+
+    block_size = min(DELTA_MAX_BLOCK_SIZE, max(DELTA_MIN_BLOCK_SIZE, block_size or delta_block_size(file_size)))
+    batch_size = SIGNATURE_BATCH_SIZE // block_size * block_size
+    status = STATUS_OK
+    job = None
+    try:
+        # Signature pages leave flagged FLAG_MORE as they are computed; the summary frame closes the stream
+        offset = 0
+        if file_size:
+            job = asyncio.ensure_future(run_disk_job(read_signatures, content, 0, batch_size, block_size))
+        while offset < file_size:
+            page = await job
+            job = None
+            offset += batch_size
+            if offset < file_size:
+                job = asyncio.ensure_future(run_disk_job(read_signatures, content, offset, batch_size, block_size))
+            await send_frame(session, OP_SIGS, request_id, page, flags=FLAG_MORE)
+    except OSError:
+        LOG.error("Error reading %s.", file_name)
+        status = STATUS_ERROR
     finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        if job is not None:
+            await asyncio.gather(job, return_exceptions=True)
+        await run_disk_job(content.close)
+
+    LOG.info("Sent the block signatures of %s (%s byte blocks)", file_name, block_size)
+    await send_frame(session, OP_SIGS, request_id, SIGS_SUMMARY.pack(file_size, block_size), status)
     return
 
-def close_connection(connect, soc):
+def open_delta_files(file_name):
+    # Runs on the disk worker pool: the old copy (None if there is none) and the file the new one is rebuilt in
     try:
-        connect.send(b"1")
-        connect.close()
-        soc.close()
-        print("Server connection closed.")
+        basis = open(file_name, "rb")
+    except FileNotFoundError:
+        basis = None
+    try:
+        return basis, open(file_name + DELTA_SUFFIX, "wb", 0)
+    except OSError:
+        if basis is not None:
+            basis.close()
+        raise
+
+def apply_delta_instruction(basis, output_file, payload, tree, totals):
+    # Runs on the disk worker pool: one COPY, LITERAL or END instruction; raises ValueError on a bad one
+    kind = payload[0] if payload else None
+    if kind == DELTA_KIND_COPY and len(payload) == DELTA_COPY.size:
+        _, offset, length = DELTA_COPY.unpack(payload)
+        if basis is None or offset + length > os.fstat(basis.fileno()).st_size:
+            raise ValueError("copy outside the server's copy")
+        end = offset + length
+        while offset < end:
+            data = os.pread(basis.fileno(), min(HASH_BLOCK_SIZE, end - offset), offset)
+            write_all(output_file, data, tree)
+            offset += len(data)
+        totals["size"] += length
+    elif kind == DELTA_KIND_LITERAL:
+        write_all(output_file, memoryview(payload)[DELTA_LITERAL.size:], tree)
+        totals["size"] += len(payload) - DELTA_LITERAL.size
+        totals["literal"] += len(payload) - DELTA_LITERAL.size
+    elif kind == DELTA_KIND_END and len(payload) == DELTA_END.size:
+        if merkle_root(finish_chunk_tree(tree)) != DELTA_END.unpack(payload)[1]:
+            raise ValueError("the rebuilt file does not match the client's hash")
+        totals["complete"] = True
+    else:
+        raise ValueError("malformed delta instruction")
+    return
+
+async def store_file_from_delta(session, request_id, payload_length):
+    # The instructions follow as DATA frames, whatever this frame holds, so they are skipped on every early exit
+    request = await recv_name_request(session, OP_DELTA, request_id, payload_length, NAME_REQUEST)
+    if request is None:
+        await discard_chunks(session, request_id)
+        return
+    file_name = request[1]
+
+    start_time = time.time()
+    try:
+        basis, output_file = await run_disk_job(open_delta_files, file_name)
+    except OSError:
+        LOG.error("Error opening %s for writing.", file_name)
+        await discard_chunks(session, request_id)
+        await send_frame(session, OP_DELTA, request_id, status=STATUS_ERROR)
+        return
+
+    # The new file is hashed as it is rebuilt: against the client's hash at the end, and for the content index
+    tree = create_chunk_tree()
+    totals = {"size": 0, "literal": 0, "complete": False}
+    error = None
+    LOG.info("Rebuilding %s from a delta...", file_name)
+    try:
+        while True:
+            frame = await recv_frame(session)
+            if frame is None:
+                raise ConnectionError("Connection closed by client.")
+            opcode, _, flags, chunk_request_id, chunk_length = frame
+            if opcode != OP_DATA or chunk_request_id != request_id or chunk_length > DELTA_COPY.size + MAX_CHUNK_SIZE:
+                raise ConnectionError("Malformed DATA frame for request {}.".format(request_id))
+            payload = await recv_exact(session, chunk_length)
+            if error is None:
+                try:
+                    await run_disk_job(apply_delta_instruction, basis, output_file, payload, tree, totals)
+                except(ValueError, OSError) as e:
+                    # Keep reading to the last frame so the next request is still found
+                    error = e
+            if not flags & FLAG_MORE:
+                break
+        if error is None and not totals["complete"]:
+            error = ValueError("the delta ended without its END instruction")
+    except(ConnectionError, asyncio.CancelledError):
+        await run_disk_job(output_file.close)
+        await run_disk_job(remove_if_exists, file_name + DELTA_SUFFIX)
+        raise
+    finally:
+        if basis is not None:
+            await run_disk_job(basis.close)
+        await run_disk_job(output_file.close)
+
+    try:
+        if error is not None:
+            raise error
+        await run_disk_job(os.replace, file_name + DELTA_SUFFIX, file_name)
+    except(ValueError, OSError) as e:
+        LOG.error("Error rebuilding %s: %s", file_name, e)
+        await run_disk_job(remove_if_exists, file_name + DELTA_SUFFIX)
+        await send_frame(session, OP_DELTA, request_id, status=STATUS_ERROR)
+        return
+    invalidate_listing_cache()
+    drop_cached_file(file_name)
+    await index_content(file_name, tree["leaves"])
+    log_transfer(session, "DELTA", file_name, totals["size"], start_time, literal_bytes=totals["literal"])
+
+    response = DELTA_RESPONSE.pack(time.time() - start_time, totals["size"], totals["literal"])
+    await send_frame(session, OP_DELTA, request_id, response)
+    return
+
+async def delete_file_from_server(session, request_id, payload_length):
+    if payload_length > MAX_NAME_PAYLOAD:
+        # Never buffer an oversized request; skip it in bounded chunks instead
+        LOG.warning("File name too long.")
+        await discard_payload(session, payload_length)
+        await send_frame(session, OP_DEL, request_id, status=STATUS_BAD_REQUEST)
+        return
+
+    try:
+        # Payload: the file name
+        file_name = (await recv_exact(session, payload_length)).decode('utf-8')
+    except UnicodeDecodeError:
+        LOG.error("Error decoding file name.")
+        await send_frame(session, OP_DEL, request_id, status=STATUS_BAD_REQUEST)
+        return
+    if not valid_name(file_name):
+        LOG.warning("Invalid file name %s.", file_name)
+        await send_frame(session, OP_DEL, request_id, status=STATUS_BAD_REQUEST)
+        return
+
+    start_time = time.time()
+    try:
+        # Delete file
+        await run_disk_job(os.remove, file_name)
+        invalidate_listing_cache()
+        drop_cached_file(file_name)
+        await index_content(file_name, None)
+        status = STATUS_OK
+        LOG.info("Deleted file: %s", file_name)
+    except FileNotFoundError:
+        status = STATUS_NOT_FOUND
+        LOG.warning("File %s does not exist", file_name)
+    except OSError:
+        status = STATUS_ERROR
+        LOG.error("Failed to delete %s", file_name)
+
+    # Send deletion performance details
+    await send_frame(session, OP_DEL, request_id, DEL_RESPONSE.pack(time.time() - start_time), status)
+    return
+
+def valid_name(name):
+    # One path component that is not hidden nor named like a temporary file, so a file or directory transfer never
+    # reaches outside the server's directory, into its digests and index, or into another transfer's partial file
+    return bool(name) and not name.startswith(".") and "/" not in name and os.sep not in name and "\0" not in name \
+        and not name.endswith(TEMPORARY_SUFFIXES + (REPLACED_SUFFIX,))
+
+def remove_tree(path):
+    try:
+        shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
+    return
+
+def replace_tree(staging, directory):
+    # Runs on the disk worker pool: the old tree moves aside before the new one takes its name, so the name is
+    # only missing between two renames
+    replaced = directory + REPLACED_SUFFIX
+    remove_tree(replaced)
+    if os.path.isdir(directory):
+        os.rename(directory, replaced)
+    os.rename(staging, directory)
+    remove_tree(replaced)
+    return
+
+class ArchiveStream:
+    # File object between tarfile, on a thread of its own, and the event loop: what tarfile writes is gathered into
+    # chunks of COMPRESSION_CHUNK_SIZE, compressed and queued for the loop to send; what it reads is decoded from
+    # the chunks the loop received
+
+    def __init__(self, loop, chunks, totals):
+        self.loop = loop
+        self.chunks = chunks
+        self.totals = totals
+        self.pending = memoryview(b"")
+        self.buffer = bytearray()
+        self.aborted = False
+
+    def exchange(self, coroutine):
+        # Waits for room in the queue or for the next chunk; a session that broke sets aborted and empties the queue
+        if self.aborted:
+            coroutine.close()
+            raise OSError("directory transfer aborted")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= COMPRESSION_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        codec, compressed = encode_chunk(data, self.totals)
+        self.exchange(self.chunks.put((codec, len(data), compressed if codec != CODEC_NONE else data)))
+        self.totals["raw"] += len(data)
+        return
+
+    def read(self, size):
+        while not self.pending:
+            chunk = self.exchange(self.chunks.get())
+            if chunk is None:
+                return b""
+            codec, raw_size, data = chunk
+            self.pending = memoryview(decode_chunk(codec, data, raw_size, self.totals))
+        data = bytes(self.pending[:size])
+        self.pending = self.pending[size:]
+        return data
+
+def start_archive_thread(function, *args):
+    # Packing and unpacking wait on the event loop for queue room or data, so they run on threads of their own
+    # instead of the disk worker pool the loop may need meanwhile
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def settle(result, error):
+        if done.done():
+            return
+        if error is not None:
+            done.set_exception(error)
+        else:
+            done.set_result(result)
+
+    def run():
+        result = error = None
+        try:
+            result = function(*args)
+        except Exception as e:
+            error = e
+        try:
+            loop.call_soon_threadsafe(settle, result, error)
+        except RuntimeError:
+            # The event loop is gone; the server is shutting down
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return done
+
+def abort_archive(stream, chunks):
+    # Let the archive thread run into an error instead of waiting forever for the loop
+    stream.aborted = True
+    while not chunks.empty():
+        chunks.get_nowait()
+    chunks.put_nowait(None)
+    return
+
+async def feed_archive(chunks, done, chunk):
+    # Queue a received chunk for the unpacking thread; False once the thread stopped taking them
+    putting = asyncio.ensure_future(chunks.put(chunk))
+    await asyncio.wait([putting, done], return_when=asyncio.FIRST_COMPLETED)
+    if not putting.done():
+        putting.cancel()
+        return False
+    return True
+
+async def next_archive_chunk(chunks, done):
+    # The next chunk the packing thread queued, or None once it finished and the queue is empty
+    getting = asyncio.ensure_future(chunks.get())
+    await asyncio.wait([getting, done], return_when=asyncio.FIRST_COMPLETED)
+    if getting.done():
+        return getting.result()
+    getting.cancel()
+    return chunks.get_nowait() if not chunks.empty() else None
+
+def count_member(member, counts):
+    if member.isfile():
+        counts["files"] += 1
+        counts["bytes"] += member.size
+    return
+
+def pack_directory(directory, stream, counts):
+    # Runs on its own thread: the tree under directory as a tar stream with names relative to it, regular files
+    # and directories only, with their mtimes
+    def admit(member):
+        if not (member.isfile() or member.isdir()) or member.name.endswith(TEMPORARY_SUFFIXES):
+            return None
+        member.uid = member.gid = 0
+        member.uname = member.gname = ""
+        count_member(member, counts)
+        return member
+
+    # GNU headers keep mtimes to the second; PAX would add an extended header to every file for the fraction
+    with tarfile.open(fileobj=stream, mode="w|", format=tarfile.GNU_FORMAT) as archive:
+        archive.add(directory, arcname=".", filter=admit)
+    stream.flush()
+    return counts
+
+def safe_members(archive, counts):
+    # Regular files and directories that stay inside the target, owned by the server and never setuid; links,
+    # devices and paths leading out are skipped
+    for member in archive:
+        path = os.path.normpath(member.name)
+        if os.path.isabs(path) or path == ".." or path.startswith(".." + os.sep) or \
+                not (member.isfile() or member.isdir()):
+            LOG.warning("Skipping archive member %s", member.name)
+            continue
+        member.mode = (member.mode & 0o755) | (0o700 if member.isdir() else 0o600)
+        member.uid = member.gid = 0
+        member.uname = member.gname = ""
+        count_member(member, counts)
+        yield member
+
+def unpack_directory(staging, stream, counts):
+    # Runs on its own thread: the tar stream is extracted into staging as it arrives, with its mtimes
+    with tarfile.open(fileobj=stream, mode="r|") as archive:
+        archive.extractall(staging, members=safe_members(archive, counts), **EXTRACT_OPTIONS)
+    return counts
+
+async def store_directory_to_server(session, request_id, payload_length):
+    # Payload: directory name. The tar archive of the tree follows as DATA frames, whatever this frame holds, and is
+    # unpacked while it arrives into a staging directory that replaces the old tree once the archive is complete.
+    # The client marks the last DATA frame STATUS_ERROR if it could not finish the archive
+    request = await recv_name_request(session, OP_PUTDIR, request_id, payload_length, NAME_REQUEST)
+    if request is None:
+        await discard_chunks(session, request_id)
+        return
+    directory = request[1]
+
+    start_time = time.time()
+    staging = directory + PARTIAL_SUFFIX
+    try:
+        if await run_disk_job(os.path.lexists, directory) and not await run_disk_job(os.path.isdir, directory):
+            raise OSError("{} is a file".format(directory))
+        await run_disk_job(remove_tree, staging)
+        await run_disk_job(os.mkdir, staging)
+    except OSError as e:
+        LOG.error("Error preparing directory %s: %s", directory, e)
+        await discard_chunks(session, request_id)
+        await send_frame(session, OP_PUTDIR, request_id, status=STATUS_ERROR)
+        return
+
+    LOG.info("Receiving directory %s...", directory)
+    totals = create_compression_totals(CODEC_NONE)
+    counts = {"files": 0, "bytes": 0}
+    chunks = asyncio.Queue(ARCHIVE_QUEUE_SIZE)
+    stream = ArchiveStream(asyncio.get_running_loop(), chunks, totals)
+    done = start_archive_thread(unpack_directory, staging, stream, counts)
+    error = None
+    try:
+        while True:
+            frame = await recv_frame(session)
+            if frame is None:
+                raise ConnectionError("Connection closed by client.")
+            opcode, status, flags, chunk_request_id, chunk_length = frame
+            if opcode != OP_DATA or chunk_request_id != request_id or \
+                    not CHUNK_HEADER.size <= chunk_length <= CHUNK_HEADER.size + MAX_CHUNK_SIZE:
+                raise ConnectionError("Malformed DATA frame for request {}.".format(request_id))
+            raw_size = CHUNK_HEADER.unpack(await recv_exact(session, CHUNK_HEADER.size))[0]
+            data = await recv_exact(session, chunk_length - CHUNK_HEADER.size)
+            if raw_size > MAX_CHUNK_SIZE:
+                raise ConnectionError("Chunk of request {} is too large.".format(request_id))
+            totals["wire"] += chunk_length
+            # Once unpacking stopped, on an error or past the end of the archive, the rest is only read
+            if raw_size and not done.done():
+                await feed_archive(chunks, done, ((flags & CODEC_MASK) >> CODEC_SHIFT, raw_size, data))
+            if not flags & FLAG_MORE:
+                break
+        await feed_archive(chunks, done, None)
+        await asyncio.wait([done])
+        if status != STATUS_OK:
+            error = "the client could not finish the archive"
+        elif done.exception() is not None:
+            error = done.exception()
+        else:
+            await run_disk_job(replace_tree, staging, directory)
+    except(ConnectionError, asyncio.CancelledError):
+        # Nothing of a broken upload is kept; the thread stops before its tree is removed
+        abort_archive(stream, chunks)
+        await asyncio.wait([done])
+        await run_disk_job(remove_tree, staging)
+        raise
+    except OSError as e:
+        error = e
+    if error is not None:
+        LOG.error("Error unpacking directory %s: %s", directory, error)
+        await run_disk_job(remove_tree, staging)
+        await send_frame(session, OP_PUTDIR, request_id, status=STATUS_ERROR)
+        return
+
+    invalidate_listing_cache()
+    log_transfer(session, "PUTDIR", directory, counts["bytes"], start_time, files=counts["files"],
+                 wire_bytes=totals["wire"])
+    response = DIR_SUMMARY.pack(time.time() - start_time, counts["files"], counts["bytes"])
+    await send_frame(session, OP_PUTDIR, request_id, response)
+    return
+
+async def send_directory(session, request_id, payload_length):
+    # Payload: directory name. The answer is a frame flagged FLAG_CHUNKED, the tar archive of the tree as DATA
+    # frames compressed with the session's codec, and a closing frame with the totals, STATUS_ERROR if the archive
+    # broke off; the tree is packed while it is sent
+    request = await recv_name_request(session, OP_GETDIR, request_id, payload_length, NAME_REQUEST)
+    if request is None:
+        return
+    directory = request[1]
+    if not await run_disk_job(os.path.isdir, directory):
+        LOG.warning("Directory %s not found.", directory)
+        await send_frame(session, OP_GETDIR, request_id, status=STATUS_NOT_FOUND)
+        return
+
+    start_time = time.time()
+    LOG.info("Sending directory %s...", directory)
+    await send_frame(session, OP_GETDIR, request_id, flags=FLAG_CHUNKED)
+    totals = create_compression_totals(session["codec"])
+    counts = {"files": 0, "bytes": 0}
+    chunks = asyncio.Queue(ARCHIVE_QUEUE_SIZE)
+    stream = ArchiveStream(asyncio.get_running_loop(), chunks, totals)
+    done = start_archive_thread(pack_directory, directory, stream, counts)
+    try:
+        while True:
+            chunk = await next_archive_chunk(chunks, done)
+            if chunk is None:
+                break
+            codec, raw_size, data = chunk
+            await send_frame(session, OP_DATA, request_id, CHUNK_HEADER.pack(raw_size) + data,
+                             flags=(codec << CODEC_SHIFT) | FLAG_MORE)
+            totals["wire"] += CHUNK_HEADER.size + len(data)
+        await send_frame(session, OP_DATA, request_id, CHUNK_HEADER.pack(0))
+    except(ConnectionError, OSError, asyncio.CancelledError):
+        abort_archive(stream, chunks)
+        await asyncio.wait([done])
+        raise
+    await asyncio.wait([done])
+    if done.exception() is not None:
+        LOG.error("Error packing directory %s: %s", directory, done.exception())
+        await send_frame(session, OP_GETDIR, request_id, DIR_SUMMARY.pack(time.time() - start_time, 0, 0),
+                         status=STATUS_ERROR)
+        return
+    log_transfer(session, "GETDIR", directory, counts["bytes"], start_time, files=counts["files"],
+                 wire_bytes=totals["wire"])
+    response = DIR_SUMMARY.pack(time.time() - start_time, counts["files"], counts["bytes"])
+    await send_frame(session, OP_GETDIR, request_id, response)
+    return
+
+async def send_statistics(session, request_id, payload_length):
+    # STAT has no arguments; the answer covers this process only, the metrics file covers every worker
+    await discard_payload(session, payload_length)
+    snapshot = metrics_snapshot(STATS, LATENCY)
+    await send_frame(session, OP_STAT, request_id, json.dumps(snapshot).encode('utf-8'))
+    return
+
+async def negotiate_codec(session, payload_length):
+    # The client answers our greeting with the codec it wants for downloads; HELLO gets no response
+    if payload_length != CLIENT_HELLO.size:
+        await discard_payload(session, payload_length)
+        return
+    codec = CLIENT_HELLO.unpack(await recv_exact(session, CLIENT_HELLO.size))[0]
+    session["codec"] = codec if codec in CODECS else CODEC_NONE
+    codec_name = CODECS[session["codec"]][0] if session["codec"] != CODEC_NONE else "none"
+    LOG.info("Session %s uses codec %s", session["addr"], codec_name)
+    return
+
+async def close_connection(session, request_id):
+    connect = session["connect"]
+    try:
+        await send_frame(session, OP_QUIT, request_id)
     except(socket.error, OSError):
-        print("\nError closing connection.")
+        LOG.error("Error closing connection.")
+    finally:
+        connect.close()
+        LOG.info("Connection with %s closed.", session["addr"])
     return
 
-def handle_client(connect, soc, buffer_size, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
+async def handle_client(session):
+    connect = session["connect"]
+    STATS["active_sessions"] += 1
 
     try:
         while True:
-            data = connect.recv(buffer_size).decode('utf-8')
-            print("\nReceived instruction: {}".format(data))
-
-            if data == "STOR":
-                store_file_to_server(connect, buffer_size, quiet_mode)
-            elif data == "LIST" or data == "LS":
-                list_files_from_server(connect, buffer_size, quiet_mode)
-            elif data == "RETR":
-                retrieve_file_from_server(connect, buffer_size, quiet_mode)
-            elif data == "DEL":
-                delete_file_from_server(connect, buffer_size, quiet_mode)
-            elif data == "QUIT" or data == "EXIT" or data == "BYE":
-                print("Server shutting down...")
-                close_connection(connect, soc)
+            session["state"] = "IDLE"
+            frame = await recv_frame(session)
+            if frame is None:
+                LOG.info("Client %s disconnected.", session["addr"])
+                connect.close()
+                break
+            opcode, _, flags, request_id, payload_length = frame
+            LOG.info("Received request %s from %s: %s", request_id, session["addr"], OPCODE_NAMES.get(opcode, opcode))
+            STATS["commands"] += 1
+            start_time = time.perf_counter()
+
+            # Every command moves the session into its own state until the handler returns
+            session["state"] = OPCODE_NAMES.get(opcode, "UNKNOWN")
+            if opcode == OP_HELLO:
+                await negotiate_codec(session, payload_length)
+            elif opcode == OP_STOR:
+                await store_file_to_server(session, request_id, flags, payload_length)
+            elif opcode == OP_LIST:
+                await list_files_from_server(session, request_id, payload_length)
+            elif opcode == OP_RETR:
+                await retrieve_file_from_server(session, request_id, payload_length)
+            elif opcode == OP_DEL:
+                await delete_file_from_server(session, request_id, payload_length)
+            elif opcode == OP_REST:
+                await query_partial_upload(session, request_id, payload_length)
+            elif opcode == OP_SIZE:
+                await send_file_size(session, request_id, payload_length)
+            elif opcode == OP_HASH:
+                await send_file_hash(session, request_id, payload_length)
+            elif opcode == OP_GET:
+                await send_file_range(session, request_id, payload_length)
+            elif opcode == OP_PUT:
+                await store_file_range(session, request_id, payload_length)
+            elif opcode == OP_COMMIT:
+                await commit_file_segments(session, request_id, payload_length)
+            elif opcode == OP_LINK:
+                await link_known_content(session, request_id, payload_length)
+            elif opcode == OP_SIGS:
+                await send_signatures(session, request_id, payload_length)
+            elif opcode == OP_DELTA:
+                await store_file_from_delta(session, request_id, payload_length)
+            elif opcode == OP_TREE:
+                await send_file_tree(session, request_id, payload_length)
+            elif opcode == OP_STAT:
+                await send_statistics(session, request_id, payload_length)
+            elif opcode == OP_PUTDIR:
+                await store_directory_to_server(session, request_id, payload_length)
+            elif opcode == OP_GETDIR:
+                await send_directory(session, request_id, payload_length)
+            elif opcode == OP_QUIT:
+                session["state"] = "CLOSING"
+                await discard_payload(session, payload_length)
+                await close_connection(session, request_id)
                 break
             else:
-                print("Command not recognized.")
-            data = None # Reset data for next iteration
-    except KeyboardInterrupt:
-        print("\nServer interrupted by user.")
-        close_connection(connect, soc)
-        exit(1)
+                LOG.warning("Command not recognized.")
+                await discard_payload(session, payload_length)
+                await send_frame(session, opcode, request_id, status=STATUS_BAD_REQUEST)
+            record_latency(session["state"], time.perf_counter() - start_time)
+    except asyncio.CancelledError:
+        connect.close()
+        raise
     except Exception as e:
-        print(f"An error occurred: {e}")
-        close_connection(connect, soc)
-        exit(1)
+        LOG.error("An error occurred with %s: %s", session['addr'], e)
+        # Charged to the command the session was serving when it broke
+        record_error(session["state"])
+        connect.close()
     finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        STATS["active_sessions"] -= 1
+        if LOG.isEnabledFor(logging.INFO):
+            LOG.info("Session %s tuning: %s", session["addr"], format_tuning(session))
     return
 
-def main():
+def latency_entry(command):
+    entry = LATENCY.get(command)
+    if entry is None:
+        entry = LATENCY[command] = {"count": 0, "sum": 0.0, "errors": 0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+    return entry
+
+def record_latency(command, seconds):
+    entry = latency_entry(command)
+    entry["count"] += 1
+    entry["sum"] += seconds
+    # A latency equal to a bound belongs to that bucket, as with Prometheus' "le"
+    entry["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    return
+
+def record_error(command):
+    STATS["errors"] += 1
+    latency_entry(command)["errors"] += 1
+    return
+
+def merge_latency(totals, latency):
+    # Add the histograms of one worker into totals, command by command and bucket by bucket
+    for command, entry in latency.items():
+        total = totals.setdefault(command, {"count": 0, "sum": 0.0, "errors": 0,
+                                            "buckets": [0] * (len(LATENCY_BUCKETS) + 1)})
+        total["count"] += entry["count"]
+        total["sum"] += entry["sum"]
+        total["errors"] += entry["errors"]
+        total["buckets"] = [a + b for a, b in zip(total["buckets"], entry["buckets"])]
+    return totals
+
+def latency_quantile(buckets, quantile):
+    # Interpolate linearly inside the bucket holding the quantile, like Prometheus' histogram_quantile
+    rank = quantile * sum(buckets)
+    cumulative = 0
+    for index, count in enumerate(buckets):
+        if count and cumulative + count >= rank:
+            if index == len(LATENCY_BUCKETS):
+                # Slower than the last bound: that bound is the best estimate we have
+                return LATENCY_BUCKETS[-1]
+            lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+            return lower + (LATENCY_BUCKETS[index] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return 0.0
+
+def metrics_snapshot(stats, latency):
+    commands = {}
+    for command, entry in latency.items():
+        commands[command] = {"count": entry["count"], "errors": entry["errors"],
+                             "mean": entry["sum"] / entry["count"] if entry["count"] else 0.0}
+        for quantile in LATENCY_QUANTILES:
+            commands[command]["p{}".format(round(quantile * 100))] = latency_quantile(entry["buckets"], quantile)
+    return {"pid": os.getpid(), "scope": METRICS["scope"], "uptime": time.time() - METRICS["started"],
+            "stats": stats, "commands": commands}
+
+def format_prometheus(stats, latency):
+    lines = []
+    for name, metric, kind, description in METRIC_FAMILIES:
+        lines += ["# HELP {} {}".format(metric, description), "# TYPE {} {}".format(metric, kind),
+                  "{} {}".format(metric, stats.get(name, 0))]
+    lines += ["# HELP ftp_start_time_seconds Unix time the server started.", "# TYPE ftp_start_time_seconds gauge",
+              "ftp_start_time_seconds {}".format(METRICS["started"])]
+
+    lines += ["# HELP ftp_command_duration_seconds Time taken to serve a command.",
+              "# TYPE ftp_command_duration_seconds histogram"]
+    for command, entry in sorted(latency.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (math.inf,), entry["buckets"]):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else repr(bound)
+            lines.append('ftp_command_duration_seconds_bucket{{command="{}",le="{}"}} {}'.format(command, le, cumulative))
+        lines.append('ftp_command_duration_seconds_sum{{command="{}"}} {}'.format(command, entry["sum"]))
+        lines.append('ftp_command_duration_seconds_count{{command="{}"}} {}'.format(command, entry["count"]))
+
+    lines += ["# HELP ftp_command_errors_total Error responses by command.", "# TYPE ftp_command_errors_total counter"]
+    for command, entry in sorted(latency.items()):
+        lines.append('ftp_command_errors_total{{command="{}"}} {}'.format(command, entry["errors"]))
+    return "\n".join(lines) + "\n"
+
+def write_metrics_file(path, text):
+    # Written aside and renamed over the old dump, so a scraper never reads half a file
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as metrics_file:
+        metrics_file.write(text)
+    os.replace(temporary_path, path)
+    return
+
+def dump_metrics(path, stats, latency):
     try:
-        # Check for correct usage of parameters
-        correct_usage_parameters_message()
+        write_metrics_file(path, format_prometheus(stats, latency))
+    except OSError as e:
+        LOG.error("Error writing metrics to %s: %s", path, e)
+    return
 
-        soc = connect = None
-        print("\nWelcome to FTP Server!\n")
+async def export_metrics(path):
+    # Single-process mode: dump this process' metrics; in --workers mode the supervisor dumps the totals
+    while True:
+        try:
+            await run_disk_job(write_metrics_file, path, format_prometheus(STATS, LATENCY))
+        except OSError as e:
+            LOG.error("Error writing metrics to %s: %s", path, e)
+        await asyncio.sleep(METRICS_INTERVAL)
 
-        # Create socket connection
-        soc, buffer_size, quiet_mode = create_socket_connection()
+async def report_stats(stats_fd, server_task):
+    # Periodically push this worker's counters to the supervisor as one JSON line
+    while True:
+        await asyncio.sleep(STATS_REPORT_INTERVAL)
+        if not write_stats_report(stats_fd):
+            # The supervisor is gone, so nobody would respawn or stop this worker
+            LOG.error("Worker %s lost its supervisor, stopping.", os.getpid())
+            server_task.cancel()
+            return
 
-        # Accept incoming connection
-        connect, addr = soc.accept()
-        print("Connected to by address: {}".format(addr))
+def write_stats_report(stats_fd, final=False):
+    # With the histograms a report can outgrow the pipe's atomic write size, so the rest of a partly written
+    # report goes out before any newer one; the final report waits for the supervisor to make room
+    if final:
+        os.set_blocking(stats_fd, True)
+    try:
+        while True:
+            if not STATS_REPORT["pending"]:
+                report = json.dumps({"pid": os.getpid(), "stats": STATS, "latency": LATENCY}) + "\n"
+                STATS_REPORT["pending"] = report.encode('utf-8')
+                final = False
+            written = os.write(stats_fd, STATS_REPORT["pending"])
+            STATS_REPORT["pending"] = STATS_REPORT["pending"][written:]
+            if not STATS_REPORT["pending"] and not final:
+                break
+    except BlockingIOError:
+        # The supervisor is behind; the rest goes out with the next report
+        pass
+    except BrokenPipeError:
+        return False
+    return True
 
-        # Send buffer size to client as an integer in network byte order
-        connect.send(struct.pack("i", buffer_size))
+async def serve_forever(soc, buffer_size, stats_fd=None):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=DISK_WORKERS))
+
+    # Keep a reference to every session task so none is garbage collected mid-transfer
+    sessions = set()
+    if stats_fd is not None:
+        reporter = asyncio.create_task(report_stats(stats_fd, asyncio.current_task()))
+        sessions.add(reporter)
+    elif METRICS["path"] is not None:
+        sessions.add(asyncio.create_task(export_metrics(METRICS["path"])))
+    try:
+        while True:
+            # Accept incoming connection
+            connect, addr = await loop.sock_accept(soc)
+            connect.setblocking(False)
+            configure_socket(connect)
+            LOG.info("Connected to by address: %s", addr)
+            STATS["sessions"] += 1
+
+            session = create_session(connect, addr, buffer_size)
+            try:
+                # Greet the client with the buffer size and the codecs it may use
+                codecs = sum(1 << codec for codec in CODECS)
+                await send_frame(session, OP_HELLO, 0, HELLO_PAYLOAD.pack(buffer_size, codecs))
+            except socket.error:
+                LOG.error("Error sending buffer size to %s.", addr)
+                connect.close()
+                continue
+
+            # Handle client requests concurrently with every other session
+            task = asyncio.create_task(handle_client(session))
+            sessions.add(task)
+            task.add_done_callback(sessions.discard)
+    finally:
+        for task in sessions:
+            task.cancel()
+        await asyncio.gather(*sessions, return_exceptions=True)
+        soc.close()
+        if stats_fd is None and METRICS["path"] is not None:
+            dump_metrics(METRICS["path"], STATS, LATENCY)
+    return
+
+def run_worker(soc, address, buffer_size, reuse_port, stats_fd):
+    # Entry point of a forked worker process; never returns to the supervisor code
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    METRICS["scope"] = "worker"
+    exit_code = 0
+    try:
+        if reuse_port:
+            # Trade the supervisor's placeholder for a listening socket of our own in the SO_REUSEPORT group
+            soc.close()
+            soc = create_listening_socket(address, reuse_port=True)
+        LOG.info("Worker %s accepting connections.", os.getpid())
+        asyncio.run(serve_forever(soc, buffer_size, stats_fd))
+    except(KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    except Exception as e:
+        LOG.error("Worker %s failed: %s", os.getpid(), e)
+        exit_code = 1
+    finally:
+        write_stats_report(stats_fd, final=True)
+        stop_logging()
+        os._exit(exit_code)
+
+def spawn_worker(soc, address, buffer_size, reuse_port, selector):
+    # Each worker gets a pipe to send its counters back to the supervisor
+    read_fd, write_fd = os.pipe()
+    # The writer thread would not survive the fork and might hold the stdout lock while it happens
+    stop_logging()
+    pid = os.fork()
+    configure_logging(LOGGING["quiet_mode"])
+    if pid == 0:
+        os.close(read_fd)
+        for key in list(selector.get_map().values()):
+            os.close(key.fd)
+        os.set_blocking(write_fd, False)
+        run_worker(soc, address, buffer_size, reuse_port, write_fd)
+    os.close(write_fd)
+    selector.register(read_fd, selectors.EVENT_READ, {"pid": pid, "pending": b""})
+    return pid
+
+def read_worker_reports(key, worker_stats, worker_latency):
+    # Keep only the latest report of every worker; reports are cumulative
+    data = os.read(key.fd, 65536)
+    if not data:
+        return False
+    lines = (key.data["pending"] + data).split(b"\n")
+    key.data["pending"] = lines.pop()
+    for line in lines:
+        report = json.loads(line)
+        worker_stats[report["pid"]] = report["stats"]
+        worker_latency[report["pid"]] = report["latency"]
+    return True
+
+def aggregate_stats(worker_stats, retired_stats):
+    totals = dict(retired_stats)
+    for stats in worker_stats.values():
+        for name, value in stats.items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+def aggregate_latency(worker_latency, retired_latency):
+    totals = merge_latency({}, retired_latency)
+    for latency in worker_latency.values():
+        merge_latency(totals, latency)
+    return totals
+
+def print_stats_summary(worker_stats, retired_stats):
+    totals = aggregate_stats(worker_stats, retired_stats)
+    LOG.info("Aggregated statistics of %s worker(s):", len(worker_stats))
+    for pid, stats in sorted(worker_stats.items()):
+        LOG.info("\tWorker %s: %s", pid, stats)
+    LOG.info("\tTotal: %s", totals)
+    return
 
-        # Handle client requests
-        handle_client(connect, soc, buffer_size, quiet_mode)
+def supervise_workers(soc, address, buffer_size, reuse_port, workers):
+    selector = selectors.DefaultSelector()
+    children = {}
+    worker_stats = {}
+    worker_latency = {}
+    # Counters and histograms of dead workers, so respawning never loses history; active sessions died with them
+    retired_stats = dict.fromkeys(STATS, 0)
+    retired_latency = {}
 
+    for _ in range(workers):
+        pid = spawn_worker(soc, address, buffer_size, reuse_port, selector)
+        children[pid] = True
+    LOG.info("Supervisor %s started %s workers.", os.getpid(), workers)
+
+    # SIGTERM stops the supervisor the same way Ctrl+C does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    last_summary = last_metrics = time.time()
+    try:
+        while True:
+            for key, _ in selector.select(timeout=STATS_REPORT_INTERVAL):
+                if not read_worker_reports(key, worker_stats, worker_latency):
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+
+            # Reap dead workers and respawn them
+            while True:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                children.pop(pid, None)
+                stats = worker_stats.pop(pid, {})
+                for name, value in stats.items():
+                    if name not in STATS_GAUGES:
+                        retired_stats[name] += value
+                merge_latency(retired_latency, worker_latency.pop(pid, {}))
+                LOG.warning("Worker %s exited with status %s, respawning.", pid, os.waitstatus_to_exitcode(status))
+                new_pid = spawn_worker(soc, address, buffer_size, reuse_port, selector)
+                children[new_pid] = True
+
+            if time.time() - last_summary >= STATS_SUMMARY_INTERVAL:
+                print_stats_summary(worker_stats, retired_stats)
+                last_summary = time.time()
+            if METRICS["path"] is not None and time.time() - last_metrics >= METRICS_INTERVAL:
+                dump_metrics(METRICS["path"], aggregate_stats(worker_stats, retired_stats),
+                             aggregate_latency(worker_latency, retired_latency))
+                last_metrics = time.time()
+    except KeyboardInterrupt:
+        LOG.info("Server interrupted by user, stopping workers...")
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        # Collect the final reports the workers sent while shutting down
+        for key in list(selector.get_map().values()):
+            while read_worker_reports(key, worker_stats, worker_latency):
+                pass
+            os.close(key.fd)
+        print_stats_summary(worker_stats, retired_stats)
+        if METRICS["path"] is not None:
+            dump_metrics(METRICS["path"], aggregate_stats(worker_stats, retired_stats),
+                         aggregate_latency(worker_latency, retired_latency))
+        soc.close()
+    return
+
+def run_server(soc, address, buffer_size, options, reuse_port):
+    workers = options["--workers"]
+    # Every worker holds a cache of its own
+    FILE_CACHE["budget"] = options["--cache-mb"] * 1024 * 1024
+    AUTO_TUNE["enabled"] = bool(options["--tune"])
+    METRICS["path"] = options["--metrics-file"]
+
+    try:
+        # Load the content index before workers fork, so each starts from the compacted journal
+        compact_content_index()
+    except OSError as e:
+        LOG.error("Error loading the content index: %s", e)
+
+    if workers > 1:
+        # Pre-fork one event loop per worker process so the server scales across cores
+        supervise_workers(soc, address, buffer_size, reuse_port, workers)
+        return
+
+    try:
+        asyncio.run(serve_forever(soc, buffer_size))
     except KeyboardInterrupt:
-        print("\nServer interrupted by user.")
-        if(connect is not None):
-            close_connection(connect, soc)
+        LOG.info("Server interrupted by user.")
         exit(1)
     except Exception as e:
-        print(f"An error occurred: {e}")
-        if(connect is not None):
-            close_connection(connect, soc)
+        LOG.error("An error occurred: %s", e)
         exit(1)
     return
 
+def main():
+    # Check for correct usage of parameters
+    correct_usage_parameters_message()
+
+    print("\nWelcome to FTP Server!\n")
+
+    # Create socket connection
+    soc, address, buffer_size, quiet_mode, options, reuse_port = create_socket_connection()
+    configure_logging(quiet_mode)
+    try:
+        run_server(soc, address, buffer_size, options, reuse_port)
+    finally:
+        stop_logging()
+    return
+
 if __name__ == "__main__":
     main()
@@ -1,9 +1,108 @@
-import socket, struct, sys, os, time
+import bisect, collections, hashlib, json, logging, logging.handlers, math, queue, socket, struct, sys, os, time
 from sys import argv
 
+# Every message goes through this logger; records are queued and written by a background thread
+LOG = logging.getLogger("ftp.server")
+# -n logs everything from INFO up, -q only warnings and errors
+LOG_LEVELS = {"-n": logging.INFO, "-q": logging.WARNING}
+LOG_FORMAT = "%(asctime)s %(process)d %(levelname)s %(message)s"
+
+# STOR, RETR and DEL go out as one request datagram: the command, a newline, a REQUEST_HEADER of the transfer id the
+# client picked and the size and chunk size of the file to store (0 otherwise), then the file name. The server
+# answers with a REPLY_HEADER of the id, 1 to go ahead or 0 if the file cannot be stored, found or deleted, and the
+# size and chunk size of a file to retrieve. TRANSFER_DETAILS close the request: the id, the seconds elapsed and the
+# Merkle root of the bytes that went through, zeros after DEL. A request left without an answer is sent again, and
+# the server answers a request it already carried out with the datagrams it answered it with
+REQUEST_HEADER = struct.Struct("!IQI")
+REPLY_HEADER = struct.Struct("!cIBQI")
+TRANSFER_DETAILS = struct.Struct("!cId32s")
+# Both ends hash the content as it goes by, as a Merkle tree over chunks of this size like the TCP server does
+MERKLE_CHUNK_SIZE = 1024 * 1024
+# Every LIST datagram starts with one of these markers; the END datagram carries the totals and closes the listing
+LIST_PAGE_MARKER = b"PAGE\n"
+LIST_END_MARKER = b"END\n"
+# STOR and RETR data moves as numbered chunks, each datagram a DATA_HEADER of kind, transfer id, sequence number and
+# file offset ahead of at most BUFFER_SIZE - DATA_HEADER.size bytes. Every data datagram is answered with an
+# ACK_HEADER: the transfer id, the number of chunks received in order, the sequence number that prompted it, and a
+# bitmap of the chunks received past the first missing one. Kinds are control bytes, so a late datagram is never
+# taken for a command, and the id tells datagrams left over from an earlier transfer from those of the current one
+DATA_HEADER = struct.Struct("!cIIQ")
+ACK_HEADER = struct.Struct("!cIIIQ")
+DATA_KIND = b"\x01"
+ACK_KIND = b"\x02"
+REPLY_KIND = b"\x03"
+DETAILS_KIND = b"\x04"
+KINDS = (DATA_KIND, ACK_KIND, REPLY_KIND, DETAILS_KIND)
+# Every datagram of a kind carries the transfer id right after it
+TRANSFER_ID = struct.Struct("!I")
+SACK_BITS = 64
+# Chunks in flight: the window starts small, doubles per round trip up to the threshold, then grows by one chunk
+# per round trip up to WINDOW_SIZE; a loss halves it and a timeout takes it back to MIN_WINDOW
+WINDOW_SIZE = SACK_BITS
+INITIAL_WINDOW = 4
+MIN_WINDOW = 1
+# A chunk is sent again once this many chunks past it were acknowledged, or when the retransmission timer of the
+# first unacknowledged one runs out. The timer follows the measured round trip time as in RFC 6298, with bounds
+# suited to a LAN, and doubles on every timeout; the transfer fails after MAX_TIMEOUTS timeouts in a row
+DUPLICATE_THRESHOLD = 3
+INITIAL_RTO = 1.0
+MIN_RTO = 0.05
+MAX_RTO = 4.0
+MAX_TIMEOUTS = 8
+# Seconds a receiver waits for the next data datagram before giving up on the transfer
+RECEIVE_TIMEOUT = 10
+# Largest UDP payload; data is received into a buffer this big whatever buffer size the sender uses
+MAX_DATAGRAM_SIZE = 65535
+# Kernel socket buffers asked for, so a full window fits; Linux caps them at net.core.rmem_max and wmem_max
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+# Uploads are received into <name>.ftp-part and only take the place of the file once every chunk arrived; such
+# files are left out of LIST, and no file name may end with the suffix
+PARTIAL_SUFFIX = ".ftp-part"
+# Commands sent as a request datagram, and how many answered requests are kept to answer again
+REQUEST_COMMANDS = ("STOR", "RETR", "DEL")
+ANSWERED_ENTRIES = 256
+# Hot files are sent from memory: at most this many bytes in all, files up to FILE_CACHE_MAX_FILE_SIZE each,
+# remembering this many recently missed files to decide what to admit
+FILE_CACHE_BUDGET = 64 * 1024 * 1024
+FILE_CACHE_MAX_FILE_SIZE = 4 * 1024 * 1024
+FILE_CACHE_SEEN_ENTRIES = 4096
+
+# name -> {"key", "data", "root"} in least recently used order; a file is only copied in when it is asked for
+# again while it is still in "seen", so one-off downloads never push hot files out
+FILE_CACHE = {"entries": collections.OrderedDict(), "seen": collections.OrderedDict(), "bytes": 0,
+              "hits": 0, "misses": 0, "evictions": 0}
+
+# (client address, transfer id) -> the datagrams a request was answered with, oldest first, for a client that sends
+# the request again because the answer was lost
+ANSWERED = collections.OrderedDict()
+
+# Counters of the server, answered to STAT along with the cache counters and the latency histograms
+STATS = {"commands": 0, "bytes_in": 0, "bytes_out": 0, "errors": 0}
+# Upper bounds in seconds of the command latency histogram buckets; one more bucket takes anything slower
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+LATENCY_QUANTILES = (0.5, 0.95, 0.99)
+# command -> {"count", "sum", "errors", "buckets"}
+LATENCY = {}
+# --metrics-file is rewritten in Prometheus text format at most every METRICS_INTERVAL seconds, after a command:
+# the server waits for datagrams in between, so an idle server keeps its last dump
+METRICS_INTERVAL = 10.0
+METRICS = {"path": None, "command": None, "started": time.time(), "dumped": 0.0}
+# Prometheus name, type and help text of every counter
+METRIC_FAMILIES = (
+    ("commands", "ftp_commands_total", "counter", "Commands received."),
+    ("bytes_in", "ftp_received_bytes_total", "counter", "Bytes received from clients."),
+    ("bytes_out", "ftp_sent_bytes_total", "counter", "Bytes sent to clients."),
+    ("errors", "ftp_errors_total", "counter", "Commands that failed."),
+    ("cache_hits", "ftp_cache_hits_total", "counter", "Downloads served from the hot-file cache."),
+    ("cache_misses", "ftp_cache_misses_total", "counter", "Downloads read from disk."),
+    ("cache_evictions", "ftp_cache_evictions_total", "counter", "Files evicted from the hot-file cache."),
+    ("cache_bytes", "ftp_cache_bytes", "gauge", "Bytes held by the hot-file cache."),
+)
+
 def correct_usage_parameters_message():
-    if len(argv) != 5:
-        print("Usage: python3 server.py <IP> <PORT> <BUFFER_SIZE> [-q <quiet_mode> -n <not_quiet_mode>]")
+    if len(argv) not in (5, 7) or (len(argv) == 7 and argv[5] != "--metrics-file"):
+        print("Usage: python3 server.py <IP> <PORT> <BUFFER_SIZE> [-q <quiet_mode> -n <not_quiet_mode>] "
+              "[--metrics-file PATH]")
         exit(1)
 
 def create_socket():
@@ -13,8 +112,11 @@ def create_socket():
         BUFFER_SIZE = int(argv[3])
         server_addr = (UDP_IP, UDP_PORT)
         QUIET_MODE = argv[4]
+        METRICS["path"] = argv[6] if len(argv) == 7 else None
 
         soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        soc.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        soc.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
         soc.bind((server_addr))
 
     except socket.error as e:
@@ -37,180 +139,625 @@ def create_socket():
         exit(1)
     return soc, BUFFER_SIZE, QUIET_MODE
 
-def store_file_to_server(soc, buffer_size, addr, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
+def configure_logging(quiet_mode):
+    # The receive loop only puts records on a queue; a background thread formats and writes them. Records below the
+    # level are dropped before they are built, which makes quiet mode free
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    LOG.handlers = [logging.handlers.QueueHandler(records)]
+    LOG.setLevel(LOG_LEVELS.get(quiet_mode, logging.INFO))
+    LOG.propagate = False
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener
 
-    try:
-        data, addr = soc.recvfrom(buffer_size)
-        file_name = data.decode('utf-8')
-        soc.sendto(b"1", addr)
-    except socket.error:
-        print("\nError to send confirmation message to client.")
+def log_transfer(addr, command, file_name, size, start_time, **fields):
+    # One key=value record per finished transfer for log shippers; the fields also ride on the record as "transfer"
+    if not LOG.isEnabledFor(logging.INFO):
         return
+    seconds = time.time() - start_time
+    record = {"peer": "{}:{}".format(*addr), "command": command, "file": file_name, "bytes": size,
+              "seconds": round(seconds, 6), "mib_s": round(size / seconds / 1024 ** 2, 2) if seconds > 0 else 0.0}
+    record.update(fields)
+    LOG.info("transfer %s", " ".join("{}={}".format(key, json.dumps(value)) for key, value in record.items()),
+             extra={"transfer": record})
+    return
+
+def create_chunk_tree():
+    # Chunk digests of a stream of bytes, filled in as the bytes go by
+    return {"leaves": [], "chunk": hashlib.sha256(), "filled": 0}
+
+def update_chunk_tree(tree, view):
+    view = memoryview(view)
+    while view:
+        size = min(len(view), MERKLE_CHUNK_SIZE - tree["filled"])
+        tree["chunk"].update(view[:size])
+        tree["filled"] += size
+        view = view[size:]
+        if tree["filled"] == MERKLE_CHUNK_SIZE:
+            tree["leaves"].append(tree["chunk"].digest())
+            tree["chunk"] = hashlib.sha256()
+            tree["filled"] = 0
+    return
+
+def merkle_root(tree):
+    # Root over every chunk digest, the last chunk possibly short: pairs of digests hash into their parent until
+    # one is left, an odd digest out moving up as it is
+    level = tree["leaves"] + ([tree["chunk"].digest()] if tree["filled"] or not tree["leaves"] else [])
+    while len(level) > 1:
+        level = [hashlib.sha256(level[index] + level[index + 1]).digest() if index + 1 < len(level) else level[index]
+                 for index in range(0, len(level), 2)]
+    return level[0]
+
+def write_all(output_file, view):
+    # Unbuffered file writes may be partial
+    while view:
+        written = output_file.write(view)
+        view = view[written:]
+    return
+
+def preallocate_file(output_file, file_size):
+    # Reserve every block up front so the file is laid out in one piece instead of growing chunk by chunk
+    if file_size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(output_file.fileno(), 0, file_size)
+        except OSError:
+            # Not every file system supports it; the writes work without it
+            pass
+    return
+
+def read_at(input_file, offset, size):
+    input_file.seek(offset)
+    return input_file.read(size)
+
+def new_transfer_id():
+    # Random, so a new transfer is unlikely to take a datagram of an earlier one for its own
+    return int.from_bytes(os.urandom(TRANSFER_ID.size), "big")
+
+def transfer_of(data):
+    # The transfer id of a DATA, ACK, REPLY or DETAILS datagram, None for a datagram of no transfer
+    if data[:1] not in KINDS or len(data) < 1 + TRANSFER_ID.size:
+        return None
+    return TRANSFER_ID.unpack_from(data, 1)[0]
+
+def send_reliable(soc, addr, read_chunk, file_size, chunk_size, transfer_id, tree=None, request=None, reply=None):
+    # Send file_size bytes, read with read_chunk(offset, size), as numbered chunks over a sliding window, and hash
+    # them into tree on their first sending. Returns the transfer figures along with the details of the transfer, or
+    # the first datagram from the peer that belongs to no transfer, which ends it: the receiver only speaks otherwise
+    # once done. The request the transfer answers, should it come again, gets the reply again
+    total = -(-file_size // chunk_size)
+    # sequence number -> time of the latest sending, and how many times it was sent, for chunks not yet acknowledged
+    sent_at = {}
+    sendings = {}
+    sacked = set()
+    base = next_sequence = 0
+    window, threshold = INITIAL_WINDOW, WINDOW_SIZE
+    # No window cut for losses among the chunks in flight when the window was last cut
+    recovery = 0
+    srtt, rttvar, rto = None, 0.0, INITIAL_RTO
+    timeouts = 0
+    figures = {"retransmissions": 0, "bytes_sent": 0, "srtt": 0.0, "reply": None}
+    buffer = bytearray(MAX_DATAGRAM_SIZE)
+
+    def send_chunk(sequence):
+        offset = sequence * chunk_size
+        chunk = read_chunk(offset, min(chunk_size, file_size - offset))
+        if len(chunk) != min(chunk_size, file_size - offset):
+            raise OSError("the file shrank while being sent")
+        if sequence in sendings:
+            figures["retransmissions"] += 1
+        elif tree is not None:
+            update_chunk_tree(tree, chunk)
+        header = DATA_HEADER.pack(DATA_KIND, transfer_id, sequence, offset)
+        figures["bytes_sent"] += soc.sendto(b"".join((header, chunk)), addr)
+        sent_at[sequence] = time.monotonic()
+        sendings[sequence] = sendings.get(sequence, 0) + 1
+        return
+
+    previous_timeout = soc.gettimeout()
+    try:
+        while base < total:
+            while next_sequence < min(total, base + int(window)):
+                send_chunk(next_sequence)
+                next_sequence += 1
+            try:
+                soc.settimeout(max(sent_at[base] + rto - time.monotonic(), 0.001))
+                size, peer = soc.recvfrom_into(buffer)
+            except socket.timeout:
+                timeouts += 1
+                if timeouts > MAX_TIMEOUTS:
+                    raise socket.timeout(f"no acknowledgement after {MAX_TIMEOUTS} retransmissions")
+                rto = min(rto * 2, MAX_RTO)
+                threshold, window = max(int(window) // 2, MIN_WINDOW), MIN_WINDOW
+                recovery = next_sequence
+                send_chunk(base)
+                continue
+            if peer != addr:
+                continue
+            if buffer[:1] != ACK_KIND or size < ACK_HEADER.size:
+                data = bytes(buffer[:size])
+                if request is not None and data == request:
+                    # The reply to the request was lost
+                    soc.sendto(reply, addr)
+                    continue
+                transfer = transfer_of(data)
+                if transfer is not None and (data[:1] != DETAILS_KIND or transfer != transfer_id):
+                    # A reply sent again, or a datagram of an earlier transfer
+                    continue
+                figures["reply"] = data
+                break
+            _, acked_id, received, echoed, bitmap = ACK_HEADER.unpack_from(buffer)
+            if acked_id != transfer_id or received > next_sequence:
+                # Left over from an earlier transfer, or acknowledging chunks never sent
+                continue
 
+            # Karn's rule: a chunk sent more than once does not tell which sending was acknowledged
+            if sendings.get(echoed) == 1:
+                sample = time.monotonic() - sent_at[echoed]
+                if srtt is None:
+                    srtt, rttvar = sample, sample / 2
+                else:
+                    rttvar = 0.75 * rttvar + 0.25 * abs(srtt - sample)
+                    srtt = 0.875 * srtt + 0.125 * sample
+                rto = min(max(srtt + 4 * rttvar, MIN_RTO), MAX_RTO)
+            if received > base:
+                for sequence in range(base, received):
+                    del sent_at[sequence], sendings[sequence]
+                    sacked.discard(sequence)
+                window += received - base if window < threshold else (received - base) / window
+                window = min(window, WINDOW_SIZE)
+                base = received
+                timeouts = 0
+            early = (received + 1 + bit for bit in range(SACK_BITS) if bitmap >> bit & 1)
+            sacked.update(sequence for sequence in early if base <= sequence < next_sequence)
+
+            # Holes with enough chunks acknowledged past them are resent, at most once per round trip
+            if sacked:
+                now = time.monotonic()
+                last = min(max(sacked) - DUPLICATE_THRESHOLD + 1, next_sequence)
+                lost = [sequence for sequence in range(base, last)
+                        if sequence not in sacked and now - sent_at[sequence] > (srtt or rto)]
+                if lost and base >= recovery:
+                    threshold = window = max(int(window) // 2, MIN_WINDOW)
+                    recovery = next_sequence
+                for sequence in lost:
+                    send_chunk(sequence)
+    finally:
+        soc.settimeout(previous_timeout)
+    figures["srtt"] = srtt or 0.0
+    return figures
+
+def acknowledgement(transfer_id, received, echoed, early):
+    bitmap = 0
+    for sequence in early:
+        if sequence - received - 1 < SACK_BITS:
+            bitmap |= 1 << (sequence - received - 1)
+    return ACK_HEADER.pack(ACK_KIND, transfer_id, received, echoed, bitmap)
+
+def receive_reliable(soc, output_file, file_size, chunk_size, tree, transfer_id, request=None, reply=None):
+    # Write the chunks at their offsets as they arrive and acknowledge every one, hashing them into tree in order.
+    # Only chunks cut as the sender announced, chunk_size bytes at sequence * chunk_size, are taken.
+    # Chunks that arrive ahead of a missing one are kept until it comes, at most a window of them. Returns the
+    # sender's address, None for an empty file, and the figures of the transfer, with the last acknowledgement sent.
+    # The request the transfer answers, should it come again, gets the reply again
+    received = received_bytes = 0
+    early = {}
+    addr = None
+    figures = {"duplicates": 0, "bytes_received": 0, "ack": acknowledgement(transfer_id, 0, 0, ())}
+    buffer = bytearray(MAX_DATAGRAM_SIZE)
+    view = memoryview(buffer)
+
+    previous_timeout = soc.gettimeout()
+    soc.settimeout(RECEIVE_TIMEOUT)
     try:
-        file_size, addr = soc.recvfrom(4)
-        file_size = struct.unpack("i", file_size)[0]
-    except struct.error:
-        print("\nError to unpack file size.")
+        while received_bytes < file_size:
+            size, addr = soc.recvfrom_into(buffer)
+            if buffer[:1] != DATA_KIND or size < DATA_HEADER.size:
+                if request is not None and buffer[:size] == request:
+                    # The reply to the request was lost
+                    soc.sendto(reply, addr)
+                continue
+            _, data_id, sequence, offset = DATA_HEADER.unpack_from(buffer)
+            if data_id != transfer_id:
+                # Left over from an earlier transfer
+                continue
+            chunk = view[DATA_HEADER.size:size]
+            if offset != sequence * chunk_size or not 0 < len(chunk) == min(chunk_size, file_size - offset):
+                # Not a chunk of this file: it would land at the wrong place or past the end
+                continue
+            figures["bytes_received"] += len(chunk)
+            if sequence == received:
+                output_file.seek(offset)
+                write_all(output_file, chunk)
+                update_chunk_tree(tree, chunk)
+                received, received_bytes = received + 1, received_bytes + len(chunk)
+                while received in early:
+                    chunk = early.pop(received)
+                    update_chunk_tree(tree, chunk)
+                    received, received_bytes = received + 1, received_bytes + len(chunk)
+            elif sequence > received and sequence not in early and sequence - received <= WINDOW_SIZE:
+                output_file.seek(offset)
+                write_all(output_file, chunk)
+                early[sequence] = bytes(chunk)
+            else:
+                figures["duplicates"] += 1
+            figures["ack"] = acknowledgement(transfer_id, received, sequence, early)
+            soc.sendto(figures["ack"], addr)
+    finally:
+        soc.settimeout(previous_timeout)
+    return addr, figures
+
+def file_cache_key(stat):
+    # A replaced file has a new inode, a rewritten one a new size or mtime
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+def lookup_cached_file(file_name, stat):
+    # The cache entry of file_name if it still holds the file as it is on disk, else None
+    entry = FILE_CACHE["entries"].get(file_name)
+    if entry is not None and entry["key"] == file_cache_key(stat):
+        FILE_CACHE["entries"].move_to_end(file_name)
+        FILE_CACHE["hits"] += 1
+        return entry
+    drop_cached_file(file_name)
+    FILE_CACHE["misses"] += 1
+    return None
+
+def admit_to_file_cache(file_name, stat):
+    # Small files are copied in the second time they are asked for while they are still remembered
+    if not 0 < stat.st_size <= FILE_CACHE_MAX_FILE_SIZE:
+        return False
+    key = (file_name,) + file_cache_key(stat)
+    seen = FILE_CACHE["seen"]
+    if key in seen:
+        del seen[key]
+        return True
+    seen[key] = True
+    if len(seen) > FILE_CACHE_SEEN_ENTRIES:
+        seen.popitem(last=False)
+    return False
+
+def store_cached_file(file_name, key, data, root):
+    # The least recently used files make room for the new one
+    drop_cached_file(file_name)
+    entry = {"key": key, "data": data, "root": root}
+    FILE_CACHE["entries"][file_name] = entry
+    FILE_CACHE["bytes"] += len(data)
+    while FILE_CACHE["bytes"] > FILE_CACHE_BUDGET:
+        _, evicted = FILE_CACHE["entries"].popitem(last=False)
+        FILE_CACHE["bytes"] -= len(evicted["data"])
+        FILE_CACHE["evictions"] += 1
+    return entry
+
+def drop_cached_file(file_name):
+    # Called wherever the server replaces or removes a file
+    entry = FILE_CACHE["entries"].pop(file_name, None)
+    if entry is not None:
+        FILE_CACHE["bytes"] -= len(entry["data"])
+    return
+
+def latency_entry(command):
+    entry = LATENCY.get(command)
+    if entry is None:
+        entry = LATENCY[command] = {"count": 0, "sum": 0.0, "errors": 0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+    return entry
+
+def record_latency(command, seconds):
+    entry = latency_entry(command)
+    entry["count"] += 1
+    entry["sum"] += seconds
+    # A latency equal to a bound belongs to that bucket, as with Prometheus' "le"
+    entry["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    return
+
+def report_error(message, *args):
+    # Log the error and charge it to the command being served
+    LOG.error(message, *args)
+    STATS["errors"] += 1
+    latency_entry(METRICS["command"])["errors"] += 1
+    return
+
+def latency_quantile(buckets, quantile):
+    # Interpolate linearly inside the bucket holding the quantile, like Prometheus' histogram_quantile
+    rank = quantile * sum(buckets)
+    cumulative = 0
+    for index, count in enumerate(buckets):
+        if count and cumulative + count >= rank:
+            if index == len(LATENCY_BUCKETS):
+                return LATENCY_BUCKETS[-1]
+            lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+            return lower + (LATENCY_BUCKETS[index] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return 0.0
+
+def current_stats():
+    return dict(STATS, cache_hits=FILE_CACHE["hits"], cache_misses=FILE_CACHE["misses"],
+                cache_evictions=FILE_CACHE["evictions"], cache_bytes=FILE_CACHE["bytes"])
+
+def metrics_snapshot():
+    commands = {}
+    for command, entry in LATENCY.items():
+        commands[command] = {"count": entry["count"], "errors": entry["errors"],
+                             "mean": entry["sum"] / entry["count"] if entry["count"] else 0.0}
+        for quantile in LATENCY_QUANTILES:
+            commands[command]["p{}".format(round(quantile * 100))] = latency_quantile(entry["buckets"], quantile)
+    return {"pid": os.getpid(), "uptime": time.time() - METRICS["started"], "stats": current_stats(),
+            "commands": commands}
+
+def format_prometheus():
+    stats = current_stats()
+    lines = []
+    for name, metric, kind, description in METRIC_FAMILIES:
+        lines += ["# HELP {} {}".format(metric, description), "# TYPE {} {}".format(metric, kind),
+                  "{} {}".format(metric, stats[name])]
+    lines += ["# HELP ftp_start_time_seconds Unix time the server started.", "# TYPE ftp_start_time_seconds gauge",
+              "ftp_start_time_seconds {}".format(METRICS["started"])]
+
+    lines += ["# HELP ftp_command_duration_seconds Time taken to serve a command.",
+              "# TYPE ftp_command_duration_seconds histogram"]
+    for command, entry in sorted(LATENCY.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (math.inf,), entry["buckets"]):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else repr(bound)
+            lines.append('ftp_command_duration_seconds_bucket{{command="{}",le="{}"}} {}'.format(command, le, cumulative))
+        lines.append('ftp_command_duration_seconds_sum{{command="{}"}} {}'.format(command, entry["sum"]))
+        lines.append('ftp_command_duration_seconds_count{{command="{}"}} {}'.format(command, entry["count"]))
+
+    lines += ["# HELP ftp_command_errors_total Failures by command.", "# TYPE ftp_command_errors_total counter"]
+    for command, entry in sorted(LATENCY.items()):
+        lines.append('ftp_command_errors_total{{command="{}"}} {}'.format(command, entry["errors"]))
+    return "\n".join(lines) + "\n"
+
+def dump_metrics(force=False):
+    if METRICS["path"] is None or (not force and time.time() - METRICS["dumped"] < METRICS_INTERVAL):
         return
+    # Written aside and renamed over the old dump, so a scraper never reads half a file
+    temporary_path = METRICS["path"] + ".tmp"
+    try:
+        with open(temporary_path, "w") as metrics_file:
+            metrics_file.write(format_prometheus())
+        os.replace(temporary_path, METRICS["path"])
+    except OSError as e:
+        LOG.error("Error writing metrics to %s: %s", METRICS['path'], e)
+    METRICS["dumped"] = time.time()
+    return
+
+def send_statistics(soc, addr):
+    # The whole snapshot fits in one datagram
+    try:
+        soc.sendto(json.dumps(metrics_snapshot()).encode('utf-8'), addr)
+        LOG.info("Sent statistics to client.")
     except socket.error:
-        print("\nError to receive file size.")
+        report_error("Error sending statistics to client.")
+    return
+
+def parse_request(arguments):
+    # Transfer id, file size, chunk size and file name of a STOR, RETR or DEL request, or None if it is malformed
+    if len(arguments) < REQUEST_HEADER.size:
+        return None
+    transfer_id, file_size, chunk_size = REQUEST_HEADER.unpack_from(arguments)
+    try:
+        file_name = arguments[REQUEST_HEADER.size:].decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    return transfer_id, file_size, chunk_size, file_name
+
+def valid_name(name):
+    # One path component that is not hidden nor a partial upload, so a request never reaches outside the server's
+    # directory or into a transfer in progress
+    return bool(name) and not name.startswith(".") and "/" not in name and os.sep not in name and "\0" not in name \
+        and not name.endswith(PARTIAL_SUFFIX)
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return
+
+def remember_answers(addr, transfer_id, answers):
+    ANSWERED[(addr, transfer_id)] = answers
+    if len(ANSWERED) > ANSWERED_ENTRIES:
+        ANSWERED.popitem(last=False)
+    return
+
+def refuse_request(soc, addr, transfer_id):
+    # The file cannot be stored, found or deleted
+    reply = REPLY_HEADER.pack(REPLY_KIND, transfer_id, 0, 0, 0)
+    remember_answers(addr, transfer_id, [reply])
+    try:
+        soc.sendto(reply, addr)
+    except socket.error:
+        report_error("Error sending reply to client.")
+    return
+
+def store_file_to_server(soc, addr, request, transfer_id, file_size, chunk_size, file_name):
+    if not 0 < chunk_size <= MAX_DATAGRAM_SIZE - DATA_HEADER.size:
+        LOG.warning("Chunk size %s does not fit a datagram.", chunk_size)
+        refuse_request(soc, addr, transfer_id)
         return
-    
+
     try:
+        # Unbuffered file so each chunk goes straight to the kernel at its offset; the old file stays until the new
+        # one is complete
         start_time = time.time()
-        output_file = open(file_name, "wb")
-        bytes_received = 0
-        print("\nReceiving...")
-        while bytes_received < file_size:
-            data, addr = soc.recvfrom(buffer_size)
-            output_file.write(data)
-            bytes_received += len(data)
-        output_file.close()
-        print("\nReceived file: {}".format(file_name))
+        partial_name = file_name + PARTIAL_SUFFIX
+        output_file = open(partial_name, "wb", buffering=0)
     except OSError:
-        print("\nError writing file.")
+        report_error("Error opening %s for writing.", file_name)
+        refuse_request(soc, addr, transfer_id)
         return
-    except socket.error:
-        print("\nError receiving file content from client.")
+
+    reply = REPLY_HEADER.pack(REPLY_KIND, transfer_id, 1, 0, 0)
+    try:
+        tree = create_chunk_tree()
+        LOG.info("Receiving %s...", file_name)
+        with output_file:
+            soc.sendto(reply, addr)
+            preallocate_file(output_file, file_size)
+            sender, figures = receive_reliable(soc, output_file, file_size, chunk_size, tree, transfer_id, request,
+                                               reply)
+        os.replace(partial_name, file_name)
+        drop_cached_file(file_name)
+        addr = sender or addr
+        STATS["bytes_in"] += figures["bytes_received"]
+        log_transfer(addr, "STOR", file_name, file_size, start_time, duplicates=figures["duplicates"])
+    except socket.timeout:
+        report_error("Timed out receiving %s: the client stopped sending.", file_name)
+        remove_if_exists(partial_name)
+        return
+    except OSError:
+        report_error("Error writing file.")
+        remove_if_exists(partial_name)
         return
     except Exception as e:
-        print(f"\nUnexpected error receiving file content: {e}")
+        report_error("Unexpected error receiving file content: %s", e)
+        remove_if_exists(partial_name)
         return
     
     try:
-        # Send download details to client
-        soc.sendto(struct.pack("f", time.time() - start_time), addr)
+        # Send upload details to client, with the root of what was written; it also tells the client that every
+        # chunk arrived, should the last acknowledgements be lost
+        details = TRANSFER_DETAILS.pack(DETAILS_KIND, transfer_id, time.time() - start_time, merkle_root(tree))
+        remember_answers(addr, transfer_id, [reply, details])
+        soc.sendto(details, addr)
     except(socket.error):
-        print("\nError sending download details.")
-    finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        report_error("Error sending download details.")
     return
 
-def retrieve_file_from_server(soc, buffer_size, addr, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-
+def retrieve_file_from_server(soc, buffer_size, addr, request, transfer_id, file_name):
     try:
-        data, addr = soc.recvfrom(buffer_size)
-        file_name = data.decode('utf-8')
-        if not os.path.exists(file_name):
-            soc.sendto(b"0", addr)
-            print("File not found.")
-            return
-        soc.sendto(b"1", addr)
-    except socket.error:
-        print("\nError to send confirmation message to client.")
+        # A hot file is sent from memory; the stat only checks that it did not change since it was cached
+        stat = os.stat(file_name)
+        entry = lookup_cached_file(file_name, stat)
+        file_size = stat.st_size
+    except FileNotFoundError:
+        LOG.warning("File not found.")
+        refuse_request(soc, addr, transfer_id)
+        return
+    except OSError:
+        report_error("Error getting file size.")
+        refuse_request(soc, addr, transfer_id)
         return
 
+    chunk_size = buffer_size - DATA_HEADER.size
+    reply = REPLY_HEADER.pack(REPLY_KIND, transfer_id, 1, file_size, chunk_size)
     try:
-        file_size = os.path.getsize(file_name)
-        soc.sendto(struct.pack("i", file_size), addr)
-    except OSError:
-        print("\nError getting file size.")
+        soc.sendto(reply, addr)
+    except socket.error:
+        report_error("Error to send confirmation message to client.")
         return
 
     try:
         start_time = time.time()
-        with open(file_name, "rb") as f:
-            bytes_sent = 0
-            while bytes_sent < file_size:
-                data = f.read(buffer_size)
-                soc.sendto(data, addr)
-                bytes_sent += len(data)
-        print("\nSent file: {}".format(file_name))
+        tree = create_chunk_tree()
+        if entry is None and admit_to_file_cache(file_name, stat):
+            with open(file_name, "rb") as f:
+                data = f.read(file_size)
+            # Only what was read in one piece as the announced size is worth keeping
+            if len(data) == file_size:
+                update_chunk_tree(tree, data)
+                entry = store_cached_file(file_name, file_cache_key(stat), data, merkle_root(tree))
+        if entry is not None:
+            view = memoryview(entry["data"])
+            figures = send_reliable(soc, addr, lambda offset, size: view[offset:offset + size], file_size, chunk_size,
+                                    transfer_id, request=request, reply=reply)
+        else:
+            with open(file_name, "rb") as f:
+                figures = send_reliable(soc, addr, lambda offset, size: read_at(f, offset, size), file_size,
+                                        chunk_size, transfer_id, tree, request, reply)
+        STATS["bytes_out"] += figures["bytes_sent"]
+        if figures["reply"] is not None:
+            # The client gave up on the transfer and moved on
+            report_error("Client stopped acknowledging %s.", file_name)
+        log_transfer(addr, "RETR", file_name, file_size, start_time, source="disk" if entry is None else "cache",
+                     retransmissions=figures["retransmissions"], srtt_ms=round(figures["srtt"] * 1000, 3))
+        LOG.info("Cache: %s hits, %s misses, %s evictions, %s bytes held",
+                 FILE_CACHE["hits"], FILE_CACHE["misses"], FILE_CACHE["evictions"], FILE_CACHE["bytes"])
+    except socket.timeout as e:
+        report_error("Timed out sending %s: %s.", file_name, e)
     except OSError:
-        print("\nError reading file.")
+        report_error("Error reading file.")
     except socket.error:
-        print("\nError sending file content to client.")
+        report_error("Error sending file content to client.")
     except Exception as e:
-        print(f"\nUnexpected error sending file content: {e}")
+        report_error("Unexpected error sending file content: %s", e)
 
     try:
-        # Send download details to client
-        soc.sendto(struct.pack("f", time.time() - start_time), addr)
+        # Send download details to client, with the root of what was sent to compare with what arrived
+        root = entry["root"] if entry is not None else merkle_root(tree)
+        details = TRANSFER_DETAILS.pack(DETAILS_KIND, transfer_id, time.time() - start_time, root)
+        remember_answers(addr, transfer_id, [reply, details])
+        soc.sendto(details, addr)
     except(socket.error):
-        print("\nError sending download details.")
-    finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        report_error("Error sending download details.")
     return
 
-def list_files_from_server(soc, addr, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-
+def list_files_from_server(soc, addr, buffer_size):
     try:
-        files = os.listdir('.')
         total_directory_size = 0
-        files_info = []
         size = 0
+        # Entries are read one at a time and leave in pages of at most buffer_size bytes,
+        # so neither the directory nor the listing is ever held in memory
+        page = [LIST_PAGE_MARKER]
+        page_length = len(LIST_PAGE_MARKER)
 
-        for file in files:
-            file_size = os.path.getsize(file)
-            total_directory_size += file_size
-            files_info.append(f"\t{file} - {file_size} bytes")
-            size += 1
+        with os.scandir('.') as listing:
+            for entry in listing:
+                try:
+                    if not entry.is_file() or entry.name.endswith(PARTIAL_SUFFIX):
+                        continue
+                    file_size = entry.stat().st_size
+                except FileNotFoundError:
+                    # Removed between reading the directory and looking at the entry
+                    continue
+                line = f"\t{entry.name} - {file_size} bytes\n".encode('utf-8', 'surrogateescape')
+                if page_length + len(line) > buffer_size and len(page) > 1:
+                    soc.sendto(b"".join(page), addr)
+                    page = [LIST_PAGE_MARKER]
+                    page_length = len(LIST_PAGE_MARKER)
+                page.append(line)
+                page_length += len(line)
+                total_directory_size += file_size
+                size += 1
 
-        files_list = "\n".join(files_info)
-        files_list += f"\n\nTotal directory size: {total_directory_size} bytes\nTotal number of files: {size}"
-        soc.sendto(files_list.encode('utf-8'), addr)
-        print("Sent file list to client.")
+        if len(page) > 1:
+            soc.sendto(b"".join(page), addr)
+        summary = f"\nTotal directory size: {total_directory_size} bytes\nTotal number of files: {size}"
+        soc.sendto(LIST_END_MARKER + summary.encode('utf-8'), addr)
+        LOG.info("Sent file list to client.")
 
     except OSError:
-        print("\nError listing files.")
+        report_error("Error listing files.")
     except socket.error:
-        print("\nError sending file list to client.")
-    finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        report_error("Error sending file list to client.")
     return
 
-def delete_file_from_server(soc, addr, buffer_size, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-
+def delete_file_from_server(soc, addr, transfer_id, file_name):
     try:
         start_time = time.time()
-        data, addr = soc.recvfrom(buffer_size)
-        file_name = data.decode('utf-8')
-        if not os.path.exists(file_name):
-            soc.sendto(b"0", addr)
-            print("File not found.")
-            return
         os.remove(file_name)
-        soc.sendto(b"1", addr)
-        print("Deleted file: {}".format(file_name))
-    except OSError:
-        print("\nError deleting file.")
+        drop_cached_file(file_name)
+        LOG.info("Deleted file: %s", file_name)
+    except FileNotFoundError:
+        LOG.warning("File not found.")
+        refuse_request(soc, addr, transfer_id)
         return
-    except socket.error:
-        print("\nError sending delete confirmation to client.")
+    except OSError:
+        report_error("Error deleting file.")
+        refuse_request(soc, addr, transfer_id)
         return
-    
+
     try:
-        # Send download details to client
-        soc.sendto(struct.pack("f", time.time() - start_time), addr)
-    except(socket.error):
-        print("\nError sending download details.")
-    finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+        # Send the confirmation and the details to client
+        reply = REPLY_HEADER.pack(REPLY_KIND, transfer_id, 1, 0, 0)
+        details = TRANSFER_DETAILS.pack(DETAILS_KIND, transfer_id, time.time() - start_time, bytes(32))
+        remember_answers(addr, transfer_id, [reply, details])
+        soc.sendto(reply, addr)
+        soc.sendto(details, addr)
+    except socket.error:
+        report_error("Error sending delete confirmation to client.")
     return
     
 def close_socket(soc, addr):
@@ -218,53 +765,77 @@ def close_socket(soc, addr):
         # Send confirmation to client
         soc.sendto("Server closed successfully.".encode('utf-8'), addr)
         soc.close()
-        print("Server closed successfully.")
+        LOG.info("Server closed successfully.")
     except BrokenPipeError:
-        print("\nServer socket not started or already closed.")
+        LOG.info("Server socket not started or already closed.")
     except(socket.error, OSError):
-        print("\nError closing socket.")
+        LOG.error("Error closing socket.")
     return
 
-def handle_client(soc, buffer_size, quiet_mode):
-    if quiet_mode == "-q":
-        sys.stdout = open(os.devnull, 'w')
-        sys.stderr = open(os.devnull, 'w')
-    
+def handle_client(soc, buffer_size):
     try:
         addr = None
         while True:
             choice, addr = soc.recvfrom(buffer_size)
-            command = choice.decode('utf-8')
+            if choice[:1] in KINDS:
+                # Left over from the last transfer: a retransmission or acknowledgement that crossed its end. Chunks
+                # sent again because the details of an upload were lost get the details again
+                answers = ANSWERED.get((addr, transfer_of(choice)))
+                if choice[:1] == DATA_KIND and answers is not None:
+                    soc.sendto(answers[-1], addr)
+                continue
+            command, _, arguments = choice.partition(b"\n")
+            command = command.decode('utf-8')
+            if command.upper() in REQUEST_COMMANDS:
+                request = parse_request(arguments)
+                if request is None:
+                    LOG.warning("Malformed %s request.", command.upper())
+                    continue
+                answers = ANSWERED.get((addr, request[0]))
+                if answers is not None:
+                    # Carried out already: the client did not get the answer
+                    for datagram in answers:
+                        soc.sendto(datagram, addr)
+                    continue
+                if not valid_name(request[3]):
+                    LOG.warning("Invalid file name %s.", request[3])
+                    refuse_request(soc, addr, request[0])
+                    continue
+            STATS["commands"] += 1
+            METRICS["command"] = command.upper()
+            start_time = time.perf_counter()
 
             if command.upper() == 'STOR':
-                store_file_to_server(soc, buffer_size, addr, quiet_mode)
+                store_file_to_server(soc, addr, choice, *request)
             elif command.upper() == 'RETR':
-                retrieve_file_from_server(soc, buffer_size, addr, quiet_mode)
+                retrieve_file_from_server(soc, buffer_size, addr, choice, request[0], request[3])
             elif command.upper() == 'LIST' or command.upper() == 'LS':
-                list_files_from_server(soc, addr, quiet_mode)
+                list_files_from_server(soc, addr, buffer_size)
             elif command.upper() == 'DEL':
-                delete_file_from_server(soc, addr, buffer_size, quiet_mode)
+                delete_file_from_server(soc, addr, request[0], request[3])
+            elif command.upper() == 'STAT':
+                send_statistics(soc, addr)
             elif command.upper() == 'QUIT' or command.upper() == 'EXIT' or command.upper() == 'BYE':
-                print("Server shutting down...")
+                LOG.info("Server shutting down...")
+                dump_metrics(force=True)
                 close_socket(soc, addr)
                 break
             else:
-                print("Unknown command received, try again.")
+                LOG.warning("Unknown command received, try again.")
+                METRICS["command"] = "UNKNOWN"
+            record_latency(METRICS["command"], time.perf_counter() - start_time)
+            dump_metrics()
     except KeyboardInterrupt:
-        print("\nServer interrupted by user.")
+        LOG.info("Server interrupted by user.")
+        dump_metrics(force=True)
         if(addr is not None):
             close_socket(soc, addr)
         exit(1)
     except Exception as e:
-        print(f"\nUnexpected error: {e}")
+        LOG.error("Unexpected error: %s", e)
         if(addr is not None):
             close_socket(soc, addr)
         exit(1)
-    finally:
-        # Restore stdout and stderr
-        if quiet_mode == "-q":
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
     return
 
 def main():
@@ -275,9 +846,14 @@ def main():
     soc, buffer_size, quiet_mode = create_socket()
 
     print("\nWelcome to FTP Server!\n")
-    
-    # Handle client requests
-    handle_client(soc, buffer_size, quiet_mode)
+    listener = configure_logging(quiet_mode)
+
+    try:
+        # Handle client requests
+        handle_client(soc, buffer_size)
+    finally:
+        # Write out whatever is still queued
+        listener.stop()
     return
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+import importlib.util, os, socket, subprocess, sys, time
+
+import pytest
+
+# Loopback round trips: every test gets servers of its own, started as scripts in a temporary directory, and
+# talks to them from the client modules, run from a directory of their own
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT_DIRECTORY = os.path.join(ROOT, "client")
+SERVER_TCP = os.path.join(ROOT, "server", "server-tcp.py")
+SERVER_UDP = os.path.join(ROOT, "server", "server-udp.py")
+CLIENT_UDP = os.path.join(CLIENT_DIRECTORY, "client-udp.py")
+STARTUP_TIMEOUT = 10
+UDP_BUFFER_SIZE = 8192
+
+# ftp_client and ftp_async import each other by module name, as when run from the client directory
+sys.path.insert(0, CLIENT_DIRECTORY)
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def load_script(path, name):
+    # The client and server scripts have dashes in their names, so they are loaded from their paths
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def stop_process(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    return
+
+def wait_for_tcp(port, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the TCP server exited on start-up")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("the TCP server did not start")
+
+def wait_for_udp(port, process):
+    # STAT is the one command answered without side effects
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.settimeout(0.2)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("the UDP server exited on start-up")
+            probe.sendto(b"STAT", ("127.0.0.1", port))
+            try:
+                probe.recvfrom(65535)
+                return
+            except socket.timeout:
+                continue
+    raise RuntimeError("the UDP server did not start")
+
+@pytest.fixture
+def server_directory(tmp_path):
+    directory = tmp_path / "server"
+    directory.mkdir()
+    return directory
+
+@pytest.fixture
+def client_directory(tmp_path, monkeypatch):
+    # The clients read and write files relative to the working directory
+    directory = tmp_path / "client"
+    directory.mkdir()
+    monkeypatch.chdir(directory)
+    return directory
+
+@pytest.fixture
+def tcp_server(server_directory):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, SERVER_TCP, "127.0.0.1", str(port), "65536", "-q"],
+                               cwd=server_directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_tcp(port, process)
+        yield "127.0.0.1", port
+    finally:
+        stop_process(process)
+
+@pytest.fixture
+def udp_server(server_directory):
+    port = free_port(socket.SOCK_DGRAM)
+    process = subprocess.Popen([sys.executable, SERVER_UDP, "127.0.0.1", str(port), str(UDP_BUFFER_SIZE), "-q"],
+                               cwd=server_directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_udp(port, process)
+        yield "127.0.0.1", port
+    finally:
+        stop_process(process)
@@ -0,0 +1,152 @@
+import hashlib, os, socket, zlib
+
+import pytest
+
+from ftp_client import PROTOCOL, Session
+
+CHUNK = PROTOCOL.MERKLE_CHUNK_SIZE
+
+def write_journal(path, content, chunks):
+    # What an interrupted transfer leaves next to its partial file: the digests of the chunks it finished
+    leaves = [hashlib.sha256(content[start:start + CHUNK]).digest() for start in range(0, chunks * CHUNK, CHUNK)]
+    path.write_bytes(PROTOCOL.TREE_JOURNAL_HEADER.pack(*PROTOCOL.PARTIAL_IDENTITY) + b"".join(leaves))
+    return leaves
+
+def test_resume_takes_finished_chunks_from_the_journal(client_directory):
+    content = os.urandom(2 * CHUNK + 1000)
+    leaves = write_journal(client_directory / "a.bin.ftp-tree", content, 2)
+    # Zeros where the journaled chunks were: had they been read again, their digests would differ
+    (client_directory / "a.bin.ftp-part").write_bytes(bytes(2 * CHUNK) + content[2 * CHUNK:])
+
+    with open("a.bin.ftp-part", "rb") as partial:
+        tree = PROTOCOL.resume_chunk_tree(partial.fileno(), len(content), "a.bin.ftp-tree")
+        PROTOCOL.close_tree_journal(tree)
+
+    assert PROTOCOL.finish_chunk_tree(tree) == leaves + [hashlib.sha256(content[2 * CHUNK:]).digest()]
+    assert PROTOCOL.load_tree_journal("a.bin.ftp-tree", PROTOCOL.PARTIAL_IDENTITY) == leaves
+
+def test_resumed_upload(tcp_server, server_directory, client_directory):
+    content = os.urandom(3 * CHUNK + 4567)
+    (client_directory / "big.bin").write_bytes(content)
+    offset = 2 * CHUNK + 100
+    (server_directory / "big.bin.ftp-part").write_bytes(content[:offset])
+    write_journal(server_directory / "big.bin.ftp-tree", content, 2)
+
+    with Session(*tcp_server) as session:
+        result = session.stor("big.bin", resume=True)
+
+    assert result["ok"], result
+    assert result["offset"] == offset
+    assert result["repaired_bytes"] == 0
+    assert (server_directory / "big.bin").read_bytes() == content
+    assert not (server_directory / "big.bin.ftp-tree").exists()
+    assert not (client_directory / "big.bin.ftp-tree").exists()
+
+def test_resumed_download(tcp_server, server_directory, client_directory):
+    content = os.urandom(3 * CHUNK + 4567)
+    (server_directory / "big.bin").write_bytes(content)
+    offset = CHUNK + 5
+    (client_directory / "big.bin.ftp-part").write_bytes(content[:offset])
+    write_journal(client_directory / "big.bin.ftp-tree", content, 1)
+
+    with Session(*tcp_server) as session:
+        result = session.retr("big.bin")
+
+    assert result["ok"], result
+    assert result["offset"] == offset
+    assert (client_directory / "big.bin").read_bytes() == content
+    assert not (client_directory / "big.bin.ftp-tree").exists()
+
+def test_upload_hashed_while_sent(tcp_server, server_directory, client_directory):
+    # Several sendfile ranges, each hashed after it left; a wrong digest would show as a repair
+    content = os.urandom(2 * PROTOCOL.SENDFILE_RANGE_SIZE + 4567)
+    (client_directory / "big.bin").write_bytes(content)
+
+    with Session(*tcp_server, dedup=False) as session:
+        result = session.stor("big.bin")
+
+    assert result["ok"], result
+    assert result["repaired_bytes"] == 0
+    assert (server_directory / "big.bin").read_bytes() == content
+
+def test_download_without_cached_root_needs_no_repair(tcp_server, server_directory, client_directory, monkeypatch):
+    # The server has no digests of these files: it hashes them as it sends them and the root follows the content
+    def no_repair(*args):
+        raise AssertionError("download was repaired")
+    monkeypatch.setattr(PROTOCOL, "repair_download", no_repair)
+    files = {"big.bin": os.urandom(2 * PROTOCOL.SENDFILE_RANGE_SIZE + 4567), "empty.bin": b"",
+             "text.txt": b"compressible line of text\n" * 200000, "resumed.bin": os.urandom(3 * CHUNK + 89)}
+    for name, content in files.items():
+        (server_directory / name).write_bytes(content)
+    (client_directory / "resumed.bin.ftp-part").write_bytes(files["resumed.bin"][:CHUNK + 7])
+
+    with Session(*tcp_server, compress="zlib") as session:
+        results = [session.retr(name) for name in files]
+
+    assert [result["ok"] for result in results] == [True] * len(files), results
+    assert results[3]["offset"] == CHUNK + 7
+    for name, content in files.items():
+        assert (client_directory / name).read_bytes() == content
+    # The digests taken on the way are cached for the next download
+    assert len(os.listdir(server_directory / ".ftp-digests")) == len(files)
+
+def test_file_shorter_than_its_frame_is_not_sent_short(client_directory):
+    # The file shrank after its size was read: the frame header announces more than sendfile can send
+    (client_directory / "shrunk.bin").write_bytes(os.urandom(1000))
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        with socket.create_connection(listener.getsockname()) as soc, listener.accept()[0], \
+                open("shrunk.bin", "rb") as content:
+            with pytest.raises(OSError, match="shrank"):
+                PROTOCOL.send_frame_with_file(soc, PROTOCOL.OP_STOR, 1, [b"meta"], content, 0, 5000)
+            with pytest.raises(OSError, match="shrank"):
+                PROTOCOL.send_frame_with_file(soc, PROTOCOL.OP_STOR, 2, [b"meta"], content, 0, 5000,
+                                              PROTOCOL.create_chunk_tree())
+
+@pytest.mark.parametrize("window", [os.urandom(5000), b"\xff" * 70000, bytes(300), b"a"])
+def test_rolling_checksums_match_adler32(window):
+    # All 0xff bytes push both sums past the modulus the most
+    for block_size in [size for size in (1, 7, 256, 4096, len(window)) if size <= len(window)]:
+        expected = [zlib.adler32(window[start:start + block_size]) for start in range(len(window) - block_size + 1)]
+        assert list(PROTOCOL.rolling_checksums(window, block_size)) == expected
+
+# The server picks blocks of 4 KiB for files of a few MiB
+DELTA_BLOCK = 4096
+
+@pytest.mark.parametrize("edit", ["insert", "overwrite"])
+def test_delta_upload_sends_only_what_changed(tcp_server, server_directory, client_directory, edit):
+    old = os.urandom(6 * CHUNK + 321)
+    (server_directory / "doc.bin").write_bytes(old)
+    # Two changes, one of them just past the client's first 4 MiB read
+    changes = [(CHUNK + 1000, os.urandom(100)), (4 * CHUNK + 10, os.urandom(100))]
+    new = old
+    for position, change in reversed(changes):
+        end = position if edit == "insert" else position + len(change)
+        new = new[:position] + change + new[end:]
+    (client_directory / "doc.bin").write_bytes(new)
+
+    with Session(*tcp_server, dedup=False) as session:
+        result = session.stor("doc.bin", delta=True)
+
+    assert result["ok"], result
+    assert (server_directory / "doc.bin").read_bytes() == new
+    # Each change costs at most the blocks it touches
+    assert 200 <= result["literal_bytes"] <= len(changes) * (2 * DELTA_BLOCK + 100)
+
+def test_segmented_round_trip(tcp_server, server_directory, client_directory, monkeypatch):
+    # Ranges of one chunk, so a few MiB make enough of them to spread over every stream
+    monkeypatch.setattr(PROTOCOL, "SEGMENT_SIZE", CHUNK)
+    content = os.urandom(5 * CHUNK + 777)
+    (client_directory / "big.bin").write_bytes(content)
+
+    with Session(*tcp_server, dedup=False) as session:
+        stored = session.stor("big.bin", streams=3)
+        os.remove("big.bin")
+        retrieved = session.retr("big.bin", streams=3)
+
+    assert stored["ok"], stored
+    assert retrieved["ok"], retrieved
+    assert stored["streams"] == retrieved["streams"] == 3
+    assert (server_directory / "big.bin").read_bytes() == content
+    assert (client_directory / "big.bin").read_bytes() == content
+    assert not (server_directory / "big.bin.ftp-seg").exists()
+    assert not (client_directory / "big.bin.ftp-seg").exists()
@@ -0,0 +1,80 @@
+import asyncio, os
+
+from ftp_async import AsyncSession, run_transfers
+from ftp_client import PROTOCOL
+
+def test_empty_file_round_trip(tcp_server, server_directory, client_directory):
+    host, port = tcp_server
+    (server_directory / "empty.bin").write_bytes(b"")
+    (server_directory / "full.bin").write_bytes(os.urandom(300000))
+    (client_directory / "local-empty.bin").write_bytes(b"")
+
+    results = asyncio.run(run_transfers([(host, port, "RETR", "empty.bin", "e2.bin"),
+                                         (host, port, "RETR", "full.bin", "f2.bin"),
+                                         (host, port, "STOR", "stored-empty.bin", "local-empty.bin")]))
+
+    assert [result["ok"] for result in results] == [True, True, True], results
+    assert (client_directory / "e2.bin").read_bytes() == b""
+    assert (client_directory / "f2.bin").read_bytes() == (server_directory / "full.bin").read_bytes()
+    assert (server_directory / "stored-empty.bin").read_bytes() == b""
+    assert not (client_directory / "e2.bin.ftp-part").exists()
+
+def test_resumed_download_matches(tcp_server, server_directory, client_directory):
+    host, port = tcp_server
+    content = os.urandom(3 * 1024 * 1024 + 123)
+    (server_directory / "big.bin").write_bytes(content)
+    # What an interrupted download leaves behind
+    (client_directory / "big.bin.ftp-part").write_bytes(content[:1500000])
+
+    result = asyncio.run(run_transfers([(host, port, "RETR", "big.bin")]))[0]
+
+    assert result["ok"], result
+    assert result["offset"] == 1500000
+    assert (client_directory / "big.bin").read_bytes() == content
+
+def test_upload_hashed_while_sent(tcp_server, server_directory, client_directory):
+    host, port = tcp_server
+    content = os.urandom(2 * PROTOCOL.SENDFILE_RANGE_SIZE + 4567)
+    (client_directory / "big.bin").write_bytes(content)
+
+    result = asyncio.run(run_transfers([(host, port, "STOR", "big.bin")]))[0]
+
+    assert result["ok"], result
+    assert (server_directory / "big.bin").read_bytes() == content
+
+def test_download_without_cached_root_is_not_hashed_again(tcp_server, server_directory, client_directory,
+                                                         monkeypatch):
+    async def no_query(*args):
+        raise AssertionError("the server was asked to hash its copy")
+    monkeypatch.setattr(AsyncSession, "query_root", no_query)
+    host, port = tcp_server
+    content = os.urandom(2 * PROTOCOL.SENDFILE_RANGE_SIZE + 4567)
+    (server_directory / "big.bin").write_bytes(content)
+
+    result = asyncio.run(run_transfers([(host, port, "RETR", "big.bin")]))[0]
+
+    assert result["ok"], result
+    assert (client_directory / "big.bin").read_bytes() == content
+
+def test_file_shorter_than_its_frame_fails_the_upload(tcp_server, server_directory, client_directory, monkeypatch):
+    # The file shrinks between its size being read and its content being sent
+    real_fstat = os.fstat
+
+    class Shrunk:
+        def __init__(self, stat):
+            self.stat = stat
+            self.st_size = stat.st_size + 5000
+
+        def __getattr__(self, name):
+            return getattr(self.stat, name)
+
+    monkeypatch.setattr(os, "fstat", lambda fd: Shrunk(real_fstat(fd)))
+    host, port = tcp_server
+    (client_directory / "shrunk.bin").write_bytes(os.urandom(300000))
+
+    # Sent short, the frame would leave the server waiting for the missing bytes
+    result = asyncio.run(run_transfers([(host, port, "STOR", "shrunk.bin")], timeout=10))[0]
+
+    assert not result["ok"]
+    assert "shrank" in result["error"], result
+    assert not (server_directory / "shrunk.bin").exists()
@@ -0,0 +1,144 @@
+import asyncio, os, random, socket, tempfile, threading
+
+import pytest
+
+from conftest import SERVER_TCP, load_script
+from ftp_client import PROTOCOL, Session
+
+SERVER = load_script(SERVER_TCP, "server_tcp")
+# Directories with more entries than this are listed from sorted runs on disk in the listing server below
+LISTING_LIMIT = 10
+
+@pytest.fixture
+def listing_server(server_directory, monkeypatch):
+    # A server in this process, so its in-memory listing limit can be cut down to a handful of entries
+    monkeypatch.setattr(SERVER, "LISTING_CACHE_MAX_ENTRIES", LISTING_LIMIT)
+    monkeypatch.chdir(server_directory)
+    soc = socket.create_server(("127.0.0.1", 0))
+    soc.setblocking(False)
+    address = soc.getsockname()
+    loop = asyncio.new_event_loop()
+    server = loop.create_task(SERVER.serve_forever(soc, 65536))
+    thread = threading.Thread(target=loop.run_until_complete, args=(asyncio.wait([server]),))
+    thread.start()
+    try:
+        yield address
+    finally:
+        loop.call_soon_threadsafe(server.cancel)
+        thread.join()
+        loop.close()
+
+def read_response(soc):
+    _, status, _, request_id, payload_length = PROTOCOL.recv_frame(soc)
+    return status, request_id, PROTOCOL.recv_exact(soc, payload_length)
+
+@pytest.mark.parametrize("opcode, meta", [(PROTOCOL.OP_STOR, PROTOCOL.STOR_REQUEST),
+                                          (PROTOCOL.OP_PUT, PROTOCOL.PUT_REQUEST)])
+def test_name_longer_than_frame_is_rejected_in_step(tcp_server, server_directory, opcode, meta):
+    (server_directory / "known.bin").write_bytes(b"12345")
+    soc = PROTOCOL.open_session(tcp_server)[0]
+    try:
+        PROTOCOL.send_frame(soc, PROTOCOL.OP_HELLO, 0, [PROTOCOL.CLIENT_HELLO.pack(PROTOCOL.CODEC_NONE)])
+        # The name claims 60000 bytes, the frame holds 4; the SIZE request right behind must still be understood
+        PROTOCOL.send_frame(soc, opcode, 1, [meta.pack(0, 60000), b"name"])
+        PROTOCOL.send_frame(soc, PROTOCOL.OP_SIZE, 2, [b"known.bin"])
+
+        assert read_response(soc)[:2] == (PROTOCOL.STATUS_BAD_REQUEST, 1)
+        status, request_id, payload = read_response(soc)
+        assert (status, request_id) == (PROTOCOL.STATUS_OK, 2)
+        assert PROTOCOL.SIZE_RESPONSE.unpack(payload)[0] == 5
+    finally:
+        soc.close()
+
+def test_frame_shorter_than_request_is_rejected_in_step(tcp_server):
+    soc = PROTOCOL.open_session(tcp_server)[0]
+    try:
+        PROTOCOL.send_frame(soc, PROTOCOL.OP_STOR, 1, [b"\x00\x00"])
+        PROTOCOL.send_frame(soc, PROTOCOL.OP_SIZE, 2, [b"missing.bin"])
+
+        assert read_response(soc)[:2] == (PROTOCOL.STATUS_BAD_REQUEST, 1)
+        assert read_response(soc)[:2] == (PROTOCOL.STATUS_NOT_FOUND, 2)
+    finally:
+        soc.close()
+
+NAMED_REQUESTS = [(PROTOCOL.OP_STOR, lambda name: [PROTOCOL.STOR_REQUEST.pack(0, len(name)), name, b"written"]),
+                  (PROTOCOL.OP_PUT, lambda name: [PROTOCOL.PUT_REQUEST.pack(0, len(name)), name, b"written"]),
+                  (PROTOCOL.OP_RETR, lambda name: [PROTOCOL.RETR_REQUEST.pack(0, bytes(32)), name]),
+                  (PROTOCOL.OP_COMMIT, lambda name: [PROTOCOL.COMMIT_REQUEST.pack(7, bytes(32)), name]),
+                  (PROTOCOL.OP_SIGS, lambda name: [PROTOCOL.SIGS_REQUEST.pack(0), name]),
+                  (PROTOCOL.OP_DEL, lambda name: [name]),
+                  (PROTOCOL.OP_REST, lambda name: [name]),
+                  (PROTOCOL.OP_HASH, lambda name: [name])]
+
+@pytest.mark.parametrize("opcode, payload", NAMED_REQUESTS)
+@pytest.mark.parametrize("name", ["../outside.txt", "sub/inner.txt", ".ftp-index", ".hidden", "x.ftp-part",
+                                  "x.ftp-seg", "x.ftp-delta", "x.ftp-tree", "x.ftp-old", "nul\0.txt"])
+def test_names_other_than_one_plain_file_are_rejected(tcp_server, server_directory, opcode, payload, name):
+    (server_directory.parent / "outside.txt").write_bytes(b"outside")
+    (server_directory / "sub").mkdir()
+    (server_directory / "sub" / "inner.txt").write_bytes(b"inner")
+    (server_directory / "x.ftp-part").write_bytes(b"another session's upload")
+    soc = PROTOCOL.open_session(tcp_server)[0]
+    try:
+        PROTOCOL.send_frame(soc, opcode, 1, payload(name.encode('utf-8')))
+        # The SIZE request right behind must still be understood
+        PROTOCOL.send_frame(soc, PROTOCOL.OP_SIZE, 2, [b"missing.bin"])
+
+        assert read_response(soc)[:2] == (PROTOCOL.STATUS_BAD_REQUEST, 1)
+        assert read_response(soc)[:2] == (PROTOCOL.STATUS_NOT_FOUND, 2)
+    finally:
+        soc.close()
+    assert (server_directory.parent / "outside.txt").read_bytes() == b"outside"
+    assert (server_directory / "sub" / "inner.txt").read_bytes() == b"inner"
+    assert (server_directory / "x.ftp-part").read_bytes() == b"another session's upload"
+    assert not (server_directory / "x.ftp-part.ftp-part").exists()
+
+def test_commit_with_a_wrong_root_is_refused(tcp_server, server_directory):
+    content = os.urandom(PROTOCOL.MERKLE_CHUNK_SIZE + 100)
+    soc = PROTOCOL.open_session(tcp_server)[0]
+    try:
+        PROTOCOL.send_frame(soc, PROTOCOL.OP_PUT, 1, [PROTOCOL.PUT_REQUEST.pack(0, 7), b"seg.bin", content])
+        assert read_response(soc)[:2] == (PROTOCOL.STATUS_OK, 1)
+        assert (server_directory / "seg.bin.ftp-seg").exists()
+
+        PROTOCOL.send_frame(soc, PROTOCOL.OP_COMMIT, 2, [PROTOCOL.COMMIT_REQUEST.pack(len(content), bytes(32)),
+                                                         b"seg.bin"])
+        assert read_response(soc)[:2] == (PROTOCOL.STATUS_ERROR, 2)
+    finally:
+        soc.close()
+    assert not (server_directory / "seg.bin").exists()
+    assert not (server_directory / "seg.bin.ftp-seg").exists()
+
+def list_in_pages(session, limit, page_size):
+    entries = []
+    cursor = ""
+    while True:
+        result = session.list(page_size=page_size, limit=limit, cursor=cursor)
+        assert result["ok"], result
+        assert len(result["entries"]) <= limit
+        entries.extend(result["entries"])
+        cursor = result["next_cursor"]
+        if not cursor:
+            return entries
+
+def test_listing_larger_than_memory_pages_in_order(listing_server, server_directory, monkeypatch):
+    names = [f"{index:03d}.txt" for index in range(95)]
+    for index in random.Random(1).sample(range(len(names)), len(names)):
+        (server_directory / names[index]).write_bytes(b"x" * index)
+    (server_directory / "partial.txt.ftp-part").write_bytes(b"not listed")
+    expected = [(name, index) for index, name in enumerate(names)]
+    runs = []
+    temporary_file = tempfile.TemporaryFile
+
+    def counted_temporary_file(*args, **kwargs):
+        runs.append(temporary_file(*args, **kwargs))
+        return runs[-1]
+    monkeypatch.setattr(tempfile, "TemporaryFile", counted_temporary_file)
+
+    with Session(*listing_server) as session:
+        # A limit above the in-memory one merges sorted runs from disk for every page, one at or below it keeps a
+        # window of the smallest names; without one, the whole directory is merged from runs
+        assert list_in_pages(session, 25, 7) == expected
+        assert runs
+        assert list_in_pages(session, 6, 4) == expected
+        assert session.list(sort=True)["entries"] == expected
@@ -0,0 +1,194 @@
+import builtins, collections, logging, os, random, socket
+
+import pytest
+
+from conftest import CLIENT_UDP, UDP_BUFFER_SIZE, load_script
+
+CLIENT = load_script(CLIENT_UDP, "client_udp")
+PEER = ("127.0.0.1", 9)
+LOSS = 0.1
+
+class ScriptedReceiver:
+    # Stands in for the socket of a send: every chunk is answered with an acknowledgement of another transfer, one
+    # of chunks never sent, and then the right one
+    def __init__(self):
+        self.datagrams = collections.deque()
+        self.received = 0
+        self.chunks = {}
+
+    def sendto(self, data, addr):
+        _, transfer_id, sequence, offset = CLIENT.DATA_HEADER.unpack_from(data)
+        self.chunks[offset] = data[CLIENT.DATA_HEADER.size:]
+        if sequence == self.received:
+            self.received += 1
+        self.datagrams.append(CLIENT.ACK_HEADER.pack(CLIENT.ACK_KIND, transfer_id + 1, 50, 0, 0))
+        self.datagrams.append(CLIENT.ACK_HEADER.pack(CLIENT.ACK_KIND, transfer_id, 1000, 0, 2 ** 64 - 1))
+        self.datagrams.append(CLIENT.acknowledgement(transfer_id, self.received, sequence, ()))
+        return len(data)
+
+    def recvfrom_into(self, buffer):
+        data = self.datagrams.popleft()
+        buffer[:len(data)] = data
+        return len(data), PEER
+
+    def gettimeout(self):
+        return None
+
+    def settimeout(self, timeout):
+        return
+
+def test_stale_acknowledgements_are_ignored():
+    content = bytes(range(256)) * 40
+    receiver = ScriptedReceiver()
+
+    figures = CLIENT.send_reliable(receiver, PEER, lambda offset, size: content[offset:offset + size], len(content),
+                                   1000, 7)
+
+    assert figures["retransmissions"] == 0
+    assert b"".join(receiver.chunks[offset] for offset in sorted(receiver.chunks)) == content
+
+class ScriptedSender:
+    # Stands in for the socket of a receive: hands out the scripted datagrams in order and keeps the acknowledgements
+    def __init__(self, datagrams):
+        self.datagrams = collections.deque(datagrams)
+
+    def sendto(self, data, addr):
+        return len(data)
+
+    def recvfrom_into(self, buffer):
+        data = self.datagrams.popleft()
+        buffer[:len(data)] = data
+        return len(data), PEER
+
+    def gettimeout(self):
+        return None
+
+    def settimeout(self, timeout):
+        return
+
+def test_chunks_out_of_place_are_dropped(tmp_path):
+    content = os.urandom(2500)
+
+    def data(sequence, offset, chunk):
+        return CLIENT.DATA_HEADER.pack(CLIENT.DATA_KIND, 7, sequence, offset) + chunk
+
+    # Among the chunks cut 1000 bytes at a time: one at the offset of another sequence number, one past the end of
+    # the file, one far past it, and one of the wrong size
+    receiver = ScriptedSender([data(1, 0, content[1000:2000]), data(3, 3000, bytes(1000)),
+                               data(1000000, 1000000000, bytes(1000)), data(0, 0, content[:999]),
+                               data(0, 0, content[:1000]), data(2, 2000, content[2000:]),
+                               data(1, 1000, content[1000:2000])])
+    tree = CLIENT.create_chunk_tree()
+    with open(tmp_path / "received.bin", "wb", buffering=0) as output_file:
+        CLIENT.receive_reliable(receiver, output_file, len(content), 1000, tree, 7)
+
+    assert (tmp_path / "received.bin").read_bytes() == content
+    assert not receiver.datagrams
+
+class LossySocket:
+    # A client socket that loses a datagram in ten, on the way out as on the way in: requests, replies, details,
+    # chunks and acknowledgements alike
+    def __init__(self, seed):
+        self.soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.random = random.Random(seed)
+
+    def sendto(self, data, addr):
+        if self.random.random() < LOSS:
+            return len(data)
+        return self.soc.sendto(data, addr)
+
+    def recvfrom(self, size):
+        while True:
+            data, addr = self.soc.recvfrom(size)
+            if self.random.random() >= LOSS:
+                return data, addr
+
+    def recvfrom_into(self, buffer):
+        while True:
+            size, addr = self.soc.recvfrom_into(buffer)
+            if self.random.random() >= LOSS:
+                return size, addr
+
+    def gettimeout(self):
+        return self.soc.gettimeout()
+
+    def settimeout(self, timeout):
+        self.soc.settimeout(timeout)
+        return
+
+    def close(self):
+        self.soc.close()
+        return
+
+def test_round_trips_under_loss(udp_server, server_directory, client_directory, caplog, monkeypatch):
+    caplog.set_level(logging.INFO, logger="ftp.client")
+    monkeypatch.setattr(builtins, "input", lambda prompt: "Y")
+    monkeypatch.setattr(CLIENT, "flush_log", lambda: None)
+    content = os.urandom(300000)
+    (client_directory / "up.bin").write_bytes(content)
+    (client_directory / "empty.bin").write_bytes(b"")
+    (server_directory / "down.bin").write_bytes(content[::-1])
+    (server_directory / "gone.bin").write_bytes(b"to be deleted")
+
+    for seed in range(3):
+        soc = LossySocket(seed)
+        try:
+            CLIENT.store_file_to_server(soc, udp_server, UDP_BUFFER_SIZE, "STOR", "up.bin")
+            CLIENT.store_file_to_server(soc, udp_server, UDP_BUFFER_SIZE, "STOR", "empty.bin")
+            CLIENT.retrieve_file_from_server(soc, udp_server, UDP_BUFFER_SIZE, "RETR", "down.bin")
+        finally:
+            soc.close()
+
+        assert (server_directory / "up.bin").read_bytes() == content
+        assert (server_directory / "empty.bin").read_bytes() == b""
+        assert (client_directory / "down.bin").read_bytes() == content[::-1]
+        os.remove(client_directory / "down.bin")
+
+    soc = LossySocket(3)
+    try:
+        CLIENT.delete_file_from_server(soc, udp_server, UDP_BUFFER_SIZE, "DEL", "gone.bin")
+    finally:
+        soc.close()
+
+    assert not (server_directory / "gone.bin").exists()
+    assert [record.getMessage() for record in caplog.records if record.levelno >= logging.WARNING] == []
+
+def send_request(soc, server, command, transfer_id, file_name, file_size=0, chunk_size=0):
+    request = CLIENT.create_request(command, transfer_id, file_name, file_size, chunk_size)
+    soc.sendto(request, server)
+    return CLIENT.await_answer(soc, server, request, transfer_id, CLIENT.REPLY_KIND)
+
+def test_upload_in_progress_leaves_the_old_file(udp_server, server_directory):
+    (server_directory / "kept.bin").write_bytes(b"old content")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as soc:
+        assert CLIENT.REPLY_HEADER.unpack(send_request(soc, udp_server, "STOR", 5, "kept.bin", 100000, 1000))[2] == 1
+        # One chunk of many: the server is left waiting for the rest
+        soc.sendto(CLIENT.DATA_HEADER.pack(CLIENT.DATA_KIND, 5, 0, 0) + bytes(1000), udp_server)
+        soc.settimeout(5)
+        assert CLIENT.ACK_HEADER.unpack(soc.recvfrom(CLIENT.MAX_DATAGRAM_SIZE)[0])[2] == 1
+
+        assert (server_directory / "kept.bin").read_bytes() == b"old content"
+        assert (server_directory / "kept.bin.ftp-part").exists()
+
+@pytest.mark.parametrize("name", ["../outside.txt", "sub/inner.txt", ".hidden", "kept.bin.ftp-part"])
+def test_names_other_than_one_plain_file_are_refused(udp_server, server_directory, name):
+    (server_directory.parent / "outside.txt").write_bytes(b"outside")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as soc:
+        for transfer_id, command in enumerate(("STOR", "RETR", "DEL")):
+            answer = send_request(soc, udp_server, command, transfer_id, name, 7, 1000)
+            assert CLIENT.REPLY_HEADER.unpack(answer)[2] == 0
+    assert (server_directory.parent / "outside.txt").read_bytes() == b"outside"
+
+def test_damaged_download_leaves_the_old_file(udp_server, server_directory, client_directory, monkeypatch):
+    (server_directory / "down.bin").write_bytes(os.urandom(50000))
+    (client_directory / "down.bin").write_bytes(b"old content")
+    # The root of what arrived differs from the server's, as if a chunk was damaged on the way
+    monkeypatch.setattr(CLIENT, "merkle_root", lambda tree: bytes(32))
+    soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        CLIENT.retrieve_file_from_server(soc, udp_server, UDP_BUFFER_SIZE, "RETR", "down.bin")
+    finally:
+        soc.close()
+
+    assert (client_directory / "down.bin").read_bytes() == b"old content"
+    assert not (client_directory / "down.bin.ftp-part").exists()